@@ -9,12 +9,6 @@ TODO:
     (o) list of particularly specified files (notes, etc) to be copied in
         to an extra directory (will need to create corresponding XML
         section)? 
-    (o) tar command to output "progress" (like ascii progress bar)?
-    (o) multithreaded / multiprocess running tar, gzip, gzip test
-        commands to be packed into a single Command instance (rather
-        than each of these being a single Command instance) and these
-        new instances could then potencially be processed in parallel
-        by the Executor class
     (o) to change the rights ... ?
             chgrp xmax backupdir ; chmod o-w,o-r,o-x,g+w backupdir
     (o) implement loggger differently, just log, does it have to be
@@ -37,6 +31,28 @@ import time
 import subprocess
 import tempfile
 import shutil
+import threading
+import Queue
+import fnmatch
+import re
+import collections
+import hashlib
+import gzip
+import stat
+import select
+import signal
+import fcntl
+import errno
+import resource
+import json
+import sqlite3
+import struct
+import tarfile
+import zlib
+import bz2
+import bisect
+import heapq
+import itertools
 # specific imports
 try:
     from pyxmaxlibs import helpers
@@ -45,245 +61,3962 @@ try:
 except ImportError, ex:
     print "Cannot import necessary Python modules, reason: %s" % ex
     sys.exit(1)
+# optional compression modules, used by builtin-auto action if available
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# optional, vectorises the rolling hash of builtin-dedup action
+try:
+    import numpy
+except ImportError:
+    numpy = None
+# C library for the calls missing in Python 2 os module (posix_fadvise)
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.posix_fadvise64.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                     ctypes.c_int64, ctypes.c_int]
+except (ImportError, OSError, AttributeError):
+    libc = None
+
+
+# built-in actions, may be used in the 'actions' attribute of the <dir>
+# element instead of the tar, gzip, gzip -t shell command templates
+# builtin-targz - single pass tar + gzip + verification, done in-process
+# builtin-dedup - tar stream stored as deduplicated chunks in the chunk
+#                 store of the destination directory, the archive itself
+#                 is just a recipe file (list of chunks)
+# builtin-auto  - as builtin-targz, compression (gzip, bz2, xz, zstd or
+#                 none) chosen by sampling the source directory
+# builtin-seekable - as builtin-targz, compressed in independent frames
+#                 with an index of members stored next to the archive,
+#                 single files are restored without decompressing all
+BUILTIN_ACTIONS = ("builtin-targz", "builtin-dedup", "builtin-auto",
+                   "builtin-seekable")
+# built-in replacement of the gzip (create archive) command template,
+# compresses the tar archive on several threads (see --compress-threads)
+BUILTIN_GZIP = "builtin-gzip"
+# already compressed file types, not worth compressing again
+COMPRESSED_EXTENSIONS = set([
+    "jpg", "jpeg", "png", "gif", "heic", "webp", "mp3", "ogg", "flac",
+    "m4a", "mp4", "m4v", "mov", "avi", "mkv", "webm", "gz", "tgz", "bz2",
+    "xz", "txz", "zst", "lz4", "zip", "7z", "rar", "jar", "deb", "rpm",
+    "docx", "xlsx", "pptx", "odt", "ods", "epub"])
+# catalog of archived members of all backups in the destination
+# directory and directory of member lists of a backup, the catalog is
+# updated from at the end of the backup
+CATALOG_FILE = "catalog.sqlite"
+CATALOG_DIR = ".catalog"
+# orders in which built-in actions archive files (see ArchiveCommand)
+ARCHIVE_ORDERS = ("directory", "inode", "extent")
+# FIEMAP ioctl (Linux) returning physical extents of a file
+FS_IOC_FIEMAP = 0xC020660B
+# posix_fadvise advices (Linux values)
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+# rough archiving speed (tar + gzip on one core) the Planner estimates
+# duration of the backup by, bytes per second and seconds per file
+PLAN_RATE = 20 * 1024 * 1024
+PLAN_FILE_COST = 0.002
+
+
+class Executor(object):
+
+    def __init__(self, dstDir, logger, workers=1):
+        self.dstDir = dstDir
+        self.logger = logger
+        # number of commands which may run at the same time, only
+        # commands independent of each other are run in parallel
+        self.workers = workers
+        # stdout log files are shared by commands (archive-filelist.log),
+        # file name -> SharedLogFile
+        self.logFiles = {}
+        self.logFilesLock = threading.Lock()
+        # commands executed so far (in order of finishing), their
+        # resource usage is available by command.getStats()
+        self.executed = []
+        # journal of completed commands of the current execute() call
+        self.journal = None
+        # commands whose output is consumed by a command depending on
+        # them (not final, see Journal.getConsumed())
+        self.consumed = set()
+
+    def _openOutput(self, command):
+        """
+        Returns CommandOutput for stdout of the command - either appending
+        into command.getStdOutLogFile() (shared by commands) or logging.
+
+        """
+        logFile = command.getStdOutLogFile()
+        sharedLog = None
+        if logFile:
+            self.logger.debug("Storing command stdout into file '%s'" %
+                              logFile)
+            self.logFilesLock.acquire()
+            try:
+                if logFile not in self.logFiles:
+                    self.logFiles[logFile] = SharedLogFile(logFile)
+                sharedLog = self.logFiles[logFile]
+            finally:
+                self.logFilesLock.release()
+        return CommandOutput("'%s' stdout" % command.getCommand(),
+                             self.logger, sharedLog=sharedLog,
+                             prefix=command.getLogPrefix())
+
+    def _readProcIO(self, pid, stats):
+        """
+        Update stats by I/O counters of the process pid from
+        /proc/<pid>/io (has to be read before the process is reaped).
+
+        """
+        names = {"rchar": "readChars", "wchar": "writeChars",
+                 "read_bytes": "readBytes", "write_bytes": "writeBytes"}
+        try:
+            f = open("/proc/%s/io" % pid, "r")
+            try:
+                for line in f:
+                    key, value = line.split(":")
+                    if key in names:
+                        stats[names[key]] = int(value)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            pass # not Linux or the process is gone
+
+    def _pumpOutput(self, p, stdOut, stdErr, stats, bwLimit=None):
+        """
+        Pass output of the running process p chunk by chunk into stdOut,
+        stdErr (CommandOutput) as it comes, until both pipes are closed.
+        I/O counters of the process are sampled into stats meanwhile.
+        If bwLimit (BandwidthLimit) is given, data read by the process is
+        charged to it and the process is stopped for the time it exceeds
+        the limit by.
+
+        """
+        outputs = {p.stdout.fileno(): stdOut, p.stderr.fileno(): stdErr}
+        # throttled process is sampled often, it is paused in short steps
+        interval = 0.1 if bwLimit else 1
+        lastSample = 0
+        lastRead = 0
+        stats["throttledTime"] = 0
+        while outputs:
+            if time.time() - lastSample > interval:
+                self._readProcIO(p.pid, stats)
+                lastSample = time.time()
+                if bwLimit:
+                    read = stats.get("readChars", 0)
+                    wait = bwLimit.consume(read - lastRead)
+                    lastRead = read
+                    if wait:
+                        self._pauseProcess(p, wait)
+                        stats["throttledTime"] += wait
+            try:
+                ready = select.select(outputs.keys(), [], [],
+                                      interval)[0]
+            except select.error, ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, CommandOutput.chunkSize)
+                if data:
+                    outputs[fd].write(data)
+                else:
+                    del outputs[fd] # EOF
+        # pipes are closed, the process is (about to be) finished
+        self._readProcIO(p.pid, stats)
+        p.stdout.close()
+        p.stderr.close()
+
+    def _pauseProcess(self, p, seconds):
+        """
+        Stop the process p for seconds (throttling).
+
+        """
+        try:
+            os.kill(p.pid, signal.SIGSTOP)
+        except OSError:
+            return # finished meanwhile
+        try:
+            time.sleep(seconds)
+        finally:
+            try:
+                os.kill(p.pid, signal.SIGCONT)
+            except OSError:
+                pass
+
+    def _waitProcess(self, p, stats):
+        """
+        Wait for the process p to finish, returns its return code (as
+        subprocess does), resource usage of the process goes into stats.
+
+        """
+        while True:
+            try:
+                pid, status, usage = os.wait4(p.pid, 0)
+                break
+            except OSError, ex:
+                if ex.errno != errno.EINTR:
+                    raise
+        return self._setExitStatus(p, status, usage, stats)
+
+    def _setExitStatus(self, p, status, usage, stats):
+        """
+        Set return code of the finished process p from its wait status,
+        its resource usage goes into stats. Returns the return code.
+
+        """
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        stats.update({"userTime": usage.ru_utime,
+                      "sysTime": usage.ru_stime,
+                      "maxRSS": usage.ru_maxrss})
+        return p.returncode
+
+    def _recordStats(self, c, stats, startTime, retCode):
+        # entries skipped by the filters, counted by Planner for shell
+        # actions (walked while estimating)
+        stats.setdefault("skipped", c.getSkipped())
+        stats.update({"command": c.getCommand(),
+                      "start": startTime,
+                      "wallTime": time.time() - startTime,
+                      "exitStatus": retCode})
+        c.setStats(stats)
+        self.executed.append(c)
+        self.logger.debug("'%s' resources: %s" % (c.getCommand(), stats))
+
+    def execute(self, commands, journal=None):
+        """
+        Execute commands. If journal (Journal) is given, commands found
+        completed in it are skipped and completed commands are recorded
+        into it.
+
+        """
+        if journal:
+            done = journal.getDone(commands)
+            for c in commands:
+                if c in done:
+                    self.logger.info("'%s' completed by a previous run, "
+                                     "skipped." % c.getCommand())
+            commands = [c for c in commands if c not in done]
+
+        strComm = "\t".join(["'%s'\n" % c.getCommand() for c in commands])
+        self.logger.info("%s command(s) to be executed:\n\t%s" %
+                         (len(commands), strComm))
+
+        self.journal = journal
+        self.consumed = Journal.getConsumed(commands)
+        try:
+            self._executeAll(commands)
+        finally:
+            self.journal = None
+
+    def _executeAll(self, commands):
+        if self.workers > 1 and len(commands) > 1:
+            self._executeParallel(commands)
+        else:
+            for c in commands:
+                self._executeCommand(c)
+
+    def _executeParallel(self, commands):
+        """
+        Run commands on a pool of worker threads. A command is handed
+        over to a worker only once all its dependencies (within commands)
+        finished successfully, commands depending on a failed command
+        are not run at all. Independent commands are started in the
+        order as they come in the commands list.
+
+        """
+        self.logger.info("Running commands on %s worker threads." %
+                         self.workers)
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+
+        def worker():
+            while True:
+                c = tasks.get()
+                if c is None:
+                    break
+                try:
+                    ok = self._executeCommand(c)
+                except Exception, ex:
+                    self.logger.error("'%s' failed, reason: %s" %
+                                      (c.getCommand(), ex))
+                    ok = False
+                results.put((c, ok))
+
+        threads = []
+        for i in range(min(self.workers, len(commands))):
+            t = threading.Thread(target=worker, name="executor-%s" % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        known = set(commands)
+        pending = list(commands) # keeps order
+        finished = set()
+        failed = set()
+        running = 0
+        try:
+            while pending or running:
+                for c in pending[:]:
+                    deps = [d for d in c.getDependencies() if d in known]
+                    if [d for d in deps if d in failed]:
+                        self.logger.error("Skipping '%s', a command it "
+                                          "depends on failed." %
+                                          c.getCommand())
+                        pending.remove(c)
+                        failed.add(c)
+                    elif len([d for d in deps if d in finished]) == len(deps):
+                        pending.remove(c)
+                        tasks.put(c)
+                        running += 1
+                if not running:
+                    # remaining commands wait for each other
+                    m = ("Unresolvable command dependencies: %s" %
+                         [c.getCommand() for c in pending])
+                    raise Exception(m)
+                # timeout makes the wait interruptible (KeyboardInterrupt)
+                c, ok = results.get(True, 365 * 24 * 3600)
+                running -= 1
+                if ok:
+                    finished.add(c)
+                else:
+                    failed.add(c)
+        finally:
+            for t in threads:
+                tasks.put(None)
+            for t in threads:
+                t.join()
+
+    def _executeCommand(self, c):
+        """
+        Run a single command, returns True if it succeeded.
+        Safe to be called from several threads at the same time, the
+        process working directory is never changed.
+
+        """
+        if self.journal:
+            self._removeIncompleteOutput(c)
+        if isinstance(c, BuiltinCommand):
+            return self._executeBuiltinCommand(c)
+
+        comm = c.getCommand()
+        self.logger.debug("Running in directory '%s'" % c.getChangeToDir())
+        self.logger.info("Executing command:\n\t'%s' ..." % comm)
+        # output is passed on as it comes, never held as a whole
+        stdOut = self._openOutput(c)
+        stdErr = CommandOutput("'%s' stderr" % comm, self.logger)
+        stats = {}
+        startTime = time.time()
+        try:
+            # subprocess.Popen() requires arguments in a sequence, if run
+            # with shell=True argument then could take the whole string
+            # close_fds - processes started in parallel must not inherit
+            # each other's pipes (would never see end of file otherwise)
+            p = subprocess.Popen(comm.split(),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 cwd=c.getChangeToDir(),
+                                 close_fds=True)
+            self._pumpOutput(p, stdOut, stdErr, stats, c.getBwLimit())
+            retCode = self._waitProcess(p, stats)
+        finally:
+            stdOut.close()
+            stdErr.close()
+        self.logger.debug("%s lines of stdout, %s lines of stderr." %
+                          (stdOut.lines, stdErr.lines))
+        stats["stdOutLines"] = stdOut.lines
+        self._recordStats(c, stats, startTime, retCode)
+
+        if retCode:
+            m = "'%s' failed, return code: %s" % (comm, retCode)
+            self.logger.error(m)
+            # just log, do not terminate the whole process
+            #raise Exception(m)
+            return False
+        self.logger.info("Command finished, no error raised.")
+        self._completed(c)
+        return True
+
+    def _completed(self, c):
+        """
+        Bookkeeping of a successfully finished command c.
+
+        """
+        if c.getMemberList() and not isinstance(c, BuiltinCommand):
+            # tar archive, built-in commands list members themselves
+            try:
+                listTarMembers(c.getOutputFile(), c.getMemberList())
+            except (IOError, OSError, tarfile.TarError), ex:
+                self.logger.warning("Cannot list members of '%s' for the "
+                                    "catalog, reason: %s" %
+                                    (c.getOutputFile(), ex))
+        if self.journal:
+            self.journal.record(c, final=c not in self.consumed)
+
+    def _removeIncompleteOutput(self, c):
+        """
+        Output of a command which is about to run is left over by an
+        interrupted run (the command is not recorded as completed).
+
+        """
+        output = c.getOutputFile()
+        if output and os.path.exists(output):
+            self.logger.warning("Removing incomplete output '%s' of an "
+                                "interrupted run." % output)
+            os.remove(output)
+
+    def _executeBuiltinCommand(self, c):
+        """
+        Run a built-in command in-process. The list of archived files
+        (if any) is stored the same way as tar -v output is.
+
+        """
+        comm = c.getCommand()
+        self.logger.info("Executing built-in command:\n\t'%s' ..." % comm)
+        stdOut = self._openOutput(c)
+        startTime = time.time()
+        # runs in a thread of this process, CPU time and peak memory
+        # can only be measured for the whole process
+        startUsage = resource.getrusage(resource.RUSAGE_SELF)
+        retCode = 0
+        try:
+            try:
+                c.run(stdOut, self.logger)
+            finally:
+                stdOut.close()
+        except Exception, ex:
+            m = "'%s' failed, reason: %s" % (comm, ex)
+            self.logger.error(m)
+            retCode = 1
+        self._recordBuiltinStats(c, stdOut, startTime, startUsage, retCode)
+        if retCode:
+            return False
+        self.logger.info("Command finished, no error raised.")
+        self._completed(c)
+        return True
+
+    def _recordBuiltinStats(self, c, stdOut, startTime, startUsage,
+                            retCode):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        stats = {"userTime": usage.ru_utime - startUsage.ru_utime,
+                 "sysTime": usage.ru_stime - startUsage.ru_stime,
+                 "maxRSS": usage.ru_maxrss,
+                 "usageScope": "process",
+                 "readBytes": c.bytesRead,
+                 "writeBytes": c.bytesWritten,
+                 "throttledTime": c.throttledTime,
+                 "skipped": c.getSkipped(),
+                 "stdOutLines": stdOut.lines}
+        self._recordStats(c, stats, startTime, retCode)
+
+
+class EventExecutor(Executor):
+    """
+    Executor running commands (up to workers at the same time) in a
+    single thread event loop instead of on worker threads: output pipes
+    of the processes are read as they become readable and built-in
+    commands are run in steps (see BuiltinCommand.steps()) in between.
+    Progress of the backup - bytes read by the archive commands against
+    their estimate (see Planner), throughput and estimated time to
+    finish - is logged periodically and stored into statusFile (JSON)
+    for other tools to poll.
+
+    """
+
+    # seconds between progress log lines and status file updates
+    logInterval = 60
+    statusInterval = 2
+    # seconds a built-in command runs before other commands get a turn
+    timeSlice = 0.05
+
+    def __init__(self, dstDir, logger, workers=1, statusFile=None):
+        Executor.__init__(self, dstDir, logger, workers)
+        self.statusFile = statusFile
+
+    def _executeAll(self, commands):
+        """
+        Run commands as Executor._executeParallel() does: a command is
+        started once all its dependencies (within commands) finished
+        successfully, commands depending on a failed command are not
+        run at all.
+
+        """
+        self.logger.info("Running commands in the event loop, at most %s "
+                         "at the same time." % self.workers)
+        known = set(commands)
+        pending = list(commands) # keeps order
+        running = []
+        finished = set()
+        failed = set()
+        progress = Progress(commands)
+        lastLog = lastStatus = time.time()
+        try:
+            while pending or running:
+                for c in pending[:]:
+                    if len(running) >= self.workers:
+                        break
+                    deps = [d for d in c.getDependencies() if d in known]
+                    if [d for d in deps if d in failed]:
+                        self.logger.error("Skipping '%s', a command it "
+                                          "depends on failed." %
+                                          c.getCommand())
+                        pending.remove(c)
+                        failed.add(c)
+                    elif len([d for d in deps if d in finished]) == len(deps):
+                        pending.remove(c)
+                        task = self._startTask(c)
+                        if task:
+                            running.append(task)
+                        else:
+                            failed.add(c)
+                if not running:
+                    if pending:
+                        # remaining commands wait for each other
+                        m = ("Unresolvable command dependencies: %s" %
+                             [c.getCommand() for c in pending])
+                        raise Exception(m)
+                    break
+                self._poll(running)
+                for task in running[:]:
+                    ok = task.advance()
+                    if ok is None:
+                        continue
+                    running.remove(task)
+                    self._finishTask(task, ok)
+                    if ok:
+                        finished.add(task.command)
+                    else:
+                        failed.add(task.command)
+                now = time.time()
+                progress.update(running, finished | failed, now)
+                if now - lastStatus > self.statusInterval:
+                    lastStatus = now
+                    self._storeStatus(progress, "running", pending)
+                    if sys.stderr.isatty() and progress.total:
+                        sys.stderr.write("\r%s " % progress)
+                if now - lastLog > self.logInterval and progress.total:
+                    lastLog = now
+                    self.logger.info("Progress: %s" % progress)
+        finally:
+            for task in running:
+                task.abort()
+                self._finishTask(task, False)
+        if sys.stderr.isatty() and progress.total:
+            sys.stderr.write("\n")
+        if progress.total:
+            self.logger.info("Progress: %s" % progress)
+        self._storeStatus(progress, "finished", pending)
+
+    def _startTask(self, c):
+        """
+        Returns running ProcessTask or BuiltinTask of the command c, None
+        if it could not be started.
+
+        """
+        if self.journal:
+            self._removeIncompleteOutput(c)
+        comm = c.getCommand()
+        try:
+            if isinstance(c, BuiltinCommand):
+                self.logger.info("Executing built-in command:\n\t'%s' ..." %
+                                 comm)
+                return BuiltinTask(c, self._openOutput(c), self.logger)
+            self.logger.debug("Running in directory '%s'" %
+                              c.getChangeToDir())
+            self.logger.info("Executing command:\n\t'%s' ..." % comm)
+            return ProcessTask(c, self._openOutput(c), self)
+        except Exception, ex:
+            self.logger.error("'%s' failed, reason: %s" % (comm, ex))
+            return None
+
+    def _poll(self, running):
+        """
+        Read output of the processes which is ready, waits for it up to
+        0.1s unless a built-in command has work to do sooner.
+
+        """
+        outputs = {}
+        for task in running:
+            for fd in task.getFds():
+                outputs[fd] = task
+        timeout = 0.1
+        now = time.time()
+        for task in running:
+            if isinstance(task, BuiltinTask):
+                timeout = min(timeout, task.getDelay(now))
+        if not outputs:
+            time.sleep(timeout)
+            return
+        try:
+            ready = select.select(outputs.keys(), [], [], timeout)[0]
+        except select.error, ex:
+            if ex.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in ready:
+            outputs[fd].read(fd)
+
+    def _finishTask(self, task, ok):
+        c = task.command
+        for out in task.getOutputs():
+            out.close()
+        if isinstance(task, BuiltinTask):
+            self._recordBuiltinStats(c, task.stdOut, task.startTime,
+                                     task.startUsage, 0 if ok else 1)
+        else:
+            task.stats["stdOutLines"] = task.stdOut.lines
+            self._recordStats(c, task.stats, task.startTime,
+                              task.p.returncode)
+            if not ok:
+                self.logger.error("'%s' failed, return code: %s" %
+                                  (c.getCommand(), task.p.returncode))
+        if ok:
+            self.logger.info("'%s' finished, no error raised." %
+                             c.getCommand())
+            self._completed(c)
+
+    def _storeStatus(self, progress, state, pending):
+        """
+        Store progress into the status file, replaced atomically so that
+        readers never see a partial file.
+
+        """
+        if not self.statusFile or not progress.total:
+            return
+        status = progress.getStatus()
+        status.update({"state": state,
+                       "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "pending": [c.getCommand() for c in pending]})
+        tmp = "".join([self.statusFile, ".tmp"])
+        try:
+            f = open(tmp, "w")
+            try:
+                json.dump(status, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+            os.rename(tmp, self.statusFile)
+        except (IOError, OSError), ex:
+            self.logger.warning("Cannot store status file '%s', reason: "
+                                "%s" % (self.statusFile, ex))
+
+
+class ProcessTask(object):
+    """
+    Command running as a process in the EventExecutor loop. Output is
+    read by read() as it becomes available, the process is sampled,
+    throttled and finally reaped by advance().
+
+    """
+
+    # seconds between samples of I/O counters of the process
+    sampleInterval = 0.5
+
+    def __init__(self, command, stdOut, executor):
+        self.command = command
+        self.stdOut = stdOut
+        self.executor = executor
+        comm = command.getCommand()
+        self.stdErr = CommandOutput("'%s' stderr" % comm, executor.logger)
+        self.stats = {"throttledTime": 0}
+        self.startTime = time.time()
+        try:
+            # see Executor._executeCommand()
+            self.p = subprocess.Popen(comm.split(),
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      cwd=command.getChangeToDir(),
+                                      close_fds=True)
+        except:
+            self.stdOut.close()
+            self.stdErr.close()
+            raise
+        self.outputs = {self.p.stdout.fileno(): self.stdOut,
+                        self.p.stderr.fileno(): self.stdErr}
+        self.lastSample = 0
+        self.lastRead = 0
+        # time to continue the process stopped by throttling
+        self.resumeAt = None
+
+    def getFds(self):
+        return self.outputs.keys()
+
+    def getOutputs(self):
+        return [self.stdOut, self.stdErr]
+
+    def getBytesDone(self):
+        return self.stats.get("readChars", 0)
+
+    def read(self, fd):
+        data = os.read(fd, CommandOutput.chunkSize)
+        if data:
+            self.outputs[fd].write(data)
+        else:
+            del self.outputs[fd] # EOF
+
+    def advance(self):
+        """
+        Returns None while the process is running, True if it succeeded,
+        False if it failed.
+
+        """
+        now = time.time()
+        if self.resumeAt and now >= self.resumeAt:
+            self._signal(signal.SIGCONT)
+            self.resumeAt = None
+        if not self.resumeAt and now - self.lastSample > self.sampleInterval:
+            self.lastSample = now
+            self.executor._readProcIO(self.p.pid, self.stats)
+            bwLimit = self.command.getBwLimit()
+            if bwLimit:
+                read = self.getBytesDone()
+                wait = bwLimit.consume(read - self.lastRead)
+                self.lastRead = read
+                if wait:
+                    self._signal(signal.SIGSTOP)
+                    self.resumeAt = now + wait
+                    self.stats["throttledTime"] += wait
+        if self.outputs:
+            return None
+        # pipes are closed, the process is (about to be) finished
+        if self.resumeAt:
+            self._signal(signal.SIGCONT)
+            self.resumeAt = None
+        self.executor._readProcIO(self.p.pid, self.stats)
+        try:
+            pid, status, usage = os.wait4(self.p.pid, os.WNOHANG)
+        except OSError, ex:
+            if ex.errno == errno.EINTR:
+                return None
+            raise
+        if not pid:
+            return None
+        self.p.stdout.close()
+        self.p.stderr.close()
+        return self.executor._setExitStatus(self.p, status, usage,
+                                            self.stats) == 0
+
+    def _signal(self, sig):
+        try:
+            os.kill(self.p.pid, sig)
+        except OSError:
+            pass # finished meanwhile
+
+    def abort(self):
+        """
+        Kill the process (the loop was interrupted).
+
+        """
+        self._signal(signal.SIGKILL)
+        self._signal(signal.SIGCONT)
+        self.executor._waitProcess(self.p, self.stats)
+        self.p.stdout.close()
+        self.p.stderr.close()
+
+
+class BuiltinTask(object):
+    """
+    Built-in command running in the EventExecutor loop, a time slice of
+    its steps is run by each advance().
+
+    """
+
+    def __init__(self, command, stdOut, logger):
+        self.command = command
+        self.stdOut = stdOut
+        self.logger = logger
+        self.startTime = time.time()
+        # CPU time and peak memory of the whole process, as for the
+        # built-in commands run by Executor
+        self.startUsage = resource.getrusage(resource.RUSAGE_SELF)
+        self.steps = command.steps(stdOut, logger)
+        # time to run the next step of the command throttled by its
+        # bandwidth limit
+        self.resumeAt = None
+
+    def getFds(self):
+        return []
+
+    def getOutputs(self):
+        return [self.stdOut]
+
+    def getBytesDone(self):
+        return self.command.bytesRead
+
+    def advance(self):
+        """
+        Returns None while the command has steps to run, True if it
+        succeeded, False if it failed.
+
+        """
+        now = time.time()
+        if self.resumeAt:
+            if now < self.resumeAt:
+                return None
+            self.resumeAt = None
+        end = now + EventExecutor.timeSlice
+        try:
+            while time.time() < end:
+                wait = self.steps.next()
+                if wait:
+                    self.resumeAt = time.time() + wait
+                    break
+        except StopIteration:
+            return True
+        except Exception, ex:
+            self.logger.error("'%s' failed, reason: %s" %
+                              (self.command.getCommand(), ex))
+            return False
+        return None
+
+    def getDelay(self, now):
+        """
+        Returns seconds until the next step may run.
+
+        """
+        return max(0, self.resumeAt - now) if self.resumeAt else 0
+
+    def abort(self):
+        self.steps.close()
+
+
+class Progress(object):
+    """
+    Progress of the backup: bytes read by the commands with an estimate
+    (archive commands estimated by Planner) against the estimate, overall
+    throughput and estimated time to finish.
+
+    """
+
+    def __init__(self, commands):
+        self.commands = [c for c in commands if c.getEstimate()]
+        self.total = sum([c.getEstimate()[0] for c in self.commands])
+        self.done = 0
+        self.startTime = time.time()
+        self.elapsed = 0
+        self.running = []
+
+    def update(self, running, ended, now):
+        """
+        Update by the running tasks and the commands ended (finished or
+        failed) so far.
+
+        """
+        tasks = dict([(t.command, t) for t in running])
+        self.done = 0
+        for c in self.commands:
+            size = c.getEstimate()[0]
+            if c in ended:
+                self.done += size
+            elif c in tasks:
+                # estimate may be exceeded (files grew, archive headers)
+                self.done += min(size, tasks[c].getBytesDone())
+        self.elapsed = now - self.startTime
+        self.running = [(t.command.getCommand(), t.getBytesDone())
+                        for t in running]
+
+    def getThroughput(self):
+        """
+        Returns bytes per second so far.
+
+        """
+        return self.done / self.elapsed if self.elapsed else 0
+
+    def getEta(self):
+        """
+        Returns estimated seconds to finish, None if unknown yet.
+
+        """
+        throughput = self.getThroughput()
+        if not throughput:
+            return None
+        return (self.total - self.done) / throughput
+
+    def getStatus(self):
+        eta = self.getEta()
+        return {"bytesDone": self.done,
+                "bytesTotal": self.total,
+                "percent": round(100.0 * self.done / (self.total or 1), 1),
+                "elapsed": int(self.elapsed),
+                "throughputMBps": round(self.getThroughput() / 1048576, 2),
+                "eta": None if eta is None else int(eta),
+                "running": [{"command": comm, "bytesDone": done}
+                            for comm, done in self.running]}
+
+    def __str__(self):
+        eta = self.getEta()
+        return ("%.1f%% (%.1f of %.1f MB), %.1f MB/s, ETA %s, %s running" %
+                (100.0 * self.done / (self.total or 1),
+                 self.done / 1048576.0, self.total / 1048576.0,
+                 self.getThroughput() / 1048576,
+                 "-" if eta is None else datetime.timedelta(seconds=int(eta)),
+                 len(self.running)))
+
+
+class SharedLogFile(object):
+    """
+    Log file appended to by several commands, owned (written into) by
+    a single command at a time so that outputs of commands running in
+    parallel do not interleave. Outputs spooled by the other commands
+    are queued in the order the commands finished and appended once the
+    file is not owned, nobody ever waits for the owner.
+
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.owner = None
+        self.lock = threading.Lock()
+        # spooled outputs of finished commands, in order of finishing
+        self.spools = []
+
+    def acquire(self, owner):
+        """
+        Make owner the owner of the file, returns False if the file is
+        owned by somebody else.
+
+        """
+        self.lock.acquire()
+        try:
+            if self.owner not in (None, owner):
+                return False
+            self.owner = owner
+            return True
+        finally:
+            self.lock.release()
+
+    def release(self, owner):
+        self.lock.acquire()
+        try:
+            if self.owner is not owner:
+                return
+            self.owner = None
+        finally:
+            self.lock.release()
+        self._appendSpools()
+
+    def append(self, spool):
+        """
+        Queue spool (file positioned at the beginning, closed once
+        appended) to be appended to the file, it is appended right away
+        if the file is not owned.
+
+        """
+        self.lock.acquire()
+        try:
+            self.spools.append(spool)
+        finally:
+            self.lock.release()
+        self._appendSpools()
+
+    def _appendSpools(self):
+        while True:
+            self.lock.acquire()
+            try:
+                if self.owner is not None or not self.spools:
+                    return
+                spool = self.spools.pop(0)
+                # owned while appended, outside of the lock
+                self.owner = spool
+            finally:
+                self.lock.release()
+            try:
+                f = open(self.fileName, "a")
+                try:
+                    shutil.copyfileobj(spool, f, CommandOutput.chunkSize)
+                finally:
+                    f.close()
+                    spool.close()
+            finally:
+                self.lock.acquire()
+                self.owner = None
+                self.lock.release()
+
+
+class CommandOutput(object):
+    """
+    File-like sink of a command output (stdout or stderr). Output is
+    passed on in chunks of complete lines (of at most about chunkSize
+    bytes), either appended into the shared log file or into the logger,
+    so memory use does not depend on the output size. Lines are counted
+    as they come, the count is logged periodically for long running
+    commands.
+    Output is streamed straight into the log file if the command gets
+    hold of it first, otherwise (another command running in parallel
+    writes into it) it is spooled into a temporary file of its own which
+    is handed over to the log file once the command finished.
+
+    """
+
+    chunkSize = 64 * 1024
+    # seconds between line count reports
+    reportInterval = 60
+
+    def __init__(self, name, logger, sharedLog=None, prefix=""):
+        self.name = name
+        self.logger = logger
+        self.sharedLog = sharedLog
+        self.prefix = prefix
+        self.f = None
+        self.spool = None
+        # incomplete last line
+        self.pending = ""
+        self.lines = 0
+        self.lastReport = time.time()
+
+    def write(self, data):
+        self.lines += data.count("\n")
+        data = "".join([self.pending, data])
+        end = data.rfind("\n") + 1
+        if not end:
+            if len(data) < self.chunkSize:
+                self.pending = data
+                return
+            end = len(data)
+        self.pending = data[end:]
+        self._store(data[:end])
+        if time.time() - self.lastReport > self.reportInterval:
+            self.lastReport = time.time()
+            self.logger.info("%s: %s lines so far ..." %
+                             (self.name, self.lines))
+
+    def _store(self, data):
+        if not self.sharedLog:
+            if data:
+                self.logger.debug("%s:\n%s" % (self.name,
+                                                data.rstrip("\n")))
+        elif not self.spool and self.sharedLog.acquire(self):
+            if not self.f:
+                # append from all
+                self.f = open(self.sharedLog.fileName, "a")
+                self.f.write(self.prefix)
+            self.f.write(data)
+            self.f.flush()
+        else:
+            if not self.spool:
+                self.spool = tempfile.TemporaryFile("w+")
+                self.spool.write(self.prefix)
+            self.spool.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Never waits for another command owning the shared log file.
+
+        """
+        # the log file gets the prefix even if there was no output
+        self._store(self.pending)
+        self.pending = ""
+        if self.f:
+            self.f.close()
+            self.f = None
+            self.sharedLog.release(self)
+        elif self.spool:
+            self.spool.seek(0)
+            self.sharedLog.append(self.spool)
+            self.spool = None
+
+
+class Planner(object):
+    """
+    Pre-flight estimation of the backup. Source directories of the
+    commands are walked in parallel (excludes honoured) to estimate
+    bytes and files of each archive, commands are reordered largest
+    archive first (so that a huge archive does not start last and
+    stretch the whole run) and the duration of the backup on the given
+    number of workers is estimated. Chains of dependent commands (tar,
+    gzip, gzip -t) are kept together, their order is not changed.
+
+    """
+
+    def __init__(self, logger, threads=8, rate=PLAN_RATE,
+                 fileCost=PLAN_FILE_COST):
+        self.logger = logger
+        # number of directories walked at the same time
+        self.threads = threads
+        # assumed archiving speed, bytes per second and seconds per file
+        self.rate = rate
+        self.fileCost = fileCost
+        # description of the plan, filled by plan()
+        self.report = []
+        # estimated duration of the backup in seconds, filled by plan()
+        self.duration = 0
+
+    def _getRoot(self, c):
+        while c.getDependencies():
+            c = c.getDependencies()[0]
+        return c
+
+    def _getDuration(self, c):
+        size, files = c.getEstimate() or (0, 0)
+        return size / float(self.rate) + files * self.fileCost
+
+    def estimate(self, commands):
+        """
+        Set estimated (bytes, files) of the source directory of each
+        command which has one.
+
+        """
+        sources = Queue.Queue()
+        for c in commands:
+            if c.getSrcDir():
+                sources.put(c)
+
+        def worker():
+            while True:
+                try:
+                    c = sources.get_nowait()
+                except Queue.Empty:
+                    break
+                size, files = 0, 0
+                try:
+                    for path, name, st in c.walk(self.logger):
+                        if stat.S_ISREG(st.st_mode):
+                            size += st.st_size
+                            files += 1
+                except OSError, ex:
+                    self.logger.warning("Cannot estimate size of '%s', "
+                                        "reason: %s" % (c.getSrcDir(), ex))
+                c.setEstimate((size, files))
+
+        threads = []
+        for i in range(min(self.threads, sources.qsize())):
+            t = threading.Thread(target=worker, name="planner-%s" % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+    def plan(self, commands, workers=1):
+        """
+        Estimate the commands, returns them reordered largest archive
+        first. The plan is described in self.report.
+
+        """
+        self.estimate(commands)
+        chains = []
+        byRoot = {}
+        for c in commands:
+            root = self._getRoot(c)
+            if root not in byRoot:
+                byRoot[root] = []
+                chains.append((root, byRoot[root]))
+            byRoot[root].append(c)
+        # sort is stable, equal archives keep the configuration order
+        chains.sort(key=lambda chain: self._getDuration(chain[0]),
+                    reverse=True)
+
+        # chains are taken in order by the first free worker
+        free = [0] * workers
+        self.report = []
+        for root, chain in chains:
+            size, files = root.getEstimate() or (0, 0)
+            duration = self._getDuration(root)
+            start = heapq.heappop(free)
+            heapq.heappush(free, start + duration)
+            self.report.append("%10.1f MB %9s files %10s  %s" %
+                               (size / 1048576.0, files,
+                                datetime.timedelta(seconds=int(duration)),
+                                root.getCommand()))
+        self.duration = max(free)
+        finish = (datetime.datetime.now() +
+                  datetime.timedelta(seconds=self.duration))
+        self.report.append("Estimated duration %s on %s worker(s), "
+                           "finish at %s" %
+                           (datetime.timedelta(seconds=int(self.duration)),
+                            workers, finish.strftime("%Y-%m-%d %H:%M:%S")))
+        return [c for root, chain in chains for c in chain]
+
+
+class XMLInputProcessor(object):
+    """
+    Converts XML input configuration file into list of commands,
+    i.e. list of Command class.
+
+    """
+
+    def __init__(self, fileName, destDir, logger, options=None):
+        self.logger = logger
+        # XML config file to parse
+        self.fileName = fileName
+        # destination directory
+        self.destDirFullPath = destDir
+        # optional command line settings (see getOptions())
+        self.options = options or {}
+        # limit shared by all commands, unless <commonDirs> sets its own
+        self.bwLimit = None
+        if self.options.get("bwlimit"):
+            self.bwLimit = BandwidthLimit(self.options["bwlimit"])
+    
+    def getFilters(self, dir):
+        """
+        Returns DirFilters of the <dir> element or None if it has none:
+            excludeCaches="yes" - skip content of directories tagged by
+                                  CACHEDIR.TAG
+            ignore - comma separated gitignore-style rules
+            maxFileSize - e.g. 500M, larger files are skipped (built-in
+                          actions only)
+            skipExtensions - comma separated extensions of files to skip
+
+        """
+        excludeCaches = dir.get("excludeCaches", "no").strip().lower()
+        ignore = dir.get("ignore", None)
+        maxFileSize = dir.get("maxFileSize", None)
+        skipExtensions = dir.get("skipExtensions", None)
+        if not (excludeCaches in ("yes", "true", "1") or ignore or
+                maxFileSize or skipExtensions):
+            return None
+        split = lambda value: [i.strip() for i in (value or "").split(",")
+                               if i.strip()]
+        return DirFilters(excludeCaches=excludeCaches in ("yes", "true",
+                                                          "1"),
+                          ignore=split(ignore),
+                          maxFileSize=(maxFileSize and
+                                       parseSize(maxFileSize)),
+                          skipExtensions=split(skipExtensions))
+
+    def getCommands(self, changeTo, dest, dir):
+        """
+        According to input arguments creates a list of Commands
+        (class Command) for each predefined command (actions field).
+        dir is dictionary representing <dir> XML element
+        keys: archiveName - name of the archive
+              srcDir - source directory for the archive
+              actions - comma separated list of predefined commands
+              exclude - comma separated list of directories to exclude
+                        (argument to --exclude tar option).
+              excludeCaches, ignore, maxFileSize, skipExtensions -
+                        filters (see getFilters())
+        actions.split(',')[0] - is expected to be tar command
+                          [1] - gzip (create archive) command (optional)
+                                or BUILTIN_GZIP
+                          [2] - gzip (test archive) command (optional)
+        actions may alternatively be a single built-in action (see
+        BUILTIN_ACTIONS) which does all the steps in-process.
+
+        """
+        commands = None
+        srcDir = dir.get("srcDir", None)
+        archiveName = dir.get("archiveName", None)
+        actions = dir.get("actions", None)
+        exclude = dir.get("exclude", None)
+
+        if not srcDir and not actions:
+            return commands
+        filters = self.getFilters(dir)
+        if (filters and filters.maxFileSize is not None and
+                actions.strip() not in BUILTIN_ACTIONS):
+            self.logger.error("Configuration error: <dir srcDir='%s' "
+                              "archiveName='%s'> - maxFileSize is supported "
+                              "only by built-in actions, directory not "
+                              "backed up." % (srcDir,
+                                              archiveName or srcDir))
+            return commands
+        
+        # continue
+        commands = [] # list of commands - result
+
+        if not archiveName:
+            archiveName = srcDir
+        
+        tarArchiveFullPath = os.path.join(self.destDirFullPath, dest,
+                                         "".join([archiveName, ".tar"]))
+        # archived members are listed for the catalog (see Catalog)
+        memberList = os.path.join(self.destDirFullPath, CATALOG_DIR, dest,
+                                  "".join([archiveName, ".members"]))
+
+        if actions.strip() in BUILTIN_ACTIONS:
+            if actions.strip() == "builtin-auto":
+                c = AutoArchiveCommand(changeTo)
+                c.setThroughputTarget(self.options.get("codecTarget", 10))
+                # extension is given by the compression chosen at run time
+                c.setArchive(tarArchiveFullPath)
+            elif actions.strip() == "builtin-dedup":
+                c = DedupArchiveCommand(changeTo)
+                # chunks are shared by all backups in the directory
+                c.setStore(os.path.join(
+                    os.path.dirname(self.destDirFullPath), "chunks"))
+                c.setArchive("".join([tarArchiveFullPath, ".recipe"]))
+            elif actions.strip() == "builtin-seekable":
+                c = SeekableArchiveCommand(changeTo)
+                c.setArchive("".join([tarArchiveFullPath, ".gz"]))
+            else:
+                c = ArchiveCommand(changeTo)
+                c.setArchive("".join([tarArchiveFullPath, ".gz"]))
+            c.setThreads(self.options.get("compressThreads", 1))
+            c.setDigestNames(self.options.get("digests", ["md5"]))
+            c.setMirrors(self.destDirFullPath,
+                         self.options.get("mirrors", []),
+                         self.options.get("verifyMirrors", True))
+            c.setDropCache(self.options.get("dropCache", False))
+            c.setOrder(self.options.get("order", "directory"))
+            if self.options.get("incremental") is not None:
+                # manifests are kept in the directory of all backups
+                manifest = os.path.join(
+                    os.path.dirname(self.destDirFullPath), "manifests",
+                    dest, "".join([archiveName, ".manifest.gz"]))
+                c.setIncremental(manifest, self.options["incremental"])
+            c.setSrcDir(srcDir)
+            if exclude:
+                c.setExcludes([i.strip() for i in exclude.split(',')])
+            c.setMemberList(memberList)
+            c.setFilters(filters)
+            c.setCommand("%s %s %s" % (actions.strip(), c.getArchive(),
+                                       srcDir))
+            c.setStdOutLogFile(os.path.join(self.destDirFullPath,
+                               "archive-filelist.log"))
+            c.setLogPrefix("".join(["\n", 78 * '=', "\n", c.getCommand(),
+                           "\n", 78 * '=', "\n"]))
+            commands.append(c)
+            return commands
+
+        if self.options.get("incremental") is not None:
+            self.logger.warning("Incremental backup is supported only by "
+                                "built-in actions, '%s' archived in full." %
+                                archiveName)
+
+        ac = actions.split(',') # predefined comma separated commands
+        # each command of the archive depends on the previous one, the
+        # chains of different archives are independent of each other
+        if len(ac) >= 1:
+            # only tar command in the action attribute ...
+            c = Command(changeTo)
+            if exclude:
+                e = exclude.split(',')
+                ex = "".join(["--exclude %s " % i.strip() for i in e])
+            else:
+                ex = ""
+            if filters:
+                ex += "".join(["%s " % o for o in
+                               filters.getTarOptions(self.logger)])
+            d = {"archive": tarArchiveFullPath,
+                 "dir": srcDir,
+                 "exclude": ex}
+            command = ac[0].strip() % d
+            c.setCommand(command)
+            c.setOutputFile(tarArchiveFullPath)
+            c.setSrcDir(srcDir)
+            if exclude:
+                c.setExcludes([i.strip() for i in exclude.split(',')])
+            c.setFilters(filters)
+            if len(ac) == 3:
+                c.setMemberList(memberList,
+                                "".join([tarArchiveFullPath, ".gz"]))
+            else:
+                c.setMemberList(memberList)
+            c.setStdOutLogFile(os.path.join(self.destDirFullPath,
+                               "archive-filelist.log"))
+            c.setLogPrefix("".join(["\n", 78 * '=', "\n", command,
+                           "\n", 78 * '=', "\n"]))
+            commands.append(c)
+        if len(ac) == 3:
+            # gzip command 
+            if ac[1].strip() == BUILTIN_GZIP:
+                c = CompressCommand(changeTo)
+                c.setThreads(self.options.get("compressThreads", 1))
+                c.setDigestNames(self.options.get("digests", ["md5"]))
+                c.setMirrors(self.destDirFullPath,
+                             self.options.get("mirrors", []),
+                             self.options.get("verifyMirrors", True))
+                c.setSource(tarArchiveFullPath)
+                c.setArchive("".join([tarArchiveFullPath, ".gz"]))
+                c.setCommand("%s %s" % (BUILTIN_GZIP, tarArchiveFullPath))
+            else:
+                c = Command(changeTo)
+                d = {"archive": tarArchiveFullPath}
+                c.setCommand(ac[1].strip() % d)
+                c.setOutputFile("".join([tarArchiveFullPath, ".gz"]))
+            c.addDependency(commands[-1])
+            commands.append(c)
+            
+            # gzip integrity test command
+            c = Command(changeTo)
+            d = {"zipArchive": "".join([tarArchiveFullPath, ".gz"])}
+            c.setCommand(ac[2].strip() % d)
+            c.addDependency(commands[-1])
+            commands.append(c)
+
+        return commands
+
+    def process(self, createDirs=True):
+        """
+        Process XML configuration input and return corresponding
+        backup commands for execution. Destination directories of the
+        archives are created unless createDirs is False (dry run).
+
+        """
+        r = [] # result - list of commands
+        self.logger.info("Parsing '%s' file." % self.fileName)
+        feed = lxml.objectify.parse(self.fileName)
+        root = feed.getroot()
+        commonsList = root.getchildren()
+        self.logger.debug("%d 'commonDirs' sections found." %
+                          len(commonsList))
+
+        for common in commonsList: # iterate over <commonDirs>
+            dest = common.get("destination", None)
+            changeTo = common.get("changeTo", None)
+            bwLimit = self.bwLimit
+            if common.get("bwlimit", None):
+                bwLimit = BandwidthLimit(common.get("bwlimit"))
+            # test for None necessary
+            if dest and changeTo:
+                #print "   ", changeTo, "  ", dest
+                self.logger.debug("%d 'dirs' sections found." %
+                                  common.countchildren())
+                for dir in common.getchildren(): # iterate over <dir>
+                    currCommands = self.getCommands(changeTo, dest, dir)
+                    if currCommands:
+                        for c in currCommands:
+                            c.setBwLimit(bwLimit)
+                        r.extend(currCommands) # will keep order
+                    (name, actions, exclude) = (None, None, None)
+
+                # if the destination directory does not exist, create it
+                # (in the mirror backup directories as well)
+                for d in ([self.destDirFullPath] +
+                          self.options.get("mirrors", [])):
+                    destCheck = os.path.join(d, dest)
+                    if createDirs and not os.path.exists(destCheck):
+                        self.logger.info("Creating directory '%s'" %
+                                         destCheck)
+                        os.mkdir(destCheck)
+                membersDir = os.path.join(self.destDirFullPath, CATALOG_DIR,
+                                          dest)
+                if createDirs and not os.path.exists(membersDir):
+                    os.makedirs(membersDir)
+            (dest, changeTo) = (None, None)
+        
+        return r
+
+
+class Command(object):
+
+    def __init__(self, changeToDir):
+        # directory into which to change before execution
+        self.changeToDir = changeToDir
+        # the command itself
+        self.command = None
+        # file name to put stdoutput of successful running
+        self.stdOutLogFile = None
+        # stdOutLogFile is open for appending, this is prefix of
+        # consecutive additions
+        self.logPrefix = ""
+        # commands which have to finish successfully before this one
+        # is started (e.g. gzip of an archive depends on its tar)
+        self.dependencies = []
+        # resource usage of the finished command (see Executor)
+        self.stats = None
+        # file the command creates (for resuming interrupted backups)
+        self.outputFile = None
+        # source directory of the archive the command creates (relative
+        # to changeToDir) and tar --exclude like patterns applied to it
+        self.srcDir = None
+        self.excludes = []
+        # estimated (bytes, files) of the source directory (see Planner)
+        self.estimate = None
+        # BandwidthLimit the command's reading is subject to (if any) and
+        # seconds the command has been waiting for it
+        self.bwLimit = None
+        self.throttledTime = 0
+        # file to list archived members into for the Catalog and the
+        # archive they end up in (the output file if None)
+        self.memberList = None
+        self.catalogArchive = None
+        # DirFilters applied while walking the source directory and
+        # (entries, bytes of files) skipped by each filter (or exclude),
+        # filter name -> list
+        self.filters = None
+        self.skipped = {}
+
+    def setCommand(self, command):
+        self.command = command
+
+    def setStdOutLogFile(self, stdOutLogFile):
+        self.stdOutLogFile = stdOutLogFile
+
+    def setLogPrefix(self, logPrefix):
+        self.logPrefix = logPrefix
+
+    def addDependency(self, command):
+        self.dependencies.append(command)
+
+    def setStats(self, stats):
+        self.stats = stats
+
+    def setOutputFile(self, outputFile):
+        self.outputFile = outputFile
+
+    def setSrcDir(self, srcDir):
+        self.srcDir = srcDir
+
+    def setExcludes(self, excludes):
+        self.excludes = excludes
+
+    def setEstimate(self, estimate):
+        self.estimate = estimate
+
+    def setBwLimit(self, bwLimit):
+        self.bwLimit = bwLimit
+
+    def setFilters(self, filters):
+        self.filters = filters
+
+    def setMemberList(self, memberList, catalogArchive=None):
+        self.memberList = memberList
+        self.catalogArchive = catalogArchive
+    
+    def getChangeToDir(self):
+        return self.changeToDir
+
+    def getCommand(self):
+        return self.command
+    
+    def getStdOutLogFile(self):
+        return self.stdOutLogFile
+
+    def getLogPrefix(self):
+        return self.logPrefix
+
+    def getDependencies(self):
+        return self.dependencies
+
+    def getStats(self):
+        return self.stats
+
+    def getOutputFile(self):
+        return self.outputFile
+
+    def getSrcDir(self):
+        return self.srcDir
+
+    def getExcludes(self):
+        return self.excludes
+
+    def getEstimate(self):
+        return self.estimate
+
+    def getBwLimit(self):
+        return self.bwLimit
+
+    def getMemberList(self):
+        return self.memberList
+
+    def getFilters(self):
+        return self.filters
+
+    def getSkipped(self):
+        return self.skipped
+
+    def _skip(self, rule, path, st=None):
+        """
+        Count the entry skipped by the rule, a skipped directory is
+        a single entry (its content is never walked).
+
+        """
+        try:
+            st = st or os.lstat(path)
+        except OSError:
+            return
+        counts = self.skipped.setdefault(rule, [0, 0])
+        counts[0] += 1
+        if stat.S_ISREG(st.st_mode):
+            counts[1] += st.st_size
+
+    def getCatalogArchive(self):
+        return self.catalogArchive or self.getOutputFile()
+
+    def isExcluded(self, name):
+        """
+        Unanchored matching like tar --exclude does: pattern is matched
+        against the whole member name and against any of its trailing
+        sequence of path components.
+
+        """
+        parts = name.split("/")
+        for pattern in self.excludes:
+            for i in range(len(parts)):
+                if fnmatch.fnmatch("/".join(parts[i:]), pattern):
+                    return True
+        return False
+
+    def walk(self, logger):
+        """
+        Generates (full path, member name, lstat result) of the source
+        directory in the order as tar stores them (directory precedes its
+        content), excluded entries and entries skipped by the filters are
+        pruned and never descended into (see self.skipped).
+        Entries which can't be stat-ed (vanished) are skipped.
+
+        """
+        top = os.path.join(self.changeToDir, self.srcDir)
+        # tar strips leading / from member names
+        topName = os.path.normpath(self.srcDir).lstrip("/")
+        if self.isExcluded(topName):
+            return
+        st = os.lstat(top)
+        yield top, topName, st
+        if not stat.S_ISDIR(st.st_mode):
+            return
+        dirs = [(top, topName)]
+        while dirs:
+            path, name = dirs.pop()
+            try:
+                entries = sorted(os.listdir(path))
+            except OSError, ex:
+                logger.warning("Cannot read directory '%s', reason: %s" %
+                               (path, ex))
+                continue
+            if (self.filters and self.filters.excludeCaches and
+                    self.filters.isCacheDir(path, entries)):
+                # only the tag is kept
+                for entry in entries:
+                    if entry != DirFilters.cacheTag:
+                        self._skip("excludeCaches",
+                                   os.path.join(path, entry))
+                entries = [DirFilters.cacheTag]
+            subDirs = []
+            for entry in entries:
+                entryPath = os.path.join(path, entry)
+                entryName = "/".join([name, entry])
+                if self.isExcluded(entryName):
+                    self._skip("exclude", entryPath)
+                    continue
+                try:
+                    st = os.lstat(entryPath)
+                except OSError, ex:
+                    # vanished in the meantime, tar just warns as well
+                    logger.warning("Cannot stat '%s', reason: %s" %
+                                   (entryPath, ex))
+                    continue
+                if self.filters:
+                    # rules are relative to the source directory
+                    rule = self.filters.getRule(
+                        entryName[len(topName) + 1:], st)
+                    if rule:
+                        self._skip(rule, entryPath, st)
+                        continue
+                yield entryPath, entryName, st
+                if stat.S_ISDIR(st.st_mode):
+                    subDirs.append((entryPath, entryName))
+            # depth first, keep the sorted order
+            subDirs.reverse()
+            dirs.extend(subDirs)
+
+
+class DirFilters(object):
+    """
+    Per <dir> filters applied while walking the source directory, so
+    that nothing skipped is ever read:
+        excludeCaches - content of directories tagged by CACHEDIR.TAG
+                        (as tar --exclude-caches, the tag is kept)
+        ignore - gitignore-style rules relative to the source directory
+                 (*, ?, [...], **, leading / anchors, trailing / matches
+                 directories only, ! re-includes)
+        maxFileSize - bytes, larger files are skipped
+        skipExtensions - files with these extensions are skipped
+
+    """
+
+    cacheTag = "CACHEDIR.TAG"
+    cacheSignature = "Signature: 8a477f597d28d172789f06886806bc55"
+
+    def __init__(self, excludeCaches=False, ignore=None, maxFileSize=None,
+                 skipExtensions=None):
+        self.excludeCaches = excludeCaches
+        self.ignore = ignore or []
+        self.maxFileSize = maxFileSize
+        self.skipExtensions = set([e.lower().lstrip(".") for e in
+                                   skipExtensions or []])
+        # (compiled regular expression, negated, directories only)
+        self.rules = [self._compileRule(r) for r in self.ignore]
+
+    def _compileRule(self, rule):
+        negated = rule.startswith("!")
+        rule = rule.lstrip("!")
+        dirOnly = rule.endswith("/")
+        rule = rule.rstrip("/")
+        # pattern with a slash is relative to the top, otherwise it
+        # matches at any level
+        anchored = "/" in rule
+        rule = rule.lstrip("/")
+        regex = []
+        i = 0
+        while i < len(rule):
+            if rule.startswith("**/", i):
+                regex.append("(?:.*/)?")
+                i += 3
+            elif rule.startswith("**", i):
+                regex.append(".*")
+                i += 2
+            elif rule[i] == "*":
+                regex.append("[^/]*")
+                i += 1
+            elif rule[i] == "?":
+                regex.append("[^/]")
+                i += 1
+            elif rule[i] == "[" and "]" in rule[i + 1:]:
+                end = rule.index("]", i + 1)
+                regex.append(rule[i:end + 1].replace("[!", "[^"))
+                i = end + 1
+            else:
+                regex.append(re.escape(rule[i]))
+                i += 1
+        prefix = "" if anchored else "(?:.*/)?"
+        return (re.compile("".join(["^", prefix] + regex + ["$"])),
+                negated, dirOnly)
+
+    def isCacheDir(self, path, entries):
+        if self.cacheTag not in entries:
+            return False
+        try:
+            f = open(os.path.join(path, self.cacheTag), "rb")
+            try:
+                return f.read(len(self.cacheSignature)) == \
+                    self.cacheSignature
+            finally:
+                f.close()
+        except IOError:
+            return False
+
+    def getRule(self, name, st):
+        """
+        Returns the filter (name) skipping the entry - name relative to
+        the source directory, st its lstat result - or None.
+
+        """
+        isDir = stat.S_ISDIR(st.st_mode)
+        ignored = False
+        # the last matching rule decides
+        for regex, negated, dirOnly in self.rules:
+            if dirOnly and not isDir:
+                continue
+            if regex.match(name):
+                ignored = not negated
+        if ignored:
+            return "ignore"
+        if stat.S_ISREG(st.st_mode):
+            if self.maxFileSize is not None and \
+                    st.st_size > self.maxFileSize:
+                return "maxFileSize"
+            extension = os.path.splitext(name)[1][1:].lower()
+            if extension and extension in self.skipExtensions:
+                return "skipExtensions"
+        return None
+
+    def getTarOptions(self, logger):
+        """
+        Returns tar options doing (as much as tar can of) the filtering
+        for the shell actions. Raises ValueError for maxFileSize, which
+        tar can't do (rejected by XMLInputProcessor.getCommands()).
+
+        """
+        if self.maxFileSize is not None:
+            raise ValueError("maxFileSize is supported only by built-in "
+                             "actions")
+        options = []
+        if self.excludeCaches:
+            options.append("--exclude-caches")
+        for rule in self.ignore:
+            if rule.startswith("!") or "/" in rule.rstrip("/"):
+                logger.warning("Ignore rule '%s' not supported by the tar "
+                               "command, ignored." % rule)
+                continue
+            options.append("--exclude %s" % rule.rstrip("/"))
+        for extension in sorted(self.skipExtensions):
+            options.append("--exclude *.%s" % extension)
+        return options
+
+
+def parseSize(size):
+    """
+    Returns bytes of size given as number with optional K, M, G, T
+    suffix (powers of 1024), raises ValueError.
+
+    """
+    size = size.strip().upper()
+    units = "KMGT"
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1]) + 1))
+    return int(size)
+
+
+class BuiltinCommand(Command):
+    """
+    Command run in-process by the Executor (by calling its run() method)
+    instead of an external program. Builtin commands produce a gzip
+    compressed archive.
+
+    """
+
+    # bytes of data processed between steps (see steps())
+    stepSize = 1024 * 1024
+
+    def __init__(self, changeToDir):
+        Command.__init__(self, changeToDir)
+        # full path of the resulting archive
+        self.archive = None
+        # gzip compression level
+        self.level = 6
+        # number of compression threads
+        self.threads = 1
+        # hashlib algorithms of archive digests computed while writing
+        self.digestNames = ["md5"]
+        # hex digests of the written archive, algorithm name -> digest
+        self.digests = {}
+        # bytes of source data read and of archive written
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        # backup directory and its mirrors the archive is written into
+        # at the same time (see FanOutWriter)
+        self.dstDir = None
+        self.mirrors = []
+        # copies are read back and verified once written
+        self.verifyMirrors = True
+
+    def setArchive(self, archive):
+        self.archive = archive
+
+    def setMirrors(self, dstDir, mirrors, verify=True):
+        self.dstDir = dstDir
+        self.mirrors = mirrors
+        self.verifyMirrors = verify
+
+    def setThreads(self, threads):
+        self.threads = threads
+
+    def setDigestNames(self, digestNames):
+        self.digestNames = digestNames
+
+    def setDigests(self, digests):
+        self.digests = digests
+
+    def getArchive(self):
+        return self.archive
+
+    def getDigests(self):
+        return self.digests
+
+    def getOutputFile(self):
+        return self.archive
+
+    def getMirrorFiles(self, fileName):
+        """
+        Returns paths of the copies of fileName (in the backup
+        directory) in the mirror backup directories.
+
+        """
+        if not self.mirrors:
+            return []
+        name = os.path.relpath(fileName, self.dstDir)
+        return [os.path.join(m, name) for m in self.mirrors]
+
+    def openArchive(self):
+        """
+        Returns DigestWriter writing into newly created archive file
+        (and its copies in the mirror backup directories, if any).
+
+        """
+        if self.mirrors:
+            fileNames = [self.archive] + self.getMirrorFiles(self.archive)
+            return DigestWriter(FanOutWriter(fileNames,
+                                             verify=self.verifyMirrors),
+                                self.digestNames)
+        return DigestWriter(open(self.archive, "wb"), self.digestNames)
+
+    def steps(self, stdOut, logger):
+        """
+        Generator running the command in steps of about stepSize bytes,
+        other work is done in between the steps (see EventExecutor).
+        Yields seconds to wait before the next step (bandwidth limit,
+        see ThrottledWriter), 0 if none.
+
+        """
+        raise NotImplementedError
+
+    def removeArchive(self):
+        """
+        Remove (incomplete) archive and its copies.
+
+        """
+        for fileName in [self.archive] + self.getMirrorFiles(self.archive):
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+    def getCompressor(self, fileobj):
+        """
+        Returns file-like object compressing into (open) fileobj.
+
+        """
+        if self.threads > 1:
+            return ParallelGzipWriter(fileobj, level=self.level,
+                                      threads=self.threads)
+        return GzipWriter(fileobj, level=self.level)
+
+    def run(self, stdOut, logger):
+        for wait in self.steps(stdOut, logger):
+            if wait:
+                time.sleep(wait)
+
+
+class CompressCommand(BuiltinCommand):
+    """
+    Built-in replacement of gzip command, compresses source file into
+    the archive (verified on the fly) and removes the source file.
+
+    """
+
+    def __init__(self, changeToDir):
+        BuiltinCommand.__init__(self, changeToDir)
+        # file to compress
+        self.source = None
+
+    def setSource(self, source):
+        self.source = source
+
+    def steps(self, stdOut, logger):
+        src = open(self.source, "rb")
+        try:
+            out = self.openArchive()
+            gz = None
+            try:
+                try:
+                    gz = self.getCompressor(out)
+                    stream = ThrottledWriter(gz, self.bwLimit)
+                    while True:
+                        data = src.read(self.stepSize)
+                        if not data:
+                            break
+                        stream.write(data)
+                        yield stream.takeWait()
+                    gz.close()
+                    self.throttledTime = stream.throttledTime
+                finally:
+                    out.close()
+            except:
+                if gz is not None:
+                    gz.abort()
+                self.removeArchive()
+                raise
+        finally:
+            src.close()
+        self.bytesRead = os.path.getsize(self.source)
+        self.bytesWritten = out.size
+        self.digests = out.hexdigests()
+        os.remove(self.source)
+
+
+class ArchiveCommand(BuiltinCommand):
+    """
+    Built-in archive command. Walks the source directory and writes tar
+    members straight into a gzip compressed stream in a single pass,
+    every compressed block is verified as it is written (replaces the
+    tar, gzip, gzip -t sequence of shell commands).
+    Tar is run in changeToDir and so is this command - member names are
+    relative to it (srcDir).
+
+    """
+
+    def __init__(self, changeToDir):
+        BuiltinCommand.__init__(self, changeToDir)
+        # incremental mode - manifest of the previous backup of this
+        # archive (updated on success) and maximum number of incremental
+        # archives between full archives, None means always full archive
+        self.manifestFile = None
+        self.maxIncrementals = None
+        # manifest of the previous backup (incremental archive) and
+        # manifest being built by the current run
+        self.previous = None
+        self.manifest = None
+        # names of files which could not be read (not deleted)
+        self.unreadable = set()
+        # open member list (see Command.setMemberList()) while running
+        self.memberListOut = None
+        # read source files with page cache hints and drop them from
+        # the page cache once archived (see SourceReader)
+        self.dropCache = False
+        # order of archived files (ARCHIVE_ORDERS): as found in the
+        # directories, or sorted by inode number or by physical location
+        # of the first extent (less seeking on rotational disks), sorted
+        # in batches of batchSize entries to bound memory
+        self.order = "directory"
+        self.batchSize = 10000
+        self.useExtents = False
+
+    def setIncremental(self, manifestFile, maxIncrementals):
+        self.manifestFile = manifestFile
+        self.maxIncrementals = maxIncrementals
+
+    def setDropCache(self, dropCache):
+        self.dropCache = dropCache
+
+    def setOrder(self, order):
+        self.order = order
+
+    def _getOrderKey(self, entry, logger):
+        """
+        Returns (physical offset, inode) of the entry, physical offset is
+        0 unless ordering by extents.
+
+        """
+        path, name, st = entry
+        if self.useExtents and stat.S_ISREG(st.st_mode):
+            try:
+                return getPhysicalOffset(path), st.st_ino
+            except IOError, ex:
+                if ex.errno in (errno.ENOTTY, errno.EOPNOTSUPP):
+                    logger.warning("FIEMAP not supported (%s), archiving "
+                                   "'%s' in inode order." % (ex, self.srcDir))
+                    self.useExtents = False
+                # otherwise vanished or not readable, archiving reports it
+        return 0, st.st_ino
+
+    def walkOrdered(self, logger):
+        """
+        Generates entries as walk() does, in batches sorted according to
+        self.order. Directories of a batch precede the other entries of
+        the batch (in the walk() order), so every directory still
+        precedes its content.
+
+        """
+        if self.order == "directory":
+            for entry in self.walk(logger):
+                yield entry
+            return
+        # FIEMAP may not be supported by the file system, inode order then
+        self.useExtents = self.order == "extent"
+        entries = self.walk(logger)
+        while True:
+            dirs, others = [], []
+            for entry in entries:
+                if stat.S_ISDIR(entry[2].st_mode):
+                    dirs.append(entry)
+                else:
+                    others.append((self._getOrderKey(entry, logger), entry))
+                if len(dirs) + len(others) >= self.batchSize:
+                    break
+            if not dirs and not others:
+                break
+            for entry in dirs:
+                yield entry
+            others.sort()
+            for key, entry in others:
+                yield entry
+
+    def steps(self, stdOut, logger):
+        """
+        Create the archive, names of the archived members are written
+        into stdOut (as tar -v does), a step per member and per stepSize
+        bytes of large members. Raises exception on failure, the
+        incomplete archive is removed.
+        In incremental mode only entries new or changed since the previous
+        backup are archived (directories always are), names of deleted
+        entries are stored next to the archive and the manifest is
+        updated.
+
+        """
+        if self.manifestFile:
+            self.loadManifest(logger)
+        self.skipped = {}
+        self.unreadable = set()
+        self.memberListOut = None
+        if self.memberList:
+            self.memberListOut = open(self.memberList, "wb")
+        out = self.openArchive()
+        gz = None
+        try:
+            try:
+                gz = self.getCompressor(out)
+                stream = ThrottledWriter(gz, self.bwLimit)
+                tar = tarfile.open(fileobj=stream, mode="w|",
+                                   format=tarfile.GNU_FORMAT)
+                for path, name, st in self.walkOrdered(logger):
+                    for step in self.addMember(tar, path, name, st,
+                                               stdOut, logger):
+                        yield stream.takeWait()
+                    yield stream.takeWait()
+                tar.close()
+                gz.close()
+                self.throttledTime = stream.throttledTime
+            finally:
+                out.close()
+                if self.memberListOut:
+                    self.memberListOut.close()
+        except:
+            if gz is not None:
+                gz.abort()
+            self.removeArchive()
+            raise
+        self.bytesWritten = out.size
+        self.digests = out.hexdigests()
+        if self.manifestFile:
+            self.storeManifest(logger)
+
+    def loadManifest(self, logger):
+        """
+        Decide between full and incremental archive according to the
+        manifest of the previous backup.
+
+        """
+        self.previous = None
+        level = 0
+        if os.path.exists(self.manifestFile):
+            previous = Manifest.load(self.manifestFile)
+            if previous.level < self.maxIncrementals:
+                self.previous = previous
+                level = previous.level + 1
+        self.manifest = Manifest(level)
+        if self.previous:
+            logger.info("'%s': incremental archive (level %s) against %s "
+                        "entries of the previous backup." %
+                        (self.archive, level, len(self.previous.entries)))
+        else:
+            logger.info("'%s': full archive." % self.archive)
+
+    def storeManifest(self, logger):
+        """
+        Store names of deleted entries and the new manifest, both into
+        the backup directory (next to the archive) and into the manifest
+        file which the next backup compares against.
+
+        """
+        base = self.archive.rsplit(".tar", 1)[0]
+        if self.previous:
+            deleted = sorted([n for n in self.previous.entries
+                              if n not in self.manifest.entries and
+                              n not in self.unreadable])
+            logger.info("'%s': %s entries deleted since the previous "
+                        "backup." % (self.archive, len(deleted)))
+            f = open("".join([base, "-deleted.log"]), "w")
+            for name in deleted:
+                f.write("%s\n" % name)
+            f.close()
+        self.manifest.save("".join([base, ".manifest.gz"]))
+        if not os.path.exists(os.path.dirname(self.manifestFile)):
+            os.makedirs(os.path.dirname(self.manifestFile))
+        self.manifest.save(self.manifestFile)
+
+    def addMember(self, tar, path, name, st, stdOut, logger):
+        """
+        Generator adding the entry into tar, a step per stepSize bytes.
+        The entry gets into the manifest only once archived (or if
+        archived unchanged before), an entry which could not be read is
+        then archived by the next incremental backup.
+
+        """
+        if (self.previous and not stat.S_ISDIR(st.st_mode) and
+                not self.previous.isChanged(name, st)):
+            self.manifest.add(name, st)
+            return
+        try:
+            tarInfo = tar.gettarinfo(path, arcname=name)
+        except (OSError, IOError), ex:
+            # vanished in the meantime, tar just warns as well
+            logger.warning("Cannot stat '%s', reason: %s" % (path, ex))
+            return
+        if tarInfo is None:
+            logger.warning("'%s' is a socket, ignored." % path)
+            return
+        if tarInfo.isreg():
+            try:
+                f = SourceReader(path, tarInfo.size, logger,
+                                 dropCache=self.dropCache)
+            except IOError, ex:
+                logger.warning("Cannot open '%s', reason: %s" % (path, ex))
+                self.unreadable.add(name)
+                return
+            try:
+                for step in addTarFile(tar, tarInfo, f, self.stepSize):
+                    yield step
+            finally:
+                f.close()
+            self.bytesRead += tarInfo.size
+        else:
+            tar.addfile(tarInfo)
+        stdOut.write("%s%s\n" % (name, "/" if tarInfo.isdir() else ""))
+        if self.memberListOut:
+            writeMember(self.memberListOut, tarInfo)
+        if self.manifest is not None:
+            self.manifest.add(name, st)
+
+
+class AutoArchiveCommand(ArchiveCommand):
+    """
+    Built-in archive command choosing compression of the archive by
+    sampling the source directory: among the available codecs the one
+    with the best compression ratio which compresses at least
+    throughputTarget MB/s is used (the fastest one if none is that
+    fast), no compression if the data does not compress. Files of
+    already compressed types (COMPRESSED_EXTENSIONS) of storeMinSize
+    bytes or more are written at the cheapest level of the codec (stored
+    as is by gzip and zstd).
+
+    """
+
+    # (codec, level, archive extension) candidates
+    codecs = [("gzip", 1, ".gz"), ("gzip", 6, ".gz"), ("bz2", 9, ".bz2")]
+    if lzma:
+        codecs.append(("xz", 6, ".xz"))
+    if zstandard:
+        codecs.append(("zstd", 3, ".zst"))
+    # level of already compressed files, codec -> level
+    storeLevels = {"gzip": 0, "bz2": 1, "xz": 0, "zstd": 1}
+    # level changes by a sync flush (gzip, a new member of parallel gzip)
+    # or by starting a new stream (other codecs), which costs ratio,
+    # smaller compressed files do not switch to the store level
+    storeMinSize = 1024 * 1024
+    # number of entries looked at, files sampled and bytes of the sample
+    # (split evenly among the files), each codec compresses the sample
+    sampleEntries = 10000
+    sampleFiles = 64
+    sampleSize = 1024 * 1024
+
+    def __init__(self, changeToDir):
+        ArchiveCommand.__init__(self, changeToDir)
+        # required compression speed, MB/s
+        self.throughputTarget = 10
+        # chosen codec, "none" for no compression, archive extension
+        self.codec = None
+        self.extension = None
+        self.compressor = None
+
+    def setThroughputTarget(self, throughputTarget):
+        self.throughputTarget = throughputTarget
+
+    def sample(self, logger):
+        """
+        Returns sample data of the (compressible) source files and the
+        ratio of bytes in already compressed files to all bytes, both
+        from the first sampleEntries entries of the source directory.
+
+        """
+        files = []
+        total, compressed = 0, 0
+        entries = self.walk(logger)
+        for path, name, st in itertools.islice(entries, self.sampleEntries):
+            if stat.S_ISREG(st.st_mode):
+                total += st.st_size
+                if isCompressedName(name):
+                    compressed += st.st_size
+                elif st.st_size:
+                    files.append(path)
+        data = []
+        step = max(1, len(files) / self.sampleFiles)
+        files = files[::step][:self.sampleFiles]
+        chunk = self.sampleSize / (len(files) or 1)
+        for path in files:
+            try:
+                f = open(path, "rb")
+                try:
+                    data.append(f.read(chunk))
+                finally:
+                    f.close()
+            except IOError:
+                pass # vanished, not readable - nothing to sample
+        return "".join(data), float(compressed) / (total or 1)
+
+    def chooseCodec(self, logger):
+        """
+        Generator choosing the codec (sets codec, level and extension),
+        a step per codec tried on the sample.
+
+        """
+        sample, compressedShare = self.sample(logger)
+        results = [] # (ratio, throughput MB/s, codec, level, extension)
+        if sample and compressedShare < 0.9:
+            for codec, level, extension in self.codecs:
+                start = time.time()
+                compressor = newCompressor(codec, level)
+                size = len(compressor.compress(sample) + compressor.flush())
+                duration = max(time.time() - start, 1e-6)
+                throughput = len(sample) / duration / (1024 * 1024)
+                if codec == "gzip":
+                    throughput *= self.threads
+                ratio = float(size) / len(sample)
+                logger.debug("'%s' sample: %s level %s ratio %.2f, "
+                             "%.1f MB/s" % (self.srcDir, codec, level,
+                                            ratio, throughput))
+                results.append((ratio, throughput, codec, level, extension))
+                yield 0
+        fast = [r for r in results if r[1] >= self.throughputTarget]
+        if not fast and results:
+            fast = [max(results, key=lambda r: r[1])]
+        if not fast or min(fast)[0] > 0.95:
+            self.codec, self.level, self.extension = "none", 0, ""
+        else:
+            (ratio, throughput, self.codec, self.level,
+             self.extension) = min(fast)
+        logger.info("'%s': %s compression (level %s) chosen, %.0f%% of "
+                    "data in compressed files." % (self.srcDir, self.codec,
+                                                  self.level,
+                                                  100 * compressedShare))
+
+    def steps(self, stdOut, logger):
+        base = "".join([self.archive.rsplit(".tar", 1)[0], ".tar"])
+        # archive of an interrupted run may have another extension
+        for extension in [""] + [e for c, l, e in self.codecs]:
+            if os.path.exists("".join([base, extension])):
+                os.remove("".join([base, extension]))
+        for step in self.chooseCodec(logger):
+            yield step
+        self.setArchive("".join([base, self.extension]))
+        for step in ArchiveCommand.steps(self, stdOut, logger):
+            yield step
+
+    def getCompressor(self, fileobj):
+        if self.codec == "gzip":
+            self.compressor = BuiltinCommand.getCompressor(self, fileobj)
+        elif self.codec == "none":
+            self.compressor = CodecWriter(fileobj, None, None)
+        else:
+            self.compressor = CodecWriter(fileobj, self.codec, self.level)
+        return self.compressor
+
+    def addMember(self, tar, path, name, st, stdOut, logger):
+        # tar stream is buffered, the switch applies approximately from
+        # the beginning of the member, which is good enough
+        if self.codec != "none" and stat.S_ISREG(st.st_mode):
+            if not isCompressedName(name):
+                self.compressor.setLevel(self.level)
+            elif st.st_size >= self.storeMinSize:
+                self.compressor.setLevel(self.storeLevels[self.codec])
+        for step in ArchiveCommand.addMember(self, tar, path, name, st,
+                                             stdOut, logger):
+            yield step
+
+
+def isCompressedName(name):
+    extension = os.path.splitext(name)[1][1:].lower()
+    return extension in COMPRESSED_EXTENSIONS
+
+
+def newCompressor(codec, level):
+    """
+    Returns compressor object (compress(), flush() methods) of the codec.
+
+    """
+    if codec == "gzip":
+        return zlib.compressobj(level)
+    if codec == "bz2":
+        return bz2.BZ2Compressor(level)
+    if codec == "xz":
+        return lzma.LZMACompressor(preset=level)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError("Unknown codec '%s'" % codec)
+
+
+def newDecompressor(codec):
+    if codec == "bz2":
+        return bz2.BZ2Decompressor()
+    if codec == "xz":
+        return lzma.LZMADecompressor()
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError("Unknown codec '%s'" % codec)
+
+
+class CodecWriter(object):
+    """
+    File-like object compressing into fileobj by codec at level (stored
+    as is if codec is None). setLevel() ends the compressed stream and
+    the data which follow go into a new one (concatenated streams are
+    decompressed as one by bzip2, xz, zstd). Each stream is decompressed
+    back as it is written and CRC of the result compared with CRC of the
+    input on close().
+    fileobj is not closed by close().
+
+    """
+
+    def __init__(self, fileobj, codec, level):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        # compressor and decompressor of the current stream
+        self.compressor = None
+        self.decompressor = None
+        self.crc = zlib.crc32("")
+        self.checkCrc = zlib.crc32("")
+
+    def write(self, data):
+        if self.codec:
+            if not self.compressor:
+                self.compressor = newCompressor(self.codec, self.level)
+                self.decompressor = newDecompressor(self.codec)
+            self.crc = zlib.crc32(data, self.crc)
+            data = self.compressor.compress(data)
+            self._verify(data)
+        self.fileobj.write(data)
+
+    def _verify(self, data):
+        if data:
+            self.checkCrc = zlib.crc32(self.decompressor.decompress(data),
+                                       self.checkCrc)
+
+    def _endStream(self):
+        if self.compressor:
+            data = self.compressor.flush()
+            self._verify(data)
+            self.fileobj.write(data)
+            self.compressor = self.decompressor = None
+
+    def setLevel(self, level):
+        if level != self.level:
+            self._endStream()
+            self.level = level
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._endStream()
+        if self.crc != self.checkCrc:
+            raise IOError("Verification of compressed stream failed, "
+                          "CRC mismatch.")
+        self.fileobj.flush()
+
+    def abort(self):
+        # failed, the stream is not finished
+        self.compressor = self.decompressor = None
+
+
+class SeekableArchiveCommand(ArchiveCommand):
+    """
+    Built-in archive command writing the tar stream compressed in
+    independent frames (multi-member gzip, a standard .tar.gz) and an
+    index of the archived members (frame and offset within the frame
+    of each member) next to the archive (.idx). A member or a subtree
+    is then restored (see extractMembers()) by decompressing only the
+    frames containing it.
+
+    """
+
+    def __init__(self, changeToDir):
+        ArchiveCommand.__init__(self, changeToDir)
+        # uncompressed size of a frame, the most data decompressed in
+        # vain when restoring a member
+        self.frameSize = 1024 * 1024
+        # (member name, offset in the tar stream) of archived members
+        self.members = []
+        self.compressor = None
+
+    def getIndexFile(self):
+        return "".join([self.archive, ".idx"])
+
+    def getCompressor(self, fileobj):
+        self.compressor = ParallelGzipWriter(fileobj, level=self.level,
+                                             blockSize=self.frameSize,
+                                             threads=self.threads,
+                                             frames=True)
+        return self.compressor
+
+    def steps(self, stdOut, logger):
+        self.members = []
+        for step in ArchiveCommand.steps(self, stdOut, logger):
+            yield step
+        try:
+            self.storeIndex(logger)
+        except:
+            self.removeArchive()
+            raise
+
+    def addMember(self, tar, path, name, st, stdOut, logger):
+        offset = tar.offset
+        for step in ArchiveCommand.addMember(self, tar, path, name, st,
+                                             stdOut, logger):
+            yield step
+        if tar.offset != offset:
+            self.members.append((name, offset))
+
+    def storeIndex(self, logger):
+        frames = self.compressor.frames
+        starts = [start for start, compressed in frames]
+        index = ArchiveIndex(self.frameSize)
+        for name, offset in self.members:
+            i = bisect.bisect_right(starts, offset) - 1
+            index.add(name, frames[i][1], offset - starts[i])
+        index.save(self.getIndexFile())
+        logger.info("'%s': index of %s members in %s frames stored." %
+                    (self.archive, len(self.members), len(frames)))
+
+
+class ArchiveIndex(object):
+    """
+    Index of a seekable archive, members in the order of the archive:
+    (name, offset of the frame in the archive, offset of the member
+    within the uncompressed frame). Stored gzip compressed as NUL
+    terminated records, the first one being the header.
+
+    """
+
+    header = "backupper-index 1"
+
+    def __init__(self, frameSize):
+        self.frameSize = frameSize
+        self.entries = []
+
+    def add(self, name, frameOffset, offset):
+        self.entries.append((name, frameOffset, offset))
+
+    @staticmethod
+    def load(fileName):
+        f = gzip.open(fileName, "rb")
+        try:
+            records = f.read().split("\0")
+        finally:
+            f.close()
+        header, frameSize = records[0].rsplit(" ", 1)
+        if header != ArchiveIndex.header:
+            raise Exception("'%s' is not an archive index." % fileName)
+        index = ArchiveIndex(int(frameSize))
+        # last record is empty (terminated)
+        for record in records[1:-1]:
+            frameOffset, offset, name = record.split(" ", 2)
+            index.add(name, int(frameOffset), int(offset))
+        return index
+
+    def save(self, fileName):
+        f = gzip.open(fileName, "wb")
+        try:
+            f.write("%s %s\0" % (ArchiveIndex.header, self.frameSize))
+            for name, frameOffset, offset in self.entries:
+                f.write("%s %s %s\0" % (frameOffset, offset, name))
+        finally:
+            f.close()
+
+
+class GzipFrameReader(object):
+    """
+    File-like object reading (decompressing) multi-member gzip stream
+    from the current position of fileobj, which has to be the beginning
+    of a member. Members are CRC checked as they are completed.
+
+    """
+
+    def __init__(self, fileobj, chunkSize=64 * 1024):
+        self.fileobj = fileobj
+        self.chunkSize = chunkSize
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ""
+        self.eof = False
+
+    def read(self, size):
+        chunks = [self.buffer]
+        buffered = len(self.buffer)
+        while buffered < size and not self.eof:
+            data = self.fileobj.read(self.chunkSize)
+            if not data:
+                self.eof = True
+            while data:
+                chunk = self.decompressor.decompress(data)
+                chunks.append(chunk)
+                buffered += len(chunk)
+                # the rest belongs to the next member
+                data = self.decompressor.unused_data
+                if data:
+                    self.decompressor = zlib.decompressobj(16 +
+                                                           zlib.MAX_WBITS)
+        data = "".join(chunks)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, self.chunkSize))
+            if not data:
+                raise IOError("Unexpected end of archive.")
+            size -= len(data)
+
+
+def extractMembers(archive, path, output):
+    """
+    Extract member path (and all members under it if it is a directory)
+    of a seekable archive (see SeekableArchiveCommand) into the output
+    directory. Only the frames containing the members are decompressed,
+    members following each other in the archive are read in one go.
+    Returns number of extracted members.
+
+    """
+    index = ArchiveIndex.load("".join([archive, ".idx"]))
+    path = path.strip("/")
+    # runs of consecutive members of the archive to extract
+    runs = []
+    last = None
+    for i, entry in enumerate(index.entries):
+        name = entry[0].rstrip("/")
+        if name == path or name.startswith("".join([path, "/"])):
+            if last is None or last != i - 1:
+                runs.append([])
+            runs[-1].append(entry)
+            last = i
+    if not runs:
+        raise Exception("'%s' not found in '%s'." % (path, archive))
+    if not os.path.exists(output):
+        os.makedirs(output)
+
+    directories = []
+    f = open(archive, "rb")
+    try:
+        for run in runs:
+            name, frameOffset, offset = run[0]
+            f.seek(frameOffset)
+            reader = GzipFrameReader(f)
+            reader.skip(offset)
+            tar = tarfile.open(fileobj=reader, mode="r|")
+            for name, frameOffset, offset in run:
+                member = tar.next()
+                if member is None or member.name != name.rstrip("/"):
+                    raise IOError("Archive does not match its index at "
+                                  "member '%s'." % name)
+                tar.extract(member, output)
+                if member.isdir():
+                    directories.append(member)
+    finally:
+        f.close()
+    # extracting members into directories changed their times
+    for member in reversed(directories):
+        dirPath = os.path.join(output, member.name)
+        os.utime(dirPath, (member.mtime, member.mtime))
+        os.chmod(dirPath, member.mode)
+    return sum([len(run) for run in runs])
+
+
+class DedupArchiveCommand(ArchiveCommand):
+    """
+    Built-in archive command storing the (uncompressed) tar stream into
+    the chunk store, the archive file is the recipe of the stream.
+
+    """
+
+    def __init__(self, changeToDir):
+        ArchiveCommand.__init__(self, changeToDir)
+        # root directory of the chunk store
+        self.store = None
+
+    def setStore(self, store):
+        self.store = store
+
+    def getCompressor(self, fileobj):
+        return ChunkStoreWriter(ChunkStore(self.store), fileobj,
+                                os.path.dirname(self.archive))
+
+
+class ChunkStore(object):
+    """
+    Directory of unique chunks of data (stored zlib compressed) keyed
+    by their sha256 hex digest: <root>/<first two hex digits>/<digest>
+    Writers hold a shared lock of the store, garbage collection an
+    exclusive one (flock of <root>/.lock).
+
+    """
+
+    lockName = ".lock"
+
+    def __init__(self, root):
+        self.root = root
+        self.lockFile = None
+
+    def lock(self, exclusive=False, logger=None):
+        """
+        Lock the store, waits for the holders of a conflicting lock.
+
+        """
+        if not os.path.exists(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                # created by another command in the meantime
+                if not os.path.isdir(self.root):
+                    raise
+        self.lockFile = open(os.path.join(self.root, self.lockName), "a")
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(self.lockFile.fileno(), operation | fcntl.LOCK_NB)
+        except IOError, ex:
+            if ex.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            if logger:
+                logger.info("Chunk store '%s' is in use, waiting ..." %
+                            self.root)
+            fcntl.flock(self.lockFile.fileno(), operation)
+
+    def unlock(self):
+        if self.lockFile:
+            # closing releases the lock
+            self.lockFile.close()
+            self.lockFile = None
+
+    def getPath(self, chunkId):
+        return os.path.join(self.root, chunkId[:2], chunkId)
+
+    def put(self, chunkId, data):
+        """
+        Store the chunk unless already present, returns True if stored.
+        Chunk is written aside and renamed, so concurrently running
+        commands may store the same chunk.
+
+        """
+        path = self.getPath(chunkId)
+        if os.path.exists(path):
+            return False
+        dirName = os.path.dirname(path)
+        if not os.path.exists(dirName):
+            try:
+                os.makedirs(dirName)
+            except OSError:
+                # created by another command in the meantime
+                if not os.path.isdir(dirName):
+                    raise
+        fd, tmpName = tempfile.mkstemp(dir=dirName, suffix=".tmp")
+        try:
+            f = os.fdopen(fd, "wb")
+            f.write(zlib.compress(data))
+            f.close()
+            os.rename(tmpName, path)
+        except:
+            os.remove(tmpName)
+            raise
+        return True
+
+    def get(self, chunkId, size):
+        f = open(self.getPath(chunkId), "rb")
+        try:
+            data = zlib.decompress(f.read())
+        finally:
+            f.close()
+        if (len(data) != size or
+                hashlib.sha256(data).hexdigest() != chunkId):
+            raise IOError("Chunk '%s' is corrupted." % chunkId)
+        return data
+
+    def collectGarbage(self, referenced, logger):
+        """
+        Remove chunks not in referenced (set of chunk ids) and leftovers
+        of interrupted writes. The store has to be locked exclusively
+        since before the referenced chunks were collected.
+
+        """
+        removed, freed = 0, 0
+        if not os.path.exists(self.root):
+            logger.info("No chunk store '%s'." % self.root)
+            return
+        for dirName in sorted(os.listdir(self.root)):
+            dirPath = os.path.join(self.root, dirName)
+            if not os.path.isdir(dirPath):
+                continue # lock file
+            for name in os.listdir(dirPath):
+                if name in referenced:
+                    continue
+                path = os.path.join(dirPath, name)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                removed += 1
+        logger.info("Removed %s unreferenced chunks, %s bytes freed." %
+                    (removed, freed))
+
+
+# gear table of the rolling hash, must never change, otherwise
+# boundaries of chunks change and nothing gets deduplicated
+CHUNK_GEAR = [int(hashlib.md5(chr(i)).hexdigest()[:8], 16)
+              for i in range(256)]
+RECIPE_HEADER = "backupper-recipe 1"
+
+
+def findChunkBoundary(buf, start, end, mask):
+    """
+    Returns the first position i (start <= i < end) whose gear hash has
+    the mask bits zero, None if there is none. The hash of position i
+    depends only on the 32 bytes buf[i - 31:i + 1] (start >= 31):
+    sum of CHUNK_GEAR[buf[i - k]] << k for k < 32, modulo 2^32.
+    Vectorised by numpy if available (the sum is built by doubling the
+    number of terms 5 times), byte by byte otherwise.
+
+    """
+    if numpy:
+        data = numpy.frombuffer(str(buf[start - 31:end]), numpy.uint8)
+        h = numpy.array(CHUNK_GEAR, numpy.uint32)[data]
+        shift = 1
+        while shift < 32:
+            h[shift:] += h[:-shift] << numpy.uint32(shift)
+            shift *= 2
+        hits = numpy.flatnonzero((h[31:] & numpy.uint32(mask)) == 0)
+        return start + int(hits[0]) if len(hits) else None
+    gear = CHUNK_GEAR
+    h = 0
+    for i in xrange(start - 31, end):
+        h = ((h << 1) + gear[buf[i]]) & 0xffffffff
+        if not h & mask and i >= start:
+            return i
+    return None
+
+
+class ChunkStoreWriter(object):
+    """
+    File-like object splitting the stream into content defined chunks
+    (gear rolling hash, chunk boundary where the top avgBits bits of the
+    hash are zero, i.e. 2^avgBits bytes apart on average) and storing
+    each chunk into the store. fileobj receives the recipe: header with
+    the store location (relative to recipeDir), one line per chunk
+    (sha256 digest, size) and the trailer with the size and sha256
+    digest of the whole stream.
+    Boundaries depend only on the content preceding them, so data
+    shifted by an insertion still produces the same chunks.
+    The store is locked (shared) until close(), fileobj is not closed
+    by close().
+
+    """
+
+    # bytes searched for a boundary at once
+    searchSize = 256 * 1024
+
+    def __init__(self, store, fileobj, recipeDir, minSize=256 * 1024,
+                 avgBits=20, maxSize=4 * 1024 * 1024):
+        self.store = store
+        self.fileobj = fileobj
+        # boundary hash needs 32 bytes of the chunk
+        self.minSize = max(minSize, 32)
+        self.maxSize = maxSize
+        self.mask = ((1 << avgBits) - 1) << (32 - avgBits)
+        self.buffer = bytearray()
+        # position of the boundary search in the buffer
+        self.pos = 0
+        self.digest = hashlib.sha256()
+        self.size = 0
+        # sizes of all chunks and of those newly stored
+        self.chunked = 0
+        self.stored = 0
+        self.fileobj.write("%s %s\n" % (RECIPE_HEADER,
+                           os.path.relpath(store.root, recipeDir)))
+        self.store.lock()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.digest.update(data)
+        self.size += len(data)
+        self._split()
+
+    def _split(self):
+        buf = self.buffer
+        while True:
+            start = max(self.pos, self.minSize)
+            end = min(len(buf), self.maxSize)
+            cut = None
+            while start < end and cut is None:
+                stop = min(end, start + self.searchSize)
+                i = findChunkBoundary(buf, start, stop, self.mask)
+                if i is None:
+                    start = stop
+                else:
+                    cut = i + 1
+            if cut is None:
+                if end < self.maxSize:
+                    self.pos = end
+                    return
+                cut = self.maxSize
+            self._storeChunk(str(buf[:cut]))
+            del buf[:cut]
+            self.pos = 0
+
+    def _storeChunk(self, chunk):
+        chunkId = hashlib.sha256(chunk).hexdigest()
+        if self.store.put(chunkId, chunk):
+            self.stored += len(chunk)
+        self.chunked += len(chunk)
+        self.fileobj.write("%s %s\n" % (chunkId, len(chunk)))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self._storeChunk(str(self.buffer))
+            self.buffer = bytearray()
+        self.fileobj.write("end %s %s\n" % (self.size,
+                                            self.digest.hexdigest()))
+        self.fileobj.flush()
+        self.store.unlock()
+
+    def abort(self):
+        # failed, chunks stored so far are left to garbage collection
+        self.buffer = bytearray()
+        self.store.unlock()
+
+
+def restoreRecipe(recipe, output):
+    """
+    Write the stream (tar archive) described by the recipe file into
+    the output file, chunks and the whole stream are verified.
+
+    """
+    f = open(recipe, "r")
+    try:
+        header, storePath = f.readline().strip().rsplit(" ", 1)
+        if header != RECIPE_HEADER:
+            raise Exception("'%s' is not a recipe file." % recipe)
+        store = ChunkStore(os.path.join(os.path.dirname(recipe), storePath))
+        out = open(output, "wb")
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            for line in f:
+                items = line.split()
+                if items[0] == "end":
+                    if (int(items[1]) != size or
+                            items[2] != digest.hexdigest()):
+                        raise IOError("Restored stream verification "
+                                      "failed.")
+                    break
+                data = store.get(items[0], int(items[1]))
+                digest.update(data)
+                size += len(data)
+                out.write(data)
+            else:
+                raise IOError("Recipe '%s' is incomplete." % recipe)
+        finally:
+            out.close()
+    finally:
+        f.close()
+    return size
+
+
+def collectChunkGarbage(dstDir, logger):
+    """
+    Remove chunks of the dstDir chunk store not referenced by any recipe
+    of the backups in dstDir (to be run after removing old backups).
+    Backups running meanwhile are waited for, those starting meanwhile
+    wait for the collection to finish.
+
+    """
+    store = ChunkStore(os.path.join(dstDir, "chunks"))
+    if not os.path.exists(store.root):
+        logger.info("No chunk store '%s'." % store.root)
+        return
+    store.lock(exclusive=True, logger=logger)
+    try:
+        referenced = set()
+        recipes = helpers.get_files(path=dstDir, file_mask="*.tar.recipe",
+                                    recursive=True)
+        for recipe in recipes:
+            f = open(recipe, "r")
+            try:
+                f.readline() # header
+                for line in f:
+                    chunkId = line.split()[0]
+                    if chunkId != "end":
+                        referenced.add(chunkId)
+            finally:
+                f.close()
+        logger.info("%s recipes reference %s chunks." %
+                    (len(recipes), len(referenced)))
+        store.collectGarbage(referenced, logger)
+    finally:
+        store.unlock()
+
+
+class Manifest(object):
+    """
+    Stat information (size, mtime, inode, mode) of archived entries,
+    member name -> tuple, used by incremental archives to find new and
+    changed entries. level is 0 for a full archive, n for n-th
+    incremental archive since the full one. Stored gzip compressed as
+    NUL terminated records, the first one being the header.
+
+    """
+
+    header = "backupper-manifest 1"
+
+    def __init__(self, level=0):
+        self.level = level
+        self.entries = {}
+
+    def add(self, name, st):
+        self.entries[name] = (st.st_size, st.st_mtime, st.st_ino,
+                              st.st_mode)
+
+    def isChanged(self, name, st):
+        return self.entries.get(name) != (st.st_size, st.st_mtime,
+                                          st.st_ino, st.st_mode)
+
+    @staticmethod
+    def load(fileName):
+        f = gzip.open(fileName, "rb")
+        try:
+            records = f.read().split("\0")
+        finally:
+            f.close()
+        header, level = records[0].rsplit(" ", 1)
+        if header != Manifest.header:
+            raise Exception("'%s' is not a manifest file." % fileName)
+        m = Manifest(int(level))
+        # last record is empty (terminated)
+        for record in records[1:-1]:
+            size, mtime, ino, mode, name = record.split(" ", 4)
+            m.entries[name] = (int(size), float(mtime), int(ino), int(mode))
+        return m
+
+    def save(self, fileName):
+        # written aside and renamed, an interrupted run keeps the old one
+        tmpName = "".join([fileName, ".tmp"])
+        f = gzip.open(tmpName, "wb")
+        try:
+            f.write("%s %s\0" % (Manifest.header, self.level))
+            for name, (size, mtime, ino, mode) in self.entries.iteritems():
+                f.write("%s %r %s %s %s\0" % (size, mtime, ino, mode, name))
+        finally:
+            f.close()
+        os.rename(tmpName, fileName)
+
+
+class Journal(object):
+    """
+    Journal of commands completed in the backup directory, one JSON
+    record per line: the command, its output file (relative to the backup
+    directory), size and digests of the output. An interrupted backup
+    can be resumed - commands recorded in the journal whose output is
+    intact are not run again.
+    Intermediate outputs (tar archive compressed by the next command of
+    the chain) are recorded by size only, they are consumed anyway.
+
+    """
+
+    fileName = "journal.log"
+
+    def __init__(self, dstDir, logger):
+        self.dstDir = dstDir
+        self.logger = logger
+        self.lock = threading.Lock()
+        # command (string) -> record
+        self.entries = {}
+        journal = os.path.join(self.dstDir, self.fileName)
+        if os.path.exists(journal):
+            f = open(journal, "r+")
+            try:
+                data = f.read()
+                # drop the last record if cut by the interruption
+                end = data.rfind("\n") + 1
+                if end < len(data):
+                    f.truncate(end)
+                for line in data[:end].splitlines():
+                    entry = json.loads(line)
+                    self.entries[entry["command"]] = entry
+            finally:
+                f.close()
+            self.logger.info("%s completed commands found in journal '%s'" %
+                             (len(self.entries), journal))
+
+    @staticmethod
+    def getConsumed(commands):
+        """
+        Returns set of commands whose output is consumed by a command
+        depending on them which has an output of its own (tar archive
+        compressed by gzip).
+
+        """
+        consumed = set()
+        for c in commands:
+            if c.getOutputFile():
+                consumed.update([d for d in c.getDependencies()
+                                 if d.getOutputFile()])
+        return consumed
+
+    def record(self, c, final=True):
+        """
+        Record the completed command c. Output of a final command is
+        recorded with its digests, computed only if not computed while
+        writing it (built-in commands).
+
+        """
+        output = c.getOutputFile()
+        entry = {"command": c.getCommand(),
+                 "output": None,
+                 "size": None,
+                 "digests": {},
+                 "time": time.time()}
+        if output:
+            if isinstance(c, BuiltinCommand) and c.getDigests():
+                entry["digests"] = c.getDigests()
+            elif final:
+                entry["digests"] = {"md5": fileDigest(output, "md5")}
+            entry["output"] = os.path.relpath(output, self.dstDir)
+            entry["size"] = os.path.getsize(output)
+        self.lock.acquire()
+        try:
+            f = open(os.path.join(self.dstDir, self.fileName), "a")
+            try:
+                f.write("%s\n" % json.dumps(entry, sort_keys=True))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            self.entries[entry["command"]] = entry
+        finally:
+            self.lock.release()
+
+    def verify(self, entry):
+        """
+        Returns True if the output of the journal entry is intact (only
+        the size is checked if it was recorded without digests).
+
+        """
+        output = os.path.join(self.dstDir, entry["output"])
+        digests = entry["digests"]
+        intact = (os.path.exists(output) and
+                  os.path.getsize(output) == entry["size"])
+        if intact and digests:
+            # one of the digests is enough
+            digestName = "md5" if "md5" in digests else sorted(digests)[0]
+            intact = fileDigest(output, digestName) == digests[digestName]
+        if not intact:
+            self.logger.warning("Output '%s' of '%s' is missing or "
+                                "changed." % (output, entry["command"]))
+            return False
+        return True
+
+    def getDone(self, commands):
+        """
+        Returns set of commands which need not be run again: recorded in
+        the journal, their own output (if any) is intact and all their
+        dependencies are done as well. A consumed output (tar archive
+        removed by gzip) is intact if it is gone and the command which
+        consumed it has its output intact.
+
+        """
+        consumers = dict([(c, []) for c in commands])
+        for c in commands:
+            if c.getOutputFile():
+                for d in c.getDependencies():
+                    if d in consumers:
+                        consumers[d].append(c)
+        valid = set()
+        # consumers come after the commands they depend on
+        for c in reversed(commands):
+            entry = self.entries.get(c.getCommand())
+            if not entry:
+                continue
+            output = entry["output"]
+            if not output:
+                valid.add(c)
+            elif (not os.path.exists(os.path.join(self.dstDir, output)) and
+                    [d for d in consumers[c] if d in valid]):
+                # consumed
+                valid.add(c)
+            elif self.verify(entry):
+                valid.add(c)
+        done = set()
+        for c in commands:
+            if c in valid and not [d for d in c.getDependencies()
+                                   if d in consumers and d not in done]:
+                done.add(c)
+                entry = self.entries[c.getCommand()]
+                if isinstance(c, BuiltinCommand) and entry["output"]:
+                    c.setArchive(os.path.join(self.dstDir, entry["output"]))
+                    c.setDigests(entry["digests"])
+        return done
+
+    def getDigests(self):
+        """
+        Returns dictionary full path of output file -> digests.
+
+        """
+        self.lock.acquire()
+        try:
+            return dict([(os.path.join(self.dstDir, e["output"]),
+                          e["digests"]) for e in self.entries.values()
+                         if e["output"] and e["digests"]])
+        finally:
+            self.lock.release()
+
+
+def writeMember(f, tarInfo):
+    """
+    Append the archived member into the member list f (NUL terminated
+    records: size, mtime, name).
+
+    """
+    f.write("%s %s %s\0" % (tarInfo.size, int(tarInfo.mtime),
+                            tarInfo.name))
+
+
+def addTarFile(tar, tarInfo, fileobj, blockSize):
+    """
+    Generator adding the member tarInfo with data read from fileobj into
+    tar (as TarFile.addfile() does), a step per blockSize bytes of data.
+
+    """
+    buf = tarInfo.tobuf(tar.format, tar.encoding, tar.errors)
+    tar.fileobj.write(buf)
+    tar.offset += len(buf)
+    remaining = tarInfo.size
+    while remaining:
+        data = fileobj.read(min(blockSize, remaining))
+        tar.fileobj.write(data)
+        remaining -= len(data)
+        yield None
+    blocks, remainder = divmod(tarInfo.size, tarfile.BLOCKSIZE)
+    if remainder:
+        tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tar.offset += blocks * tarfile.BLOCKSIZE
+    tar.members.append(tarInfo)
+
+
+def listTarMembers(tarFile, memberList):
+    """
+    List members of the (uncompressed) tar archive into memberList, only
+    the headers are read.
+
+    """
+    tar = tarfile.open(tarFile, "r:")
+    try:
+        f = open(memberList, "wb")
+        try:
+            while True:
+                tarInfo = tar.next()
+                if tarInfo is None:
+                    break
+                writeMember(f, tarInfo)
+                # not needed, would hold all the members in memory
+                tar.members = []
+        finally:
+            f.close()
+    finally:
+        tar.close()
+
+
+class Catalog(object):
+    """
+    SQLite catalog of the members archived by the backups of a
+    destination directory (path, size, mtime, archive, backup), indexed
+    by path.
+
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS backups (
+            id INTEGER PRIMARY KEY, name TEXT UNIQUE, date TEXT);
+        CREATE TABLE IF NOT EXISTS archives (
+            id INTEGER PRIMARY KEY, backup INTEGER, name TEXT);
+        CREATE TABLE IF NOT EXISTS members (
+            archive INTEGER, path TEXT, size INTEGER, mtime INTEGER);
+        CREATE INDEX IF NOT EXISTS members_path ON members (path);
+        CREATE INDEX IF NOT EXISTS archives_backup ON archives (backup);
+        CREATE INDEX IF NOT EXISTS members_archive ON members (archive);
+        """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.conn = sqlite3.connect(fileName)
+        # member names are byte strings of whatever encoding
+        self.conn.text_factory = str
+        self.conn.executescript(self.schema)
+
+    def close(self):
+        self.conn.close()
+
+    def addBackup(self, name, date, archives):
+        """
+        Add (replace, if resumed) the backup name, archives is a list of
+        (archive name, member list file).
+
+        """
+        c = self.conn.cursor()
+        try:
+            c.execute("SELECT id FROM backups WHERE name = ?", (name, ))
+            row = c.fetchone()
+            if row:
+                c.execute("DELETE FROM members WHERE archive IN "
+                          "(SELECT id FROM archives WHERE backup = ?)", row)
+                c.execute("DELETE FROM archives WHERE backup = ?", row)
+                c.execute("DELETE FROM backups WHERE id = ?", row)
+            c.execute("INSERT INTO backups (name, date) VALUES (?, ?)",
+                      (name, date))
+            backupId = c.lastrowid
+            count = 0
+            for archive, memberList in archives:
+                c.execute("INSERT INTO archives (backup, name) VALUES "
+                          "(?, ?)", (backupId, archive))
+                archiveId = c.lastrowid
+                f = open(memberList, "rb")
+                try:
+                    records = f.read().split("\0")
+                finally:
+                    f.close()
+                rows = []
+                # last record is empty (terminated)
+                for record in records[:-1]:
+                    size, mtime, path = record.split(" ", 2)
+                    rows.append((archiveId, path, int(size), int(mtime)))
+                c.executemany("INSERT INTO members (archive, path, size, "
+                              "mtime) VALUES (?, ?, ?, ?)", rows)
+                count += len(rows)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        return count
+
+    def find(self, pattern):
+        """
+        Returns (backup, date, archive, path, size, mtime) of members
+        with the path matching glob pattern (* matches / too) or with
+        the path prefix pattern (no glob special characters in it).
+
+        """
+        query = ("SELECT b.name, b.date, a.name, m.path, m.size, m.mtime "
+                 "FROM members m JOIN archives a ON m.archive = a.id "
+                 "JOIN backups b ON a.backup = b.id WHERE %s "
+                 "ORDER BY m.path, b.date")
+        if [c for c in "*?[" if c in pattern]:
+            args = (pattern, )
+            query = query % "m.path GLOB ?"
+        else:
+            # range of the index, not LIKE (case insensitive, no index)
+            args = (pattern, "".join([pattern, "\xff"]))
+            query = query % "m.path >= ? AND m.path < ?"
+        return self.conn.execute(query, args).fetchall()
+
+
+def fileCrc(fileName, fromDisk=False):
+    """
+    Returns CRC of the file. If fromDisk, the file is synced and dropped
+    from the page cache first (if possible), so that it is read from
+    the disk, not from the cache.
+
+    """
+    crc = zlib.crc32("") & 0xffffffff
+    f = open(fileName, "rb")
+    try:
+        if fromDisk:
+            os.fsync(f.fileno())
+            if libc:
+                fadvise(f.fileno(), POSIX_FADV_DONTNEED)
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc) & 0xffffffff
+    finally:
+        f.close()
+    return crc
+
+
+def fileDigest(fileName, digestName):
+    h = hashlib.new(digestName)
+    f = open(fileName, "rb")
+    try:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+class FanOutWriter(object):
+    """
+    File-like object writing the same data into several newly created
+    files at the same time, each of them by its own thread. Each thread
+    takes the data from its bounded queue, so the memory held is
+    bounded and the writer waits for the slowest file. close() checks
+    size of every copy, with verify it also reads every copy back from
+    the disk (see fileCrc()) and compares its CRC with CRC of the data
+    written.
+
+    """
+
+    def __init__(self, fileNames, maxPending=16, verify=True):
+        self.fileNames = fileNames
+        self.verify = verify
+        self.size = 0
+        self.crc = zlib.crc32("") & 0xffffffff
+        # per file: queue, thread and [size, crc, error], crc of the copy
+        # read back (verify)
+        self.queues = []
+        self.threads = []
+        self.results = []
+        for fileName in fileNames:
+            f = open(fileName, "wb")
+            q = Queue.Queue(maxPending)
+            result = [0, None, None]
+            t = threading.Thread(target=self._writer, args=(f, q, result),
+                                 name="fanout-%s" % len(self.threads))
+            t.daemon = True
+            t.start()
+            self.queues.append(q)
+            self.threads.append(t)
+            self.results.append(result)
+
+    def _writer(self, f, q, result):
+        try:
+            while True:
+                data = q.get()
+                if data is None:
+                    break
+                if result[2]:
+                    continue # failed, just drain the queue
+                try:
+                    f.write(data)
+                    result[0] += len(data)
+                except (IOError, OSError), ex:
+                    result[2] = ex
+        finally:
+            try:
+                f.close()
+            except (IOError, OSError), ex:
+                result[2] = result[2] or ex
+        if self.verify and not result[2]:
+            try:
+                result[1] = fileCrc(f.name, fromDisk=True)
+            except (IOError, OSError), ex:
+                result[2] = ex
+
+    def _checkErrors(self):
+        for fileName, (size, crc, error) in zip(self.fileNames,
+                                                self.results):
+            if error:
+                raise IOError("Writing '%s' failed, reason: %s" %
+                              (fileName, error))
+
+    def write(self, data):
+        self._checkErrors()
+        self.size += len(data)
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        for q in self.queues:
+            q.put(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+        self._checkErrors()
+        for fileName, (size, crc, error) in zip(self.fileNames,
+                                                self.results):
+            if (size != self.size or
+                os.path.getsize(fileName) != self.size):
+                raise IOError("Verification of '%s' failed, size "
+                              "mismatch." % fileName)
+            if self.verify and crc != self.crc:
+                raise IOError("Verification of '%s' failed, CRC mismatch."
+                              % fileName)
+
+
+class DigestWriter(object):
+    """
+    File-like object passing data into fileobj while computing digests
+    (hashlib algorithms digestNames) of everything written.
+    close() closes fileobj as well.
+
+    """
+
+    def __init__(self, fileobj, digestNames):
+        self.fileobj = fileobj
+        self.hashes = [(n, hashlib.new(n)) for n in digestNames]
+        self.size = 0
+
+    def write(self, data):
+        for name, h in self.hashes:
+            h.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+    def hexdigests(self):
+        return dict([(n, h.hexdigest()) for n, h in self.hashes])
+
+
+class SourceReader(object):
+    """
+    File-like reader of an archived file which always provides exactly
+    size bytes - the size recorded in the tar header. If the file shrinks
+    while being archived, it is padded with zeros (as tar does), if it
+    grows, the extra data is ignored.
+    The file is read in blocks of readSize bytes. With dropCache the
+    kernel is told the file is read sequentially, the next block is
+    asked for in advance and the blocks read are dropped from the page
+    cache, so archiving does not push out data other processes use.
+
+    """
+
+    def __init__(self, path, size, logger, dropCache=False,
+                 readSize=1024 * 1024):
+        self.path = path
+        self.remaining = size
+        self.logger = logger
+        self.dropCache = dropCache
+        self.readSize = readSize
+        self.f = open(path, "rb")
+        self.buffer = ""
+        self.position = 0
+        # bytes read from the file so far
+        self.offset = 0
+        if self.dropCache:
+            fadvise(self.f.fileno(), POSIX_FADV_SEQUENTIAL)
+            fadvise(self.f.fileno(), POSIX_FADV_WILLNEED, 0, readSize)
+
+    def _readBlock(self):
+        data = self.f.read(self.readSize)
+        if self.dropCache and data:
+            fd = self.f.fileno()
+            fadvise(fd, POSIX_FADV_DONTNEED, self.offset, len(data))
+            fadvise(fd, POSIX_FADV_WILLNEED, self.offset + len(data),
+                    self.readSize)
+        self.offset += len(data)
+        return data
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        while len(self.buffer) - self.position < size:
+            block = self._readBlock()
+            if not block:
+                break
+            self.buffer = self.buffer[self.position:] + block
+            self.position = 0
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        if len(data) < size:
+            self.logger.warning("'%s' shrank while being archived, padding "
+                                "with zeros." % self.path)
+            data += "\0" * (size - len(data))
+        self.remaining -= size
+        return data
+
+    def close(self):
+        if self.dropCache:
+            fadvise(self.f.fileno(), POSIX_FADV_DONTNEED)
+        self.f.close()
+
+
+def getPhysicalOffset(path):
+    """
+    Returns physical offset (bytes on the device) of the first extent of
+    the file by FIEMAP ioctl, 0 for files without extents. Raises
+    IOError if the file system does not support FIEMAP.
+
+    """
+    # struct fiemap: start, length, flags, mapped extents, extent count,
+    # reserved, followed by room for one struct fiemap_extent
+    request = struct.pack("=QQLLLL", 0, 0xffffffffffffffff, 0, 0, 1, 0)
+    f = open(path, "rb")
+    try:
+        result = fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP,
+                             request + "\0" * 56)
+    finally:
+        f.close()
+    mapped = struct.unpack_from("=L", result, 20)[0]
+    if not mapped:
+        return 0
+    # fiemap_extent: logical, physical, ...
+    return struct.unpack_from("=Q", result, 40)[0]
+
+
+def fadvise(fd, advice, offset=0, length=0):
+    """
+    posix_fadvise() the region of the file fd (whole file by default),
+    returns False if not supported.
+
+    """
+    if not libc:
+        return False
+    return libc.posix_fadvise64(fd, offset, length, advice) == 0
+
+
+class BandwidthLimit(object):
+    """
+    Token bucket limiting rate of data (bytes per second), shared by all
+    the commands it is given to (thread safe). spec is
+    "<MB/s>[,<HH:MM>-<HH:MM>=<MB/s>...]" - the limit and limits which
+    apply instead within time of day windows (may span midnight), 0 is
+    no limit, e.g. "5,22:00-06:00=0" is 5 MB/s except at night.
+    Raises ValueError on an incorrect spec.
+
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        items = [i.strip() for i in spec.split(",")]
+        self.rate = self._parseRate(items[0])
+        # (start minute, end minute, rate) of time of day windows
+        self.windows = []
+        for item in items[1:]:
+            try:
+                window, rate = item.split("=")
+                start, end = window.split("-")
+            except ValueError:
+                raise ValueError("incorrect time window '%s'" % item)
+            self.windows.append((self._parseTime(start),
+                                 self._parseTime(end),
+                                 self._parseRate(rate)))
+        # available bytes, negative when in debt
+        self.tokens = 0
+        self.last = time.time()
+        self.lock = threading.Lock()
 
+    def _parseRate(self, rate):
+        rate = float(rate)
+        if rate < 0:
+            raise ValueError("negative rate '%s'" % rate)
+        return int(rate * 1024 * 1024) or None
 
-class Executor(object):
+    def _parseTime(self, hhmm):
+        try:
+            hours, minutes = [int(i) for i in hhmm.split(":")]
+        except ValueError:
+            raise ValueError("incorrect time '%s'" % hhmm)
+        # 24:00 is the end of the day
+        if not (0 <= hours < 24 and 0 <= minutes < 60 or
+                hours == 24 and minutes == 0):
+            raise ValueError("incorrect time '%s'" % hhmm)
+        return hours * 60 + minutes
 
-    def __init__(self, dstDir, logger):
-        self.dstDir = dstDir
-        self.logger = logger
+    def getRate(self, now=None):
+        """
+        Returns bytes per second allowed at time now, None if unlimited.
 
-    def _storeStdOutput(self, command, toStore):
         """
-        Store stdouput for a command, now held in data into file
-        command.getStdOutLogFile()
-        toStore is a tempfile and should be open.
-        
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for start, end, rate in self.windows:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                inside = minute >= start or minute < end
+            if inside:
+                return rate
+        return self.rate
+
+    def consume(self, size):
         """
-        logFile = command.getStdOutLogFile()
-        self.logger.debug("Storing command stdout into file '%s'" % logFile)
-        logPrefix = command.getLogPrefix()
-        try:
-            f = open(logFile, 'a')  # append from all commands
-            f.write(logPrefix)
-            toStore.flush()
-            f.write(toStore.read())
-            f.flush()
-            f.close()
-        except OSError, ex:
-            m = ("Error while storing stdoutput into file '%s', "
-                 "reason: %s" % (logFile, ex))
-            raise Exception(m)
-    
-    def execute(self, commands):
-        strComm = "\t".join(["'%s'\n" % c.getCommand() for c in commands])
-        self.logger.info("%s command(s) to be executed:\n\t%s" %
-                         (len(commands), strComm))
+        Take size bytes out of the bucket, returns seconds the caller
+        has to wait to keep within the limit (0 if it needn't wait).
 
-        for c in commands:
-            comm = c.getCommand()
-            # create tmp files for stdOut, stdErr of the process
-            stdOut = tempfile.TemporaryFile("w+") # read / write
-            stdErr = tempfile.TemporaryFile("w+")
-            try:
-                self.logger.debug("Changing current directory to '%s'" %
-                                  c.getChangeToDir())
-                os.chdir(c.getChangeToDir())
-                self.logger.info("Executing command:\n\t'%s' ..." % comm)
-                
-                # p = subprocess.Popen() will not wait, would then use
-                # retCode = p.wait() - here consider multithreading
-                
-                # check_call() waits for the call, if returncode is non
-                # zero, CalledProcessError is raised
-                # subprocess.Popen() requires arguments in a sequence, if run
-                # with shell=True argument then could take the whole string
-                p = subprocess.check_call(comm.split(),
-                                          stdout=stdOut,
-                                          stderr=stdErr,
-                                          close_fds=False)
-                self.logger.info("Command finished, no error raised.")
-
-                # store stdOut, stdErr
-                # move pointer back to beggining before read()
-                stdOut.seek(0) 
-                stdErr.seek(0)
-                stdOutMsg = ""
-                if c.getStdOutLogFile():
-                    # stdoutput file is set for a command, store output there
-                    self._storeStdOutput(c, stdOut)
-                    stdOutMsg = ("stdout: saved in a separate file '%s'" %
-                                 c.getStdOutLogFile())
-                else:
-                    stdOutMsg = "\nstdout:\n%s" % stdOut.read()
+        """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            rate = self.getRate(now)
+            if not rate:
+                self.tokens, self.last = 0, now
+                return 0
+            # bucket holds at most one second worth of data
+            self.tokens = min(rate, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= size
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / float(rate)
+        finally:
+            self.lock.release()
 
-                self.logger.debug("%s\nstderr:\n%s" %
-                                  (stdOutMsg, stdErr.read()))
 
-            except subprocess.CalledProcessError, ex:
-                stdOut.seek(0)
-                stdErr.seek(0)
-                self.logger.debug("\nstdout:\n%s\n\nstderr:\n%s" %
-                                  (stdOut.read(), stdErr.read()))
-                m = ("'%s' failed, return code: %s, reason: %s" %
-                     (comm, ex.returncode, ex))
-                self.logger.error(m)
-                # just log, do not terminate the whole process
-                #raise Exception(m)
+class ThrottledWriter(object):
+    """
+    File-like object passing data into fileobj and charging it to
+    bwLimit (BandwidthLimit, None is no limit). It never waits itself,
+    seconds the writer has to wait to keep within the limit are taken
+    by takeWait() and waited for by the caller between its steps (see
+    BuiltinCommand.steps()), their sum is kept in throttledTime.
+    fileobj is not closed by close().
 
+    """
 
-class XMLInputProcessor(object):
+    def __init__(self, fileobj, bwLimit):
+        self.fileobj = fileobj
+        self.bwLimit = bwLimit
+        self.throttledTime = 0
+        self.wait = 0
+
+    def write(self, data):
+        if self.bwLimit:
+            # debt of the bucket so far
+            self.wait = self.bwLimit.consume(len(data))
+        self.fileobj.write(data)
+
+    def takeWait(self):
+        """
+        Returns seconds to wait before writing more data, 0 if none.
+
+        """
+        wait, self.wait = self.wait, 0
+        self.throttledTime += wait
+        return wait
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.flush()
+
+
+class GzipWriter(object):
     """
-    Converts XML input configuration file into list of commands,
-    i.e. list of Command class.
+    File-like object writing a gzip (single member) compressed stream
+    into fileobj. Input is compressed in blocks of blockSize bytes, each
+    block is ended by a sync flush and immediately decompressed back
+    and its CRC compared against the input, so the stream is verified
+    as it goes without reading the written archive again.
+    fileobj is not closed by close().
 
     """
 
-    def __init__(self, fileName, destDir, logger):
-        self.logger = logger
-        # XML config file to parse
-        self.fileName = fileName
-        # destination directory
-        self.destDirFullPath = destDir
-    
-    def getCommands(self, changeTo, dest, dir):
+    def __init__(self, fileobj, level=6, blockSize=1024 * 1024):
+        self.fileobj = fileobj
+        self.blockSize = blockSize
+        self.level = level
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                           -zlib.MAX_WBITS)
+        self.verifier = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32("") & 0xffffffff
+        self.size = 0
+        # gzip header: magic, deflate, no flags, mtime, no extra
+        # flags, OS unix
+        self.fileobj.write(struct.pack("<BBBBLBB", 0x1f, 0x8b, 8, 0,
+                                       int(time.time()), 0, 3))
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.blockSize:
+            block = "".join(self.buffer)
+            self.buffer, self.buffered = [], 0
+            for i in range(0, len(block), self.blockSize):
+                self._writeBlock(block[i:i + self.blockSize],
+                                 zlib.Z_SYNC_FLUSH)
+
+    def _writeBlock(self, block, flushMode):
+        compressed = (self.compressor.compress(block) +
+                      self.compressor.flush(flushMode))
+        check = self.verifier.decompress(compressed)
+        if zlib.crc32(check) != zlib.crc32(block):
+            raise IOError("Verification of compressed block failed, CRC "
+                          "mismatch at offset %s." % self.size)
+        self.crc = zlib.crc32(block, self.crc) & 0xffffffff
+        self.size += len(block)
+        self.fileobj.write(compressed)
+
+    def setLevel(self, level):
         """
-        According to input arguments creates a list of Commands
-        (class Command) for each predefined command (actions field).
-        dir is dictionary representing <dir> XML element
-        keys: archiveName - name of the archive
-              srcDir - source directory for the archive
-              actions - comma separated list of predefined commands
-              exclude - comma separated list of directories to exclude
-                        (argument to --exclude tar option).
-        actions.split(',')[0] - is expected to be tar command
-                          [1] - gzip (create archive) command (optional)
-                          [2] - gzip (test archive) command (optional)
+        Change compression level of the data written from now on (0 to
+        store already compressed data). The block compressed so far is
+        ended by a sync flush (byte aligned, not final), a new deflate
+        compressor continues the same raw deflate stream from there.
 
         """
-        commands = None
-        srcDir = dir.get("srcDir", None)
-        archiveName = dir.get("archiveName", None)
-        actions = dir.get("actions", None)
-        exclude = dir.get("exclude", None)
+        if level == self.level:
+            return
+        self._writeBlock("".join(self.buffer), zlib.Z_SYNC_FLUSH)
+        self.buffer, self.buffered = [], 0
+        self.level = level
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                           -zlib.MAX_WBITS)
 
-        if not srcDir and not actions:
-            return commands
-        
-        # continue
-        commands = [] # list of commands - result
+    def flush(self):
+        pass
 
-        if not archiveName:
-            archiveName = srcDir
-        
-        tarArchiveFullPath = os.path.join(self.destDirFullPath, dest,
-                                         "".join([archiveName, ".tar"]))
+    def close(self):
+        self._writeBlock("".join(self.buffer), zlib.Z_FINISH)
+        self.buffer, self.buffered = [], 0
+        self.fileobj.write(struct.pack("<LL", self.crc,
+                                       self.size & 0xffffffff))
+        self.fileobj.flush()
 
-        ac = actions.split(',') # predefined comma separated commands
-        if len(ac) >= 1:
-            # only tar command in the action attribute ...
-            c = Command(changeTo)
-            if exclude:
-                e = exclude.split(',')
-                ex = "".join(["--exclude %s " % i.strip() for i in e])
-            else:
-                ex = ""
-            d = {"archive": tarArchiveFullPath,
-                 "dir": srcDir,
-                 "exclude": ex}
-            command = ac[0].strip() % d
-            c.setCommand(command)
-            c.setStdOutLogFile(os.path.join(self.destDirFullPath,
-                               "archive-filelist.log"))
-            c.setLogPrefix("".join(["\n", 78 * '=', "\n", command,
-                           "\n", 78 * '=', "\n"]))
-            commands.append(c)
-        if len(ac) == 3:
-            # gzip command 
-            c = Command(changeTo)
-            d = {"archive": tarArchiveFullPath}
-            c.setCommand(ac[1].strip() % d)
-            commands.append(c)
-            
-            # gzip integrity test command
-            c = Command(changeTo)
-            d = {"zipArchive": "".join([tarArchiveFullPath, ".gz"])}
-            c.setCommand(ac[2].strip() % d)
-            commands.append(c)
+    def abort(self):
+        # failed, the stream is not finished
+        self.buffer, self.buffered = [], 0
 
-        return commands
 
-    def process(self):
+class ParallelGzipWriter(object):
+    """
+    File-like object writing gzip compressed stream into fileobj using
+    several threads. Input is split into blocks of blockSize bytes, each
+    block is compressed (zlib releases GIL) into an independent gzip
+    member and verified (decompressed back, CRC compared) by a worker
+    thread, CRC of the block included (see GzipBlock). The caller thread
+    only splits the input into blocks and writes the members, in order,
+    the result is a standard multi-member gzip file (readable by gunzip).
+    More threads than CPUs do not help, on a single CPU the throughput
+    is that of one thread (measured by benchmark.py --scaling).
+    If frames is True, (input offset, output offset) of each member is
+    recorded into the frames list (each member may be decompressed on
+    its own).
+    fileobj is not closed by close().
+
+    """
+
+    def __init__(self, fileobj, level=6, blockSize=1024 * 1024, threads=2,
+                 frames=False):
+        self.fileobj = fileobj
+        self.level = level
+        self.blockSize = blockSize
+        self.buffer = []
+        self.buffered = 0
+        # blocks being compressed, in order of the input
+        self.pending = collections.deque()
+        # bound the number of blocks held in memory
+        self.maxPending = 2 * threads
+        # bytes of input and of compressed output written so far
+        self.written = 0
+        self.compressed = 0
+        self.frames = [] if frames else None
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self._worker,
+                                 name="gzip-%s" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _worker(self):
+        while True:
+            block = self.tasks.get()
+            if block is None:
+                break
+            block.compress()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.blockSize:
+            data = "".join(self.buffer)
+            end = len(data) - len(data) % self.blockSize
+            for i in range(0, end, self.blockSize):
+                self._submit(data[i:i + self.blockSize])
+            self.buffer = [data[end:]]
+            self.buffered = len(data) - end
+
+    def _submit(self, data):
+        block = GzipBlock(data, self.level)
+        self.tasks.put(block)
+        self.pending.append(block)
+        while len(self.pending) > self.maxPending:
+            self._writeOldest()
+
+    def _writeOldest(self):
+        block = self.pending.popleft()
+        block.done.wait()
+        if block.error:
+            raise IOError("Compression of block at offset %s failed, "
+                          "reason: %s" % (self.written, block.error))
+        if self.frames is not None:
+            self.frames.append((self.written, self.compressed))
+        self.fileobj.write(block.member)
+        self.written += block.size
+        self.compressed += len(block.member)
+
+    def setLevel(self, level):
         """
-        Process XML configuration input and return corresponding
-        backup commands for execution.
+        Change compression level of the data written from now on,
+        buffered data is compressed by the previous level.
 
         """
-        r = [] # result - list of commands
-        self.logger.info("Parsing '%s' file." % self.fileName)
-        feed = lxml.objectify.parse(self.fileName)
-        root = feed.getroot()
-        commonsList = root.getchildren()
-        self.logger.debug("%d 'commonDirs' sections found." %
-                          len(commonsList))
+        if level == self.level:
+            return
+        if self.buffered:
+            self._submit("".join(self.buffer))
+            self.buffer, self.buffered = [], 0
+        self.level = level
 
-        for common in commonsList: # iterate over <commonDirs>
-            dest = common.get("destination", None)
-            changeTo = common.get("changeTo", None)
-            # test for None necessary
-            if dest and changeTo:
-                #print "   ", changeTo, "  ", dest
-                self.logger.debug("%d 'dirs' sections found." %
-                                  common.countchildren())
-                for dir in common.getchildren(): # iterate over <dir>
-                    currCommands = self.getCommands(changeTo, dest, dir)
-                    if currCommands:
-                        r.extend(currCommands) # will keep order
-                    (name, actions, exclude) = (None, None, None)
+    def flush(self):
+        pass
 
-                # if the destination directory does not exist, create it
-                destCheck = os.path.join(self.destDirFullPath, dest)
-                if not os.path.exists(destCheck):
-                    self.logger.info("Creating directory '%s'" % destCheck)
-                    os.mkdir(destCheck)
-            (dest, changeTo) = (None, None)
-        
-        return r
+    def close(self):
+        try:
+            # empty input still gives a valid (single member) gzip file
+            if self.buffered or not (self.written or self.pending):
+                self._submit("".join(self.buffer))
+            self.buffer, self.buffered = [], 0
+            while self.pending:
+                self._writeOldest()
+            self.fileobj.flush()
+        finally:
+            self._stopWorkers()
 
+    def abort(self):
+        """
+        Stop the worker threads without writing the rest of the stream
+        (on failure), blocks not compressed yet are dropped.
 
-class Command(object):
+        """
+        self.buffer, self.buffered = [], 0
+        self.pending.clear()
+        while True:
+            try:
+                self.tasks.get_nowait()
+            except Queue.Empty:
+                break
+        self._stopWorkers()
 
-    def __init__(self, changeToDir):
-        # directory into which to change before execution
-        self.changeToDir = changeToDir
-        # the command itself
-        self.command = None
-        # file name to put stdoutput of successful running
-        self.stdOutLogFile = None
-        # stdOutLogFile is open for appending, this is prefix of
-        # consecutive additions
-        self.logPrefix = ""
+    def _stopWorkers(self):
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
 
-    def setCommand(self, command):
-        self.command = command
 
-    def setStdOutLogFile(self, stdOutLogFile):
-        self.stdOutLogFile = stdOutLogFile
+class GzipBlock(object):
+    """
+    Block of data compressed into a standalone gzip member.
 
-    def setLogPrefix(self, logPrefix):
-        self.logPrefix = logPrefix
-    
-    def getChangeToDir(self):
-        return self.changeToDir
+    """
 
-    def getCommand(self):
-        return self.command
-    
-    def getStdOutLogFile(self):
-        return self.stdOutLogFile
+    def __init__(self, data, level):
+        self.data = data
+        self.level = level
+        self.size = len(data)
+        self.member = None
+        self.error = None
+        self.done = threading.Event()
 
-    def getLogPrefix(self):
-        return self.logPrefix
+    def compress(self):
+        try:
+            try:
+                crc = zlib.crc32(self.data) & 0xffffffff
+                c = zlib.compressobj(self.level, zlib.DEFLATED,
+                                     -zlib.MAX_WBITS)
+                deflated = c.compress(self.data) + c.flush(zlib.Z_FINISH)
+                check = zlib.decompress(deflated, -zlib.MAX_WBITS)
+                if zlib.crc32(check) & 0xffffffff != crc:
+                    raise IOError("verification failed, CRC mismatch")
+                self.member = "".join([
+                    struct.pack("<BBBBLBB", 0x1f, 0x8b, 8, 0,
+                                int(time.time()), 0, 3),
+                    deflated,
+                    struct.pack("<LL", crc, self.size & 0xffffffff)])
+            except Exception, ex:
+                self.error = ex
+        finally:
+            self.data = None
+            self.done.set()
 
 
 class Backupper(object):
@@ -292,15 +4025,27 @@ class Backupper(object):
     
     """
 
-    def __init__(self, xmlConfigFile, destDir):
+    def __init__(self, xmlConfigFile, destDir, options=None):
         # destination directory for backup
         self.dstDir = destDir
         # XML configuration of the backup process
         self.xmlConfig = xmlConfigFile
+        # optional command line settings (see getOptions())
+        self.options = options or {}
         # name of the file to store logging into
         self.logFileName = "backup.log"
         self.finalArchivesMask = "*.tar*"
         self.md5checksumFileName = "md5checksum.log"
+        self.sha256checksumFileName = "sha256checksum.log"
+        self.runReportFileName = "run-report.json"
+        # progress of the running backup (--event-loop)
+        self.statusFileName = "status.json"
+        # files generated anew by each run (also when resuming)
+        self.regeneratedFiles = [self.md5checksumFileName,
+                                 self.sha256checksumFileName,
+                                 "dpkg--get-selections.log", "dpkg-l.log"]
+        # backup commands as generated from the XML configuration
+        self.commands = []
         # start time of the process to measure total time
         self.startTime = datetime.datetime.now()
         
@@ -311,7 +4056,17 @@ class Backupper(object):
         self.logger = Logger(log_file=logFile, level=logging.DEBUG)
 
         # init commands executor
-        self.executor = Executor(self.dstDir, self.logger)
+        if self.options.get("eventLoop"):
+            statusFile = os.path.join(self.dstDir, self.statusFileName)
+            self.executor = EventExecutor(self.dstDir, self.logger,
+                                          workers=self.options.get("workers",
+                                                                   1),
+                                          statusFile=statusFile)
+        else:
+            self.executor = Executor(self.dstDir, self.logger,
+                                     workers=self.options.get("workers", 1))
+        # journal of completed backup commands
+        self.journal = Journal(self.dstDir, self.logger)
 
         self.logger.info("Start time: %sh %sm %ss" % (self.startTime.hour,
             self.startTime.minute, self.startTime.second))
@@ -322,8 +4077,19 @@ class Backupper(object):
         file name takes only file name and last directory (practical to
         have only the last directory compoment in the log file - for later
         checking - traversing directories and executing md5sum file.
+        Digests of archives recorded in the journal (computed while
+        writing by built-in commands, after finishing by shell commands)
+        are stored directly (in md5sum output format), md5sum is only run
+        for the other archives.
+        sha256 sums (if enabled) go into a separate file the same way.
 
         """
+        # archive full path -> digests
+        known = self.journal.getDigests()
+        sumFiles = [("md5", self.md5checksumFileName)]
+        if "sha256" in self.options.get("digests", []):
+            sumFiles.append(("sha256", self.sha256checksumFileName))
+
         # returns full paths of files
         files = helpers.get_files(path=self.dstDir,
                                   file_mask=self.finalArchivesMask,
@@ -334,11 +4100,49 @@ class Backupper(object):
             relatName = f.replace(self.dstDir, "")
             if relatName[0] == os.path.sep:
                 relatName = relatName[1:] # remove leading / if there is
-            c = Command(self.dstDir) # this is working dir for the command
-            c.setCommand("md5sum %s" % relatName)
-            c.setStdOutLogFile(os.path.join(self.dstDir,
-                                            self.md5checksumFileName))
-            self.executor.execute([c])
+            for digestName, sumFile in sumFiles:
+                sumFile = os.path.join(self.dstDir, sumFile)
+                if digestName in known.get(f, {}):
+                    self.logger.debug("%s of '%s' computed while writing "
+                                      "it." % (digestName, relatName))
+                    out = open(sumFile, 'a')
+                    out.write("%s  %s\n" % (known[f][digestName], relatName))
+                    out.close()
+                    continue
+                # this is working dir for the command
+                c = Command(self.dstDir)
+                c.setCommand("%ssum %s" % (digestName, relatName))
+                c.setStdOutLogFile(sumFile)
+                self.executor.execute([c])
+
+    def updateCatalog(self):
+        """
+        Add members archived by this backup (listed by the commands into
+        their member lists) into the catalog of the destination
+        directory, member lists are removed then.
+
+        """
+        archives = []
+        for c in self.commands:
+            memberList = c.getMemberList()
+            if memberList and os.path.exists(memberList):
+                archive = os.path.relpath(c.getCatalogArchive(), self.dstDir)
+                archives.append((archive, memberList))
+        name = os.path.basename(self.dstDir)
+        try:
+            date = datetime.datetime.strptime(name, "BACKUP-%Y-%m-%d-%Hh-"
+                                              "%Mm-%Ss").isoformat()
+        except ValueError:
+            date = self.startTime.isoformat()
+        fileName = os.path.join(os.path.dirname(self.dstDir), CATALOG_FILE)
+        catalog = Catalog(fileName)
+        try:
+            count = catalog.addBackup(name, date, archives)
+        finally:
+            catalog.close()
+        self.logger.info("%s members of %s archives added into catalog "
+                         "'%s'" % (count, len(archives), fileName))
+        shutil.rmtree(os.path.join(self.dstDir, CATALOG_DIR))
 
     def copyFiles(self):
         """
@@ -370,6 +4174,13 @@ class Backupper(object):
         accumulate them together.
 
         """
+        if self.options.get("resume"):
+            self.logger.info("Resuming backup in '%s'" % self.dstDir)
+            for fileName in self.regeneratedFiles:
+                fileName = os.path.join(self.dstDir, fileName)
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+
         # copy files (script, XML config files)
         try:
             self.copyFiles()
@@ -381,16 +4192,30 @@ class Backupper(object):
         try:
             xmlProc = XMLInputProcessor(self.xmlConfig,
                                         self.dstDir,
-                                        self.logger)
+                                        self.logger,
+                                        self.options)
             commands = xmlProc.process()
+            self.commands = commands
         except Exception, ex:
             m = "Error while processing input file, reason: %s" % ex
             self.logger.fatal(m)
             self.finish(retCode=1)
 
+        # estimate size of the archives, the largest ones go first
+        try:
+            planner = Planner(self.logger)
+            commands = planner.plan(commands,
+                                    self.options.get("workers", 1))
+            self.commands = commands
+            self.logger.info("Backup plan:\n\t%s" %
+                             "\n\t".join(planner.report))
+        except Exception, ex:
+            self.logger.warning("Planning failed, commands are run in the "
+                                "configuration order, reason: %s" % ex)
+
         # execute backup commands - commands list run as externally
         try:
-            self.executor.execute(commands)
+            self.executor.execute(commands, journal=self.journal)
         except Exception, ex:
             self.logger.fatal("Executing commands failed, reason: %s" % ex)
             self.finish(retCode=1)
@@ -402,6 +4227,12 @@ class Backupper(object):
             self.logger.fatal("Error generating md5sums, reason: %s" % ex)
             self.finish(retCode=1)
 
+        # catalog of archived members of all backups
+        try:
+            self.updateCatalog()
+        except Exception, ex:
+            self.logger.error("Error updating catalog, reason: %s" % ex)
+
         # dpkg Debian packages listings
         try:
             c = Command(self.dstDir) # set working directory, here unimportant
@@ -425,15 +4256,145 @@ class Backupper(object):
         duration = (endTime - self.startTime).seconds / 60 # duration in min
         self.logger.info("Backup lasted: %s minutes" % duration)
 
+        # a failed backup is not copied into the mirrors
+        mirrored = False
+        if self.options.get("mirrors") and retCode == 0:
+            try:
+                self.mirror()
+                mirrored = True
+            except Exception, ex:
+                self.logger.error("Mirroring failed, reason: %s" % ex)
+                retCode = 1
+
+        try:
+            self.writeRunReport(endTime, retCode)
+        except Exception, ex:
+            self.logger.error("Could not write run report, reason: %s" % ex)
+
         del self.executor
         
         self.logger.close()
         del self.logger
         logging.shutdown()
 
+        # the run report and the log are complete only now
+        if mirrored:
+            try:
+                self.mirrorFinalFiles()
+            except Exception, ex:
+                print "Mirroring the log failed, reason: %s" % ex
+                retCode = 1
+
         sys.exit(retCode)
 
 
+    def mirror(self):
+        """
+        Copy into the mirror backup directories what is not there yet -
+        archives created by shell commands, logs, checksums (built-in
+        actions write their archives into the mirrors directly) and also
+        the chunk store and manifests shared by the backups of the
+        destination directory. The run report and the backup log are
+        written later, see mirrorFinalFiles().
+
+        """
+        root = os.path.dirname(self.dstDir)
+        for mirror in self.options["mirrors"]:
+            trees = [(self.dstDir, mirror)]
+            for shared in ("chunks", "manifests"):
+                if os.path.isdir(os.path.join(root, shared)):
+                    trees.append((os.path.join(root, shared),
+                                  os.path.join(os.path.dirname(mirror),
+                                               shared)))
+            copied = 0
+            for src, dst in trees:
+                copied += syncTree(src, dst,
+                                   self.options.get("verifyMirrors", True))
+            catalog = os.path.join(root, CATALOG_FILE)
+            if os.path.exists(catalog):
+                shutil.copy2(catalog, os.path.join(os.path.dirname(mirror),
+                                                   CATALOG_FILE))
+                copied += 1
+            self.logger.info("%s files copied into mirror '%s'" %
+                             (copied, mirror))
+
+    def mirrorFinalFiles(self):
+        """
+        Copy the run report and the (closed) backup log into the mirror
+        backup directories.
+
+        """
+        for mirror in self.options["mirrors"]:
+            for fileName in (self.runReportFileName, self.logFileName):
+                src = os.path.join(self.dstDir, fileName)
+                if os.path.exists(src):
+                    shutil.copy2(src, os.path.join(mirror, fileName))
+
+    def writeRunReport(self, endTime, retCode):
+        """
+        Store machine readable report of the run with resource usage of
+        each executed command (see Executor) into the backup directory.
+
+        """
+        stats = [c.getStats() for c in self.executor.executed]
+        # filter name -> [entries, bytes] skipped by built-in actions
+        skipped = {}
+        for s in stats:
+            for rule, (entries, size) in s.get("skipped", {}).items():
+                counts = skipped.setdefault(rule, [0, 0])
+                counts[0] += entries
+                counts[1] += size
+        report = {"start": self.startTime.isoformat(),
+                  "end": endTime.isoformat(),
+                  "duration": (endTime - self.startTime).seconds,
+                  "retCode": retCode,
+                  "throttledTime": sum([s.get("throttledTime", 0)
+                                        for s in stats]),
+                  "skipped": skipped,
+                  "commands": stats}
+        fileName = os.path.join(self.dstDir, self.runReportFileName)
+        self.logger.info("Storing run report into '%s'" % fileName)
+        f = open(fileName, "w")
+        try:
+            json.dump(report, f, indent=4, sort_keys=True)
+        finally:
+            f.close()
+
+
+def syncTree(src, dst, verify=True):
+    """
+    Copy files of the src directory tree missing in dst or differing
+    in size or older there, copies are checked by size and with verify
+    also by CRC of the copy read back from the disk. Returns number of
+    copied files.
+
+    """
+    copied = 0
+    for dirPath, dirNames, fileNames in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(dirPath, src))
+        if not os.path.exists(target):
+            os.makedirs(target)
+        for fileName in fileNames:
+            s = os.path.join(dirPath, fileName)
+            t = os.path.join(target, fileName)
+            if (os.path.exists(t) and
+                    os.path.getsize(t) == os.path.getsize(s) and
+                    # copy2() does not preserve sub-microsecond mtime
+                    int(os.path.getmtime(t)) >= int(os.path.getmtime(s))):
+                continue
+            shutil.copy2(s, t)
+            # a bad copy is removed, not taken as up to date next time
+            if os.path.getsize(t) != os.path.getsize(s):
+                os.remove(t)
+                raise IOError("Copy '%s' differs in size from '%s'." %
+                              (t, s))
+            if verify and fileCrc(t, fromDisk=True) != fileCrc(s):
+                os.remove(t)
+                raise IOError("Copy '%s' differs from '%s'." % (t, s))
+            copied += 1
+    return copied
+
+
 def printUsage():
     print """
 backupper.py
@@ -444,21 +4405,88 @@ file. Destination directory and configuration file are mandatory arguments:
 
     -c, --config <XML configuration file>
     -d, --directory <destination directory to store archives into>
+        (may be given several times, the backup is then created in each
+        of them, every archive is read and compressed once and written
+        into all the directories at the same time)
+
+Optional arguments:
+
+    -w, --workers <number of archives processed in parallel, default 1>
+    --compress-threads <number of threads compressing each archive by
+        built-in actions (builtin-targz, builtin-gzip), default 1>
+    --sha256 (store sha256 sums of archives as well as md5 sums)
+    --codec-target <compression speed in MB/s the builtin-auto action
+        requires of the compression it chooses, default 10>
+    --resume <backup directory (BACKUP-...) of an interrupted run to be
+        completed, commands completed and verified are not run again,
+        used instead of -d, -d then gives only the mirror directories>
+    --order <directory|inode|extent> (order in which built-in actions
+        archive files - as found in directories (default), by inode
+        number or by physical location on the disk, the latter two
+        reduce seeking on rotational disks)
+    --drop-cache (built-in actions read source files with sequential
+        access hints and drop them from the page cache once archived,
+        so that the backup does not evict data of running services)
+    --no-verify-mirrors (copies of the backup in the further -d
+        directories are only checked by size, by default every copy is
+        read back from the disk and compared with the data written)
+    --bwlimit <MB/s>[,<HH:MM>-<HH:MM>=<MB/s>,...]
+        (limit of the rate of data read by the archive commands, shared
+        by all of them, 0 is no limit, optionally different in time of
+        day windows, e.g. 5,22:00-06:00=0 - 5 MB/s except at night,
+        <commonDirs bwlimit="..."> overrides it for its archives)
+    --event-loop (run the commands (up to --workers at the same time) in
+        a single thread event loop, progress with throughput and
+        estimated time to finish is logged and stored into status.json
+        in the backup directory while running)
+    --plan (dry run, only print size of the archives as estimated before
+        each backup, order in which they are created and estimated
+        finish time)
+    --incremental <maximum number of incremental backups between full
+        ones, only new and changed files are archived by built-in
+        actions, manifests are kept in the 'manifests' subdirectory of
+        the destination directory>
+
+Restore, catalog queries and chunk store (builtin-dedup action)
+maintenance, no backup is run:
+
+    --restore <recipe file> --output <tar file>
+        (restore archive stored in the chunk store)
+    --restore <archive> --member <path> --output <directory>
+        (extract a file or a directory of a builtin-seekable archive,
+        only the parts of the archive containing it are decompressed)
+    --find <path prefix or glob pattern> -d <destination directory>
+        (list versions of matching files archived by the backups in the
+        directory with their backup and archive, members are looked up
+        in the catalog updated by each backup, * matches / as well)
+    --gc -d <destination directory>
+        (remove chunks not referenced by any backup in the directory,
+        not to be run while a backup is running)
 """
 
 
 def getOptions(inputArgs):
     """
     Process command line options and get destination directory and XML
-    configuration file. Check validity of the arguments.
+    configuration file and dictionary of optional settings. Check
+    validity of the arguments.
 
     """
     config = ""
     dstDir = ""
+    opts = {"workers": 1, "compressThreads": 1, "digests": ["md5"],
+            "codecTarget": 10}
 
     try:
-        options, args = getopt.getopt(inputArgs, "hc:d:",
-                                      ["help", "config=", "directory="])
+        options, args = getopt.getopt(inputArgs, "hc:d:w:",
+                                      ["help", "config=", "directory=",
+                                       "workers=", "compress-threads=",
+                                       "sha256", "incremental=",
+                                       "restore=", "output=", "gc",
+                                       "codec-target=", "resume=",
+                                       "member=", "plan", "bwlimit=",
+                                       "drop-cache", "order=", "find=",
+                                       "event-loop", "no-verify-mirrors"])
     except getopt.GetoptError:
         print "Incorrect command line options, try --help"
         sys.exit(1)
@@ -476,40 +4504,204 @@ def getOptions(inputArgs):
                     print "Can't open file '%s', reason: %s" % (a, ex)
                     sys.exit(1)
             elif o in ("-d", "--directory"):
-                dstDir = a
-                if not (os.path.exists(dstDir) and os.path.isdir(dstDir)):
+                if not (os.path.exists(a) and os.path.isdir(a)):
                     print ("'%s' is neither a directory or does not "
-                           "exist, exit." % dstDir)
+                           "exist, exit." % a)
+                    sys.exit(1)
+                if dstDir:
+                    # further destinations mirror the first one
+                    opts.setdefault("mirrors", []).append(a)
+                else:
+                    dstDir = a
+            elif o in ("-w", "--workers"):
+                try:
+                    opts["workers"] = int(a)
+                    assert opts["workers"] > 0
+                except (ValueError, AssertionError):
+                    print "Wrong number of workers '%s', exit." % a
+                    sys.exit(1)
+            elif o == "--compress-threads":
+                try:
+                    opts["compressThreads"] = int(a)
+                    assert opts["compressThreads"] > 0
+                except (ValueError, AssertionError):
+                    print "Wrong number of compress threads '%s', exit." % a
+                    sys.exit(1)
+            elif o == "--sha256":
+                opts["digests"] = ["md5", "sha256"]
+            elif o == "--incremental":
+                try:
+                    opts["incremental"] = int(a)
+                    assert opts["incremental"] >= 0
+                except (ValueError, AssertionError):
+                    print "Wrong number of incremental backups '%s', exit." % a
                     sys.exit(1)
+            elif o == "--codec-target":
+                try:
+                    opts["codecTarget"] = float(a)
+                except ValueError:
+                    print "Wrong compression speed '%s', exit." % a
+                    sys.exit(1)
+            elif o == "--resume":
+                opts["resume"] = os.path.abspath(a)
+                if not os.path.isdir(opts["resume"]):
+                    print "'%s' is not a directory, exit." % a
+                    sys.exit(1)
+            elif o == "--restore":
+                opts["restore"] = a
+            elif o == "--output":
+                opts["output"] = a
+            elif o == "--member":
+                opts["member"] = a
+            elif o == "--gc":
+                opts["gc"] = True
+            elif o == "--find":
+                opts["find"] = a
+            elif o == "--plan":
+                opts["plan"] = True
+            elif o == "--event-loop":
+                opts["eventLoop"] = True
+            elif o == "--no-verify-mirrors":
+                opts["verifyMirrors"] = False
+            elif o == "--order":
+                if a not in ARCHIVE_ORDERS:
+                    print "Wrong archive order '%s', exit." % a
+                    sys.exit(1)
+                opts["order"] = a
+            elif o == "--drop-cache":
+                if not libc:
+                    print "posix_fadvise is not available, exit."
+                    sys.exit(1)
+                opts["dropCache"] = True
+            elif o == "--bwlimit":
+                try:
+                    BandwidthLimit(a)
+                except ValueError, ex:
+                    print "Wrong bandwidth limit '%s' (%s), exit." % (a, ex)
+                    sys.exit(1)
+                opts["bwlimit"] = a
+
+    if opts.get("restore"):
+        if not opts.get("output"):
+            print "--restore requires --output, try --help"
+            sys.exit(1)
+        return (config, dstDir, opts)
+    if opts.get("gc") or opts.get("find"):
+        if not dstDir:
+            print ("--gc and --find require destination directory, "
+                   "try --help")
+            sys.exit(1)
+        return (config, dstDir, opts)
 
-    if not config or not dstDir:
+    if not config or not (dstDir or opts.get("resume")):
         print "Mandatory arguments not provided, try --help"
         sys.exit(0)
 
-    return (config, dstDir)
+    return (config, dstDir, opts)
 
 
 def main():
     print "%s backup script, raw arguments: %s" % (sys.argv[0], sys.argv[1:])
 
     # get XML configuration file and destination directory for the backup
-    (config, dstDir) = getOptions(sys.argv[1:])
+    (config, dstDir, opts) = getOptions(sys.argv[1:])
+
+    if opts.get("restore") and opts.get("member"):
+        try:
+            count = extractMembers(opts["restore"], opts["member"],
+                                   opts["output"])
+        except Exception, ex:
+            print "Restore failed, reason: %s" % ex
+            sys.exit(1)
+        print "Extracted %s members into '%s'" % (count, opts["output"])
+        sys.exit(0)
+    if opts.get("restore"):
+        try:
+            size = restoreRecipe(opts["restore"], opts["output"])
+        except Exception, ex:
+            print "Restore failed, reason: %s" % ex
+            sys.exit(1)
+        print "Restored %s bytes into '%s'" % (size, opts["output"])
+        sys.exit(0)
+    if opts.get("find"):
+        fileName = os.path.join(dstDir, CATALOG_FILE)
+        if not os.path.exists(fileName):
+            print "No catalog '%s', exit." % fileName
+            sys.exit(1)
+        catalog = Catalog(fileName)
+        try:
+            for backup, date, archive, path, size, mtime in \
+                    catalog.find(opts["find"]):
+                mtime = datetime.datetime.fromtimestamp(mtime)
+                print "%s  %s  %12s  %s  %s" % (backup, archive, size,
+                                                mtime.isoformat(), path)
+        finally:
+            catalog.close()
+        sys.exit(0)
+    if opts.get("gc"):
+        logging.basicConfig(level=logging.INFO)
+        logger = logging.getLogger("backupper")
+        try:
+            collectChunkGarbage(os.path.abspath(dstDir), logger)
+        except Exception, ex:
+            logger.fatal("Garbage collection failed, reason: %s" % ex)
+            sys.exit(1)
+        sys.exit(0)
+
+    if opts.get("plan"):
+        logging.basicConfig(level=logging.WARNING)
+        logger = logging.getLogger("backupper")
+        try:
+            xmlProc = XMLInputProcessor(config, os.path.abspath(dstDir),
+                                        logger, opts)
+            planner = Planner(logger)
+            planner.plan(xmlProc.process(createDirs=False),
+                         opts["workers"])
+        except Exception, ex:
+            print "Planning failed, reason: %s" % ex
+            sys.exit(1)
+        print "\n".join(planner.report)
+        sys.exit(0)
+
     print("Using XML configuration file: '%s', destination "
           "directory: '%s'" % (config, dstDir))
 
-    # get date and time and create final destination directory
-    dtFormat = "%Y-%m-%d-%Hh-%Mm-%Ss"
-    dt = time.strftime(dtFormat, time.localtime()) # now
-    dstDir = os.path.join(os.path.abspath(dstDir), "".join(["BACKUP-", dt]))
-    print "Final destination directory: '%s'" % dstDir
-    try:
-        os.mkdir(dstDir)
-    except OSError, ex:
-        print "Could not create directory '%s', reason: %s" % (dstDir, ex)
-        sys.exit(1)
+    mirrorRoots = opts.get("mirrors", [])
+    if opts.get("resume"):
+        # continue in the directory of the interrupted backup, -d gives
+        # only the mirrors then
+        if dstDir:
+            mirrorRoots = [dstDir] + mirrorRoots
+        dstDir = opts["resume"]
+        print "Resuming in destination directory: '%s'" % dstDir
+    else:
+        # get date and time and create final destination directory
+        dtFormat = "%Y-%m-%d-%Hh-%Mm-%Ss"
+        dt = time.strftime(dtFormat, time.localtime()) # now
+        dstDir = os.path.join(os.path.abspath(dstDir),
+                              "".join(["BACKUP-", dt]))
+        print "Final destination directory: '%s'" % dstDir
+        try:
+            os.mkdir(dstDir)
+        except OSError, ex:
+            print "Could not create directory '%s', reason: %s" % (dstDir, ex)
+            sys.exit(1)
+    # mirror backup directories are named the same as dstDir
+    opts["mirrors"] = []
+    for mirror in mirrorRoots:
+        mirror = os.path.join(os.path.abspath(mirror),
+                              os.path.basename(dstDir))
+        print "Mirror destination directory: '%s'" % mirror
+        try:
+            if not os.path.exists(mirror):
+                os.mkdir(mirror)
+        except OSError, ex:
+            print "Could not create directory '%s', reason: %s" % (mirror, ex)
+            sys.exit(1)
+        opts["mirrors"].append(mirror)
 
     try:
-        backupper = Backupper(config, dstDir)
+        backupper = Backupper(config, dstDir, opts)
     except Exception, ex:
         print ex
         sys.exit(1)
@@ -0,0 +1,486 @@
+#!/usr/bin/env python2
+
+"""
+Benchmark of the backupper pipeline on synthetic source trees.
+Usage: run with --help
+
+Generates source trees of different shapes (many tiny files, a few huge
+files, deep nesting, incompressible and text data), backs each of them
+up by XMLInputProcessor + Executor (XML configuration generated) with
+the shell actions (tar, gzip, gzip -t, md5sum) as well as with the
+built-in action (also archiving files in inode and in physical order)
+and reports throughput (MB/s, files/s) of each stage. Source trees are
+dropped from the page cache before each run.
+Results are stored as JSON, two result files may be compared.
+With --cache, page cache residency of the archived tree and of a "hot"
+file set (read just before the backup, as data of a running service)
+is measured after the built-in backup with and without --drop-cache.
+With --scaling, the built-in backup is run with 1, 2, 4, ... compress
+threads (up to twice the number of CPUs, at least 4) and its throughput
+and speedup against a single thread are reported.
+
+Generated trees are kept in the working directory and reused by
+subsequent runs with the same scale.
+
+Author: Zdenek Maxa
+
+"""
+
+
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import getopt
+import logging
+import platform
+import multiprocessing
+import ctypes
+
+# backupper.py lives next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from backupper import XMLInputProcessor, Executor, Command
+from backupper import libc, fadvise, POSIX_FADV_DONTNEED
+
+
+SHELL_ACTIONS = ("tar -cvf %(archive)s %(exclude)s %(dir)s, "
+                 "gzip %(archive)s, gzip -t %(zipArchive)s")
+# stages of the shell actions in the order of the commands
+SHELL_STAGES = ("archive", "compress", "verify")
+# built-in action does everything in a single pass
+BUILTIN_STAGE = "archive+compress+verify+checksum"
+MB = 1024 * 1024
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+WORDS = ("backup", "archive", "directory", "file", "the", "of", "and",
+         "data", "system", "configuration", "zdenek", "log", "error",
+         "time", "value", "disk", "compress", "tar", "python", "a", "is")
+
+
+def writeRandomFile(fileName, size, rnd, text):
+    f = open(fileName, "wb")
+    try:
+        while size > 0:
+            n = min(size, MB)
+            if text:
+                words = [rnd.choice(WORDS) for i in xrange(n / 5 + 1)]
+                data = " ".join(words)[:n]
+            else:
+                data = os.urandom(n)
+            f.write(data)
+            size -= n
+    finally:
+        f.close()
+
+
+def generateTiny(root, scale, rnd):
+    # many small text files in a flat-ish structure
+    for i in xrange(int(20000 * scale)):
+        d = os.path.join(root, "dir%03d" % (i % 100))
+        if not os.path.exists(d):
+            os.mkdir(d)
+        writeRandomFile(os.path.join(d, "file%06d.txt" % i),
+                        rnd.randint(100, 2000), rnd, True)
+
+
+def generateHuge(root, scale, rnd):
+    # a few big files, half text half incompressible
+    for i in range(4):
+        writeRandomFile(os.path.join(root, "huge%d.bin" % i),
+                        int(64 * MB * scale), rnd, i % 2 == 0)
+
+
+def generateDeep(root, scale, rnd):
+    # deeply nested directories, few files on each level
+    for branch in range(int(20 * scale) or 1):
+        d = os.path.join(root, "branch%02d" % branch)
+        for level in range(50):
+            d = os.path.join(d, "level%02d" % level)
+            os.makedirs(d)
+            for i in range(3):
+                writeRandomFile(os.path.join(d, "f%d.txt" % i),
+                                rnd.randint(1000, 20000), rnd, True)
+
+
+def generateRandom(root, scale, rnd):
+    # incompressible data (e.g. photos, videos)
+    for i in xrange(int(64 * scale) or 1):
+        writeRandomFile(os.path.join(root, "random%04d.bin" % i), MB,
+                        rnd, False)
+
+
+def generateText(root, scale, rnd):
+    # well compressible data (e.g. logs, sources)
+    for i in xrange(int(64 * scale) or 1):
+        writeRandomFile(os.path.join(root, "text%04d.txt" % i), MB,
+                        rnd, True)
+
+
+def generateHot(root, scale, rnd):
+    # working set of a service, not archived
+    for i in xrange(int(32 * scale) or 1):
+        writeRandomFile(os.path.join(root, "hot%04d.dat" % i), MB,
+                        rnd, True)
+
+
+TREES = (("tiny", generateTiny),
+         ("huge", generateHuge),
+         ("deep", generateDeep),
+         ("random", generateRandom),
+         ("text", generateText))
+
+
+def getTree(workDir, name, generator, scale):
+    """
+    Returns (path, number of files, bytes) of the source tree, generates
+    the tree unless it exists already with the same scale.
+
+    """
+    root = os.path.join(workDir, "trees", name)
+    marker = os.path.join(workDir, "trees", "%s.scale" % name)
+    if not (os.path.exists(marker) and
+            open(marker).read() == repr(scale)):
+        print "Generating '%s' tree ..." % name
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        os.makedirs(root)
+        generator(root, scale, random.Random(name))
+        f = open(marker, "w")
+        f.write(repr(scale))
+        f.close()
+    files, size = 0, 0
+    for dirPath, dirNames, fileNames in os.walk(root):
+        for fileName in fileNames:
+            files += 1
+            size += os.path.getsize(os.path.join(dirPath, fileName))
+    return root, files, size
+
+
+def writeConfig(fileName, srcRoot, name, actions):
+    f = open(fileName, "w")
+    f.write('<backup>\n'
+            '  <commonDirs destination="bench" changeTo="%s">\n'
+            '    <dir archiveName="%s" srcDir="%s" actions="%s"/>\n'
+            '  </commonDirs>\n'
+            '</backup>\n' % (srcRoot, name, name, actions))
+    f.close()
+
+
+def runPipeline(workDir, tree, pipeline, logger, compressThreads,
+                dropCache=False):
+    """
+    Back up the tree by the pipeline, returns (stage, seconds) list.
+
+    """
+    name, root, files, size = tree
+    dstDir = os.path.join(workDir, "dst")
+    if os.path.exists(dstDir):
+        shutil.rmtree(dstDir)
+    os.makedirs(dstDir)
+    config = os.path.join(workDir, "bench.xml")
+    actions = SHELL_ACTIONS
+    if pipeline != "shell":
+        actions = "builtin-targz"
+    writeConfig(config, os.path.dirname(root), name, actions)
+
+    options = {"compressThreads": compressThreads, "dropCache": dropCache}
+    if pipeline in ("builtin-inode", "builtin-extent"):
+        options["order"] = pipeline.split("-")[1]
+    commands = XMLInputProcessor(config, dstDir, logger, options).process()
+    executor = Executor(dstDir, logger)
+    if pipeline == "shell":
+        # md5sum as Backupper.generateMD5Sums runs it
+        c = Command(dstDir)
+        c.setCommand("md5sum bench/%s.tar.gz" % name)
+        commands.append(c)
+        stages = SHELL_STAGES + ("checksum", )
+    else:
+        stages = (BUILTIN_STAGE, )
+    executor.execute(commands)
+    result = []
+    for stage, c in zip(stages, commands):
+        stats = c.getStats()
+        if not stats or stats["exitStatus"]:
+            raise Exception("'%s' failed, see the log." % c.getCommand())
+        result.append((stage, stats["wallTime"]))
+    shutil.rmtree(dstDir)
+    return result
+
+
+def runBenchmark(workDir, scale, treeNames, logger):
+    cpus = multiprocessing.cpu_count()
+    pipelines = (("shell", 1), ("builtin", 1), ("builtin-parallel", cpus),
+                 ("builtin-inode", 1), ("builtin-extent", 1))
+    results = []
+    for name, generator in TREES:
+        if treeNames and name not in treeNames:
+            continue
+        root, files, size = getTree(workDir, name, generator, scale)
+        for pipeline, threads in pipelines:
+            if pipeline == "builtin-parallel" and threads == 1:
+                continue
+            print "Running '%s' pipeline on '%s' tree ..." % (pipeline, name)
+            setCached(root, False)
+            stages = runPipeline(workDir, (name, root, files, size),
+                                 pipeline, logger, threads)
+            for stage, seconds in stages:
+                seconds = max(seconds, 1e-6)
+                results.append({"tree": name,
+                                "pipeline": pipeline,
+                                "stage": stage,
+                                "files": files,
+                                "bytes": size,
+                                "seconds": seconds,
+                                "MBps": size / seconds / MB,
+                                "filesps": files / seconds})
+    return results
+
+
+def getThreadCounts(cpus):
+    counts = [1]
+    while counts[-1] < max(4, 2 * cpus):
+        counts.append(2 * counts[-1])
+    return counts
+
+
+def runScalingBenchmark(workDir, scale, treeNames, logger):
+    results = []
+    for name, generator in TREES:
+        if treeNames and name not in treeNames:
+            continue
+        root, files, size = getTree(workDir, name, generator, scale)
+        single = None
+        for threads in getThreadCounts(multiprocessing.cpu_count()):
+            print ("Running 'builtin' pipeline with %s compress threads "
+                   "on '%s' tree ..." % (threads, name))
+            setCached(root, False)
+            stages = runPipeline(workDir, (name, root, files, size),
+                                 "builtin", logger, threads)
+            seconds = max(stages[0][1], 1e-6)
+            single = single or seconds
+            results.append({"tree": name,
+                            "threads": threads,
+                            "MBps": size / seconds / MB,
+                            "speedup": single / seconds})
+    return results
+
+
+def newReport(scale):
+    return {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "cpus": multiprocessing.cpu_count(),
+            "scale": scale,
+            "results": []}
+
+
+def getFiles(root):
+    for dirPath, dirNames, fileNames in os.walk(root):
+        for fileName in fileNames:
+            yield os.path.join(dirPath, fileName)
+
+
+def getResidency(root):
+    """
+    Returns fraction of pages of files under root which are in the page
+    cache (mincore() of the mapped files).
+
+    """
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                          ctypes.c_int, ctypes.c_int, ctypes.c_int64]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_char_p]
+    resident, total = 0, 0
+    for fileName in getFiles(root):
+        size = os.path.getsize(fileName)
+        if not size:
+            continue
+        pages = (size + PAGE_SIZE - 1) / PAGE_SIZE
+        fd = os.open(fileName, os.O_RDONLY)
+        try:
+            # PROT_READ, MAP_SHARED
+            addr = libc.mmap(None, size, 1, 1, fd, 0)
+            if addr in (None, ctypes.c_void_p(-1).value):
+                raise OSError(ctypes.get_errno(), "mmap failed")
+            try:
+                vec = ctypes.create_string_buffer(pages)
+                if libc.mincore(addr, size, vec):
+                    raise OSError(ctypes.get_errno(), "mincore failed")
+                resident += len([c for c in vec.raw if ord(c) & 1])
+            finally:
+                libc.munmap(addr, size)
+        finally:
+            os.close(fd)
+        total += pages
+    return resident / float(total or 1)
+
+
+def setCached(root, cached):
+    # read the files into the page cache or drop them from it
+    for fileName in getFiles(root):
+        f = open(fileName, "rb")
+        try:
+            if cached:
+                while f.read(MB):
+                    pass
+            else:
+                fadvise(f.fileno(), POSIX_FADV_DONTNEED)
+        finally:
+            f.close()
+
+
+def runCacheBenchmark(workDir, scale, treeNames, logger):
+    hot = getTree(workDir, "hot", generateHot, scale)[0]
+    results = []
+    for name, generator in TREES:
+        if treeNames and name not in treeNames:
+            continue
+        root, files, size = getTree(workDir, name, generator, scale)
+        for dropCache in (False, True):
+            mode = "drop-cache" if dropCache else "default"
+            print "Running '%s' mode on '%s' tree ..." % (mode, name)
+            setCached(root, False)
+            setCached(hot, True)
+            hotBefore = getResidency(hot)
+            stages = runPipeline(workDir, (name, root, files, size),
+                                 "builtin", logger, 1, dropCache)
+            seconds = max(stages[0][1], 1e-6)
+            results.append({"tree": name,
+                            "mode": mode,
+                            "MBps": size / seconds / MB,
+                            "hotBefore": hotBefore,
+                            "hotAfter": getResidency(hot),
+                            "sourceAfter": getResidency(root)})
+    return results
+
+
+def printCacheResults(report):
+    print "\n%-8s %-11s %8s %12s %11s %14s" % ("tree", "mode", "MB/s",
+        "hot before", "hot after", "source after")
+    for r in report["cache"]:
+        print "%-8s %-11s %8.1f %11.1f%% %10.1f%% %13.1f%%" % (r["tree"],
+            r["mode"], r["MBps"], 100 * r["hotBefore"],
+            100 * r["hotAfter"], 100 * r["sourceAfter"])
+
+
+def printScalingResults(report):
+    print "\n%s CPUs" % report["cpus"]
+    print "%-8s %8s %8s %8s" % ("tree", "threads", "MB/s", "speedup")
+    for r in report["scaling"]:
+        print "%-8s %8d %8.1f %7.2fx" % (r["tree"], r["threads"], r["MBps"],
+                                         r["speedup"])
+
+
+def printResults(report):
+    print "\n%-8s %-17s %-33s %10s %10s" % ("tree", "pipeline", "stage",
+                                           "MB/s", "files/s")
+    for r in report["results"]:
+        print "%-8s %-17s %-33s %10.1f %10.1f" % (r["tree"], r["pipeline"],
+            r["stage"], r["MBps"], r["filesps"])
+
+
+def compareResults(oldFile, newFile):
+    old, new = [json.load(open(f)) for f in (oldFile, newFile)]
+    key = lambda r: (r["tree"], r["pipeline"], r["stage"])
+    oldResults = dict([(key(r), r) for r in old["results"]])
+    print "%-8s %-17s %-33s %9s %9s %8s" % ("tree", "pipeline", "stage",
+                                           "old MB/s", "new MB/s", "change")
+    for r in new["results"]:
+        o = oldResults.get(key(r))
+        if not o:
+            continue
+        change = 100.0 * (r["MBps"] - o["MBps"]) / o["MBps"]
+        print "%-8s %-17s %-33s %9.1f %9.1f %+7.1f%%" % (r["tree"],
+            r["pipeline"], r["stage"], o["MBps"], r["MBps"], change)
+
+
+def printUsage():
+    print """
+benchmark.py
+
+Benchmark of the backupper pipeline (see the module documentation).
+
+    -w, --workdir <directory for generated trees and backups>
+    -o, --output <JSON file to store results into>
+    -s, --scale <size factor of the generated trees, default 1.0>
+    -t, --trees <comma separated subset of: %s>
+    -v, --verbose (log commands run)
+    -c, --cache (measure page cache residency instead of throughput)
+    --scaling (measure throughput of the built-in action by the number
+        of compress threads)
+    --compare <old JSON results> <new JSON results>
+""" % ",".join([name for name, generator in TREES])
+
+
+def main():
+    try:
+        options, args = getopt.getopt(sys.argv[1:], "hw:o:s:t:vc",
+                                      ["help", "workdir=", "output=",
+                                       "scale=", "trees=", "verbose",
+                                       "compare", "cache", "scaling"])
+    except getopt.GetoptError:
+        print "Incorrect command line options, try --help"
+        sys.exit(1)
+
+    workDir, output, scale, treeNames = None, None, 1.0, None
+    cache, scaling = False, False
+    level = logging.WARNING
+    for o, a in options:
+        if o in ("-h", "--help"):
+            printUsage()
+            sys.exit(0)
+        elif o in ("-w", "--workdir"):
+            workDir = os.path.abspath(a)
+        elif o in ("-o", "--output"):
+            output = a
+        elif o in ("-s", "--scale"):
+            scale = float(a)
+        elif o in ("-t", "--trees"):
+            treeNames = [t.strip() for t in a.split(",")]
+        elif o in ("-v", "--verbose"):
+            level = logging.DEBUG
+        elif o in ("-c", "--cache"):
+            if not libc:
+                print "C library calls are not available, exit."
+                sys.exit(1)
+            cache = True
+        elif o == "--scaling":
+            scaling = True
+        elif o == "--compare":
+            if len(args) != 2:
+                print "--compare requires two result files, try --help"
+                sys.exit(1)
+            compareResults(args[0], args[1])
+            sys.exit(0)
+
+    if not workDir or not output:
+        print "Mandatory arguments not provided, try --help"
+        sys.exit(1)
+    if not os.path.exists(workDir):
+        os.makedirs(workDir)
+
+    logging.basicConfig(level=level)
+    logger = logging.getLogger("benchmark")
+    report = newReport(scale)
+    if cache:
+        report["cache"] = runCacheBenchmark(workDir, scale, treeNames,
+                                            logger)
+        printCacheResults(report)
+    elif scaling:
+        report["scaling"] = runScalingBenchmark(workDir, scale, treeNames,
+                                                logger)
+        printScalingResults(report)
+    else:
+        report["results"] = runBenchmark(workDir, scale, treeNames, logger)
+        printResults(report)
+    f = open(output, "w")
+    json.dump(report, f, indent=4, sort_keys=True)
+    f.close()
+    print "\nResults stored into '%s'" % output
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1198 @@
+"""
+tests for backupper.py
+
+"""
+
+import os
+import sys
+import errno
+import stat
+import time
+import json
+import gzip
+import zlib
+import fcntl
+import threading
+import random
+import hashlib
+import tarfile
+import subprocess
+import logging
+from StringIO import StringIO
+
+import py.test
+
+import backupper
+from backupper import Command
+from backupper import Executor
+from backupper import EventExecutor
+from backupper import GzipWriter
+from backupper import ParallelGzipWriter
+from backupper import CompressCommand
+from backupper import ArchiveCommand
+from backupper import SeekableArchiveCommand
+from backupper import AutoArchiveCommand
+from backupper import CodecWriter
+from backupper import FanOutWriter
+from backupper import DigestWriter
+from backupper import syncTree
+from backupper import ArchiveIndex
+from backupper import extractMembers
+from backupper import Manifest
+from backupper import Journal
+from backupper import ChunkStore
+from backupper import ChunkStoreWriter
+from backupper import restoreRecipe
+from backupper import BandwidthLimit
+from backupper import BuiltinTask
+from backupper import DirFilters
+from backupper import Backupper
+from backupper import XMLInputProcessor
+from backupper import Planner
+from backupper import Catalog
+
+
+logger = logging.getLogger("test_backupper")
+
+
+class Output(object):
+    # stdout of built-in commands (member names)
+
+    def __init__(self):
+        self.lines = 0
+        self.data = []
+
+    def write(self, data):
+        self.lines += data.count("\n")
+        self.data.append(data)
+
+
+def writeFile(fileName, data):
+    dirName = os.path.dirname(fileName)
+    if not os.path.exists(dirName):
+        os.makedirs(dirName)
+    f = open(fileName, "wb")
+    f.write(data)
+    f.close()
+
+
+def readFile(fileName):
+    f = open(fileName, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def getData(size, seed=0):
+    # half compressible data, the same for the same seed
+    rnd = random.Random(seed)
+    words = ["backup", "archive", "tar", "gzip", "%s" % seed]
+    text = " ".join([rnd.choice(words) for i in xrange(size / 10)])
+    noise = [hashlib.md5("%s %s" % (seed, i)).digest()
+             for i in xrange(size / 16 + 1)]
+    return "".join([text] + noise)[:size]
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+def test_gzip_writer():
+    data = getData(3 * 1024 * 1024 + 123)
+    out = StringIO()
+    gz = GzipWriter(out, blockSize=256 * 1024)
+    gz.write(data[:1000])
+    # stored part in the middle of the stream
+    gz.setLevel(0)
+    gz.write(data[1000:500000])
+    gz.setLevel(6)
+    gz.write(data[500000:])
+    gz.close()
+    assert gunzip(out.getvalue()) == data
+
+    # empty input
+    out = StringIO()
+    GzipWriter(out).close()
+    assert gunzip(out.getvalue()) == ""
+
+
+def test_gzip_writer_verification():
+    class BrokenVerifier(object):
+        def decompress(self, data):
+            return "corrupted"
+
+    gz = GzipWriter(StringIO(), blockSize=1024)
+    gz.verifier = BrokenVerifier()
+    py.test.raises(IOError, gz.write, getData(4096))
+
+
+def test_parallel_gzip_writer():
+    data = getData(3 * 1024 * 1024 + 123)
+    for threads in (1, 3):
+        out = StringIO()
+        gz = ParallelGzipWriter(out, blockSize=256 * 1024, threads=threads,
+                                frames=True)
+        for i in range(0, len(data), 10000):
+            gz.write(data[i:i + 10000])
+        gz.close()
+        assert gunzip(out.getvalue()) == data
+        # each frame is a gzip member on its own
+        starts = [start for start, compressed in gz.frames]
+        assert starts == range(0, len(data), 256 * 1024)
+        start, compressed = gz.frames[3]
+        member = gzip.GzipFile(fileobj=StringIO(out.getvalue()[compressed:]))
+        assert member.read(1000) == data[start:start + 1000]
+
+    out = StringIO()
+    ParallelGzipWriter(out).close()
+    assert gunzip(out.getvalue()) == ""
+
+
+def test_parallel_gzip_writer_verification(monkeypatch):
+    monkeypatch.setattr(zlib, "decompress",
+                        lambda data, wbits: "corrupted")
+    gz = ParallelGzipWriter(StringIO(), blockSize=1024, threads=2)
+    gz.write(getData(4096))
+    py.test.raises(IOError, gz.close)
+
+
+class CorruptingFanOutWriter(FanOutWriter):
+    """
+    Flips the first byte of every block written into the last copy.
+
+    """
+
+    def _writer(self, f, q, result):
+        if f.name == self.fileNames[-1]:
+            f.close()
+            f = CorruptingFile(f.name, "wb")
+        FanOutWriter._writer(self, f, q, result)
+
+
+class CorruptingFile(file):
+    def write(self, data):
+        file.write(self, chr(ord(data[0]) ^ 0xff) + data[1:])
+
+
+class FailingFanOutWriter(CorruptingFanOutWriter):
+    """
+    Writing the last copy fails (e.g. full disk).
+
+    """
+
+    def _writer(self, f, q, result):
+        if f.name == self.fileNames[-1]:
+            f.close()
+            f = FailingFile(f.name, "wb")
+        FanOutWriter._writer(self, f, q, result)
+
+
+class FailingFile(file):
+    def write(self, data):
+        raise IOError("No space left on device")
+
+
+def test_fan_out_writer(tmpdir):
+    data = getData(3 * 1024 * 1024 + 123)
+    fileNames = [str(tmpdir.join("copy%s" % i)) for i in range(3)]
+    out = FanOutWriter(fileNames, maxPending=2, verify=True)
+    for i in range(0, len(data), 100000):
+        out.write(data[i:i + 100000])
+    out.close()
+    for fileName in fileNames:
+        assert readFile(fileName) == data
+
+    # same size, different content, detected only by reading it back
+    for verify in (False, True):
+        out = CorruptingFanOutWriter(fileNames, verify=verify)
+        out.write(data)
+        if verify:
+            py.test.raises(IOError, out.close)
+        else:
+            out.close()
+        assert readFile(fileNames[-1]) != data
+
+    out = FailingFanOutWriter(fileNames)
+    out.write(data)
+    ex = py.test.raises(IOError, out.close)
+    assert "No space left" in str(ex.value)
+
+
+def test_sync_tree(tmpdir, monkeypatch):
+    src, dst = tmpdir.join("src"), tmpdir.join("dst")
+    for name in ("a", "dir/b", "dir/sub/c"):
+        writeFile(str(src.join(name)), getData(1000, name))
+    assert syncTree(str(src), str(dst)) == 3
+    for name in ("a", "dir/b", "dir/sub/c"):
+        assert readFile(str(dst.join(name))) == getData(1000, name)
+    # up to date copies are not copied again
+    assert syncTree(str(src), str(dst)) == 0
+    writeFile(str(src.join("dir/b")), getData(2000, "b"))
+    assert syncTree(str(src), str(dst)) == 1
+    assert readFile(str(dst.join("dir/b"))) == getData(2000, "b")
+
+    # copy of the same size but different content
+    def corruptingCopy(s, t):
+        writeFile(t, readFile(s)[::-1])
+
+    monkeypatch.setattr(backupper.shutil, "copy2", corruptingCopy)
+    writeFile(str(src.join("d")), getData(1000, "d"))
+    py.test.raises(IOError, syncTree, str(src), str(dst))
+    assert not dst.join("d").exists()
+    assert syncTree(str(src), str(dst), verify=False) == 1
+
+
+def newArchiveCommand(tmpdir, archive, commandClass=ArchiveCommand):
+    c = commandClass(str(tmpdir))
+    c.setCommand("%s %s" % (commandClass.__name__, archive))
+    c.setSrcDir("src")
+    c.setArchive(str(tmpdir.join(archive)))
+    c.setOutputFile(str(tmpdir.join(archive)))
+    return c
+
+
+def getMembers(archive):
+    tar = tarfile.open(archive, "r")
+    try:
+        return dict([(m.name, tar.extractfile(m).read() if m.isreg()
+                      else None) for m in tar.getmembers()])
+    finally:
+        tar.close()
+
+
+def test_archive_command(tmpdir):
+    src = tmpdir.join("src")
+    for name in ("a.txt", "dir/b.txt", "dir/sub/c.jpg"):
+        writeFile(str(src.join(name)), getData(50000, name))
+    c = newArchiveCommand(tmpdir, "full.tar.gz")
+    out = Output()
+    c.run(out, logger)
+    members = getMembers(c.getOutputFile())
+    assert sorted(members) == ["src", "src/a.txt", "src/dir",
+                               "src/dir/b.txt", "src/dir/sub",
+                               "src/dir/sub/c.jpg"]
+    assert members["src/dir/b.txt"] == getData(50000, "dir/b.txt")
+    assert out.lines == 6
+    assert c.getDigests()["md5"] == backupper.fileDigest(c.getOutputFile(),
+                                                         "md5")
+
+
+class FailingReader(object):
+    # source file failing to be read (e.g. I/O error of the disk)
+
+    def __init__(self, path, *args, **kwargs):
+        pass
+
+    def read(self, size):
+        raise IOError("Input/output error")
+
+    def close(self):
+        pass
+
+
+def getWorkers():
+    return [t for t in threading.enumerate()
+            if t.name.startswith("gzip-")]
+
+
+def test_archive_command_failure(tmpdir, monkeypatch):
+    src = tmpdir.join("src")
+    for i in range(4):
+        writeFile(str(src.join("file%s" % i)), getData(300000, i))
+    monkeypatch.setattr(backupper, "SourceReader", FailingReader)
+    c = newArchiveCommand(tmpdir, "failed.tar.gz")
+    c.setThreads(3)
+    py.test.raises(IOError, c.run, Output(), logger)
+    # compressor threads are not left behind, neither is the archive
+    assert getWorkers() == []
+    assert not tmpdir.join("failed.tar.gz").exists()
+
+    writeFile(str(tmpdir.join("source.tar")), getData(3 * 1024 * 1024))
+    c = CompressCommand(str(tmpdir))
+    c.setThreads(3)
+    c.setSource(str(tmpdir.join("source.tar")))
+    c.setArchive(str(tmpdir.join("source.tar.gz")))
+    writes = []
+
+    def failingWrite(data):
+        writes.append(data)
+        if len(writes) == 2:
+            raise IOError("No space left on device")
+
+    monkeypatch.setattr(backupper.ParallelGzipWriter, "write",
+                        lambda self, data: failingWrite(data))
+    py.test.raises(IOError, c.run, Output(), logger)
+    assert getWorkers() == []
+
+
+def test_parallel_gzip_writer_abort():
+    gz = ParallelGzipWriter(StringIO(), blockSize=1024, threads=3)
+    gz.write(getData(100000))
+    gz.abort()
+    assert getWorkers() == [] and not gz.pending
+    # after a failed close as well
+    gz.abort()
+
+
+def test_source_reader(tmpdir, monkeypatch):
+    fileName = str(tmpdir.join("source"))
+    data = getData(10000)
+    writeFile(fileName, data)
+    calls = []
+    monkeypatch.setattr(backupper, "fadvise",
+                        lambda fd, *args: calls.append(args))
+    r = backupper.SourceReader(fileName, len(data), logger, readSize=4096)
+    assert r.read(3000) + r.read(10000) == data
+    r.close()
+    assert calls == []
+
+    r = backupper.SourceReader(fileName, len(data), logger, dropCache=True,
+                               readSize=4096)
+    assert r.read(10000) == data
+    r.close()
+    # read ahead of the next block, blocks read dropped, whole file on close
+    assert calls == [
+        (backupper.POSIX_FADV_SEQUENTIAL, ),
+        (backupper.POSIX_FADV_WILLNEED, 0, 4096),
+        (backupper.POSIX_FADV_DONTNEED, 0, 4096),
+        (backupper.POSIX_FADV_WILLNEED, 4096, 4096),
+        (backupper.POSIX_FADV_DONTNEED, 4096, 4096),
+        (backupper.POSIX_FADV_WILLNEED, 8192, 4096),
+        (backupper.POSIX_FADV_DONTNEED, 8192, 10000 - 8192),
+        (backupper.POSIX_FADV_WILLNEED, 10000, 4096),
+        (backupper.POSIX_FADV_DONTNEED, )]
+
+    # size of the tar header: shrunk file padded, grown file cut
+    r = backupper.SourceReader(fileName, 12000, logger)
+    assert r.read(12000) == data + "\0" * 2000
+    r.close()
+    r = backupper.SourceReader(fileName, 5000, logger)
+    assert r.read(12000) == data[:5000]
+    r.close()
+
+
+def test_get_physical_offset(tmpdir):
+    writeFile(str(tmpdir.join("empty")), "")
+    writeFile(str(tmpdir.join("data")), getData(100000))
+    os.system("sync")
+    try:
+        assert backupper.getPhysicalOffset(str(tmpdir.join("empty"))) == 0
+        assert backupper.getPhysicalOffset(str(tmpdir.join("data"))) > 0
+    except IOError, ex:
+        # file system without FIEMAP
+        assert ex.errno in (errno.ENOTTY, errno.EOPNOTSUPP)
+
+
+def checkWalkOrdered(c, batchSize):
+    c.batchSize = batchSize
+    entries = list(c.walkOrdered(logger))
+    names = [name for path, name, st in entries]
+    # every entry exactly once
+    assert sorted(names) == sorted([n for p, n, st in c.walk(logger)])
+    # directory before its content
+    for i, name in enumerate(names):
+        parent = os.path.dirname(name)
+        if parent:
+            assert names.index(parent) < i
+    return entries
+
+
+def test_walk_ordered(tmpdir, monkeypatch):
+    src = tmpdir.join("src")
+    for i in range(30):
+        writeFile(str(src.join("d%s" % (i % 4), "s%s" % (i % 3),
+                               "f%02d" % i)), "x")
+    c = newArchiveCommand(tmpdir, "ordered.tar.gz")
+    c.setOrder("inode")
+    for batchSize in (1, 5, 7, 1000):
+        entries = checkWalkOrdered(c, batchSize)
+    # single batch, files sorted by inode
+    inodes = [st.st_ino for path, name, st in entries
+              if not stat.S_ISDIR(st.st_mode)]
+    assert inodes == sorted(inodes)
+
+    # by physical offset, reversed order of the names here
+    monkeypatch.setattr(backupper, "getPhysicalOffset",
+                        lambda path: -int(path[-2:]))
+    c.setOrder("extent")
+    for batchSize in (1, 5, 7, 1000):
+        entries = checkWalkOrdered(c, batchSize)
+    files = [name[-3:] for path, name, st in entries
+             if not stat.S_ISDIR(st.st_mode)]
+    assert files == ["f%02d" % i for i in reversed(range(30))]
+
+    # not supported, inode order then
+    def notSupported(path):
+        raise IOError(errno.ENOTTY, "Inappropriate ioctl for device")
+
+    monkeypatch.setattr(backupper, "getPhysicalOffset", notSupported)
+    entries = checkWalkOrdered(c, 1000)
+    assert not c.useExtents
+    inodes = [st.st_ino for path, name, st in entries
+              if not stat.S_ISDIR(st.st_mode)]
+    assert inodes == sorted(inodes)
+
+
+def test_builtin_command_steps(tmpdir):
+    data = getData(1024 * 1024)
+    writeFile(str(tmpdir.join("src", "large.bin")), data)
+    # steps within a large member
+    c = newArchiveCommand(tmpdir, "large.tar.gz")
+    c.stepSize = 64 * 1024
+    steps = list(c.steps(Output(), logger))
+    assert len(steps) > 16
+    assert getMembers(c.getOutputFile())["src/large.bin"] == data
+
+    writeFile(str(tmpdir.join("large.tar")), data)
+    c = CompressCommand(str(tmpdir))
+    c.setSource(str(tmpdir.join("large.tar")))
+    c.setArchive(str(tmpdir.join("large.tar.gz")))
+    c.stepSize = 64 * 1024
+    steps = list(c.steps(Output(), logger))
+    assert len(steps) == 16
+    assert gunzip(readFile(c.getArchive())) == data
+    assert not os.path.exists(str(tmpdir.join("large.tar")))
+
+
+def test_bandwidth_limit():
+    def at(hhmm):
+        hours, minutes = [int(i) for i in hhmm.split(":")]
+        return time.mktime((2020, 1, 1, hours, minutes, 0, 0, 0, -1))
+
+    bw = BandwidthLimit("5, 22:00-06:00=0, 12:00-13:30=1.5, 23:00-24:00=2")
+    assert bw.rate == 5 * 1024 * 1024
+    assert bw.windows == [(22 * 60, 6 * 60, None),
+                          (12 * 60, 13 * 60 + 30, 1024 * 1024 * 3 / 2),
+                          (23 * 60, 24 * 60, 2 * 1024 * 1024)]
+    # window spanning midnight, the first matching one applies
+    for hhmm in ("22:00", "23:30", "00:00", "05:59"):
+        assert bw.getRate(at(hhmm)) is None
+    for hhmm in ("06:00", "11:59", "13:30", "21:59"):
+        assert bw.getRate(at(hhmm)) == 5 * 1024 * 1024
+    assert bw.getRate(at("12:00")) == 1024 * 1024 * 3 / 2
+    assert bw.getRate(at("13:29")) == 1024 * 1024 * 3 / 2
+    assert BandwidthLimit("0").getRate() is None
+
+    for spec in ("-1", "5,22:00-06:00=-1", "5,24:59-06:00=1",
+                 "5,22:00-25:00=1", "5,22:60-06:00=1", "5,22:00=1",
+                 "5,22:00-06:00", "5,22-06=1", "fast"):
+        py.test.raises(ValueError, BandwidthLimit, spec)
+
+
+def test_builtin_task_throttled(tmpdir):
+    # throttled command is rescheduled, the loop is never put to sleep
+    writeFile(str(tmpdir.join("src", "large.bin")), getData(2 * 1024 * 1024))
+    c = newArchiveCommand(tmpdir, "large.tar.gz")
+    c.setBwLimit(BandwidthLimit("2"))
+    task = BuiltinTask(c, Output(), logger)
+    start = time.time()
+    ok = None
+    while ok is None:
+        before = time.time()
+        ok = task.advance()
+        assert time.time() - before < 0.3
+    assert ok
+    assert time.time() - start > 0.7
+    assert c.throttledTime > 0.5
+
+
+def test_filters_skipped(tmpdir):
+    src = tmpdir.join("src")
+    writeFile(str(src.join("a.txt")), "a")
+    writeFile(str(src.join("big.bin")), getData(5000))
+    for i in range(10):
+        writeFile(str(src.join("build", "sub", "%s.o" % i)), "object")
+    c = newArchiveCommand(tmpdir, "filtered.tar.gz")
+    c.setFilters(DirFilters(ignore=["build/"], maxFileSize=1000))
+    c.run(Output(), logger)
+    assert sorted(getMembers(c.getOutputFile())) == ["src", "src/a.txt"]
+    # pruned directory is a single entry, its content is not walked
+    assert c.getSkipped() == {"ignore": [1, 0], "maxFileSize": [1, 5000]}
+
+    py.test.raises(ValueError, DirFilters(maxFileSize=1000).getTarOptions,
+                   logger)
+    assert DirFilters(ignore=["build/"]).getTarOptions(logger) == [
+        "--exclude build"]
+
+
+def writeConfig(tmpdir, dirs):
+    """
+    Returns name of the XML configuration of the <dir> elements (dicts of
+    attributes), sources in tmpdir, archives into "sys".
+
+    """
+    fileName = str(tmpdir.join("config.xml"))
+    elements = ["    <dir %s/>\n" % " ".join(['%s="%s"' % item
+                                              for item in sorted(d.items())])
+                for d in dirs]
+    writeFile(fileName, '<backup>\n  <commonDirs destination="sys" '
+                        'changeTo="%s">\n%s  </commonDirs>\n</backup>\n' %
+                        (tmpdir, "".join(elements)))
+    return fileName
+
+
+def test_filters_shell_actions(tmpdir):
+    src = tmpdir.join("src")
+    writeFile(str(src.join("a.txt")), "a")
+    writeFile(str(src.join("big.bin")), getData(5000))
+    tar = "tar -cf %(archive)s %(exclude)s %(dir)s"
+    config = writeConfig(tmpdir, [
+        {"srcDir": "src", "archiveName": "limited", "actions": tar,
+         "maxFileSize": "1K"},
+        {"srcDir": "src", "archiveName": "filtered", "actions": tar,
+         "skipExtensions": "bin"}])
+    dst = tmpdir.join("dst")
+    dst.ensure(dir=True)
+    # the directory tar can't filter is rejected, not the whole config
+    commands = XMLInputProcessor(config, str(dst), logger).process()
+    assert [c.getOutputFile() for c in commands] == [
+        str(dst.join("sys", "filtered.tar"))]
+    commands = Planner(logger).plan(commands)
+    Executor(str(dst), logger).execute(commands)
+    assert sorted(getMembers(commands[0].getOutputFile())) == [
+        "src", "src/a.txt"]
+    # counted by the planner for the shell action
+    assert commands[0].getStats()["skipped"] == {
+        "skipExtensions": [1, 5000]}
+
+
+def test_codec_writer_streams(tmpdir):
+    data = getData(300000)
+    out = StringIO()
+    w = CodecWriter(out, "bz2", 9)
+    w.write(data[:100000])
+    # new stream at the store level
+    w.setLevel(1)
+    w.write(data[100000:200000])
+    w.setLevel(9)
+    w.write(data[200000:])
+    w.close()
+    assert out.getvalue().count("BZh9") == 2
+    assert out.getvalue().count("BZh1") == 1
+    archive = str(tmpdir.join("data.bz2"))
+    writeFile(archive, out.getvalue())
+    p = subprocess.Popen(["bzip2", "-dc", archive], stdout=subprocess.PIPE)
+    assert p.communicate()[0] == data
+
+    out = StringIO()
+    w = CodecWriter(out, None, None)
+    w.write(data)
+    w.close()
+    assert out.getvalue() == data
+
+
+def test_auto_archive_sample(tmpdir):
+    src = tmpdir.join("src")
+    for i in range(20):
+        writeFile(str(src.join("%02d.txt" % i)), getData(1000, i))
+    writeFile(str(src.join("zz.jpg")), getData(100000))
+    c = newArchiveCommand(tmpdir, "auto.tar", AutoArchiveCommand)
+    sample, compressedShare = c.sample(logger)
+    assert len(sample) == 20 * 1000
+    assert compressedShare > 0.8
+    # the first entries only
+    c.sampleEntries = 6
+    sample, compressedShare = c.sample(logger)
+    assert len(sample) == 5 * 1000
+    assert compressedShare == 0
+    # sample size is split among the files
+    c.sampleEntries, c.sampleSize = 100, 4000
+    sample, compressedShare = c.sample(logger)
+    assert len(sample) == 20 * 200
+
+
+def test_auto_archive_choose_codec(tmpdir):
+    src = tmpdir.join("src")
+    for i in range(5):
+        writeFile(str(src.join("%02d.txt" % i)), "text %s\n" % i * 1000)
+    c = newArchiveCommand(tmpdir, "auto.tar", AutoArchiveCommand)
+    c.throughputTarget = 0
+    # a step per codec tried
+    assert len(list(c.chooseCodec(logger))) == len(c.codecs)
+    assert c.extension in [e for codec, l, e in c.codecs]
+    c.run(Output(), logger)
+    assert c.getOutputFile() == str(tmpdir.join("auto.tar" + c.extension))
+
+
+def test_auto_archive_store_level(tmpdir):
+    src = tmpdir.join("src")
+    for i in range(10):
+        writeFile(str(src.join("%02d.txt" % i)), "text %s\n" % i * 1000)
+        writeFile(str(src.join("%02d.jpg" % i)), getData(3000, i))
+    writeFile(str(src.join("zz.jpg")), getData(100000))
+    c = newArchiveCommand(tmpdir, "auto.tar", AutoArchiveCommand)
+    c.codecs = [("gzip", 6, ".gz")]
+    c.storeMinSize = 50000
+    levels = []
+    getCompressor = c.getCompressor
+
+    def recordingCompressor(fileobj):
+        compressor = getCompressor(fileobj)
+        setLevel = compressor.setLevel
+
+        def recordLevel(level):
+            levels.append(level)
+            setLevel(level)
+
+        compressor.setLevel = recordLevel
+        return compressor
+
+    c.getCompressor = recordingCompressor
+    c.run(Output(), logger)
+    assert c.codec == "gzip"
+    # small compressed files do not switch the level, the large one does
+    assert levels == [6] * 10 + [0]
+    assert getMembers(c.getOutputFile())["src/zz.jpg"] == getData(100000)
+
+
+def test_manifest_incremental(tmpdir):
+    src = tmpdir.join("src")
+    for name in ("a.txt", "b.txt", "dir/c.txt"):
+        writeFile(str(src.join(name)), getData(1000, name))
+    manifestFile = str(tmpdir.join("manifests", "src.manifest.gz"))
+    c = newArchiveCommand(tmpdir, "level0.tar.gz")
+    c.setIncremental(manifestFile, 3)
+    c.run(Output(), logger)
+    assert Manifest.load(manifestFile).level == 0
+    assert len(getMembers(c.getOutputFile())) == 5
+
+    # b.txt changed, dir/c.txt deleted, d.txt new
+    writeFile(str(src.join("b.txt")), getData(2000, "b.txt"))
+    os.remove(str(src.join("dir", "c.txt")))
+    writeFile(str(src.join("d.txt")), getData(1000, "d.txt"))
+    c = newArchiveCommand(tmpdir, "level1.tar.gz")
+    c.setIncremental(manifestFile, 3)
+    c.run(Output(), logger)
+    members = getMembers(c.getOutputFile())
+    # directories are always archived
+    assert sorted(members) == ["src", "src/b.txt", "src/d.txt", "src/dir"]
+    assert members["src/b.txt"] == getData(2000, "b.txt")
+    deleted = readFile(str(tmpdir.join("level1-deleted.log")))
+    assert deleted.splitlines() == ["src/dir/c.txt"]
+    manifest = Manifest.load(manifestFile)
+    assert manifest.level == 1
+    assert sorted(manifest.entries) == ["src", "src/a.txt", "src/b.txt",
+                                        "src/d.txt", "src/dir"]
+    st = os.lstat(str(src.join("a.txt")))
+    assert not manifest.isChanged("src/a.txt", st)
+
+
+def test_manifest_unreadable_file(tmpdir, monkeypatch):
+    src = tmpdir.join("src")
+    for name in ("a.txt", "b.txt"):
+        writeFile(str(src.join(name)), getData(1000, name))
+    manifestFile = str(tmpdir.join("manifests", "src.manifest.gz"))
+    sourceReader = backupper.SourceReader
+
+    def failingReader(path, *args, **kwargs):
+        if path.endswith("b.txt"):
+            raise IOError("Permission denied")
+        return sourceReader(path, *args, **kwargs)
+
+    monkeypatch.setattr(backupper, "SourceReader", failingReader)
+    c = newArchiveCommand(tmpdir, "level0.tar.gz")
+    c.setIncremental(manifestFile, 3)
+    c.run(Output(), logger)
+    assert sorted(getMembers(c.getOutputFile())) == ["src", "src/a.txt"]
+    assert "src/b.txt" not in Manifest.load(manifestFile).entries
+
+    # nothing changed, the file not archived before is archived now
+    monkeypatch.undo()
+    c = newArchiveCommand(tmpdir, "level1.tar.gz")
+    c.setIncremental(manifestFile, 3)
+    c.run(Output(), logger)
+    members = getMembers(c.getOutputFile())
+    assert sorted(members) == ["src", "src/b.txt"]
+    assert members["src/b.txt"] == getData(1000, "b.txt")
+
+    # unreadable again, not listed as deleted
+    monkeypatch.setattr(backupper, "SourceReader", failingReader)
+    c = newArchiveCommand(tmpdir, "level2.tar.gz")
+    c.setIncremental(manifestFile, 3)
+    writeFile(str(src.join("b.txt")), getData(2000, "b.txt"))
+    c.run(Output(), logger)
+    assert readFile(str(tmpdir.join("level2-deleted.log"))) == ""
+
+
+def newShellCommand(changeToDir, command, outputFile=None):
+    c = Command(changeToDir)
+    c.setCommand(command)
+    c.setOutputFile(outputFile)
+    return c
+
+
+def test_journal_resume(tmpdir):
+    dst = str(tmpdir)
+    writeFile(str(tmpdir.join("src.txt")), getData(10000))
+    c1 = newShellCommand(dst, "cp src.txt one.txt",
+                         str(tmpdir.join("one.txt")))
+    c2 = newShellCommand(dst, "cp one.txt two.txt",
+                         str(tmpdir.join("two.txt")))
+    c2.addDependency(c1)
+    c3 = newShellCommand(dst, "true")
+    c3.addDependency(c2)
+    commands = [c1, c2, c3]
+    # interrupted after the first command
+    journal = Journal(dst, logger)
+    Executor(dst, logger).execute([c1], journal)
+
+    journal = Journal(dst, logger)
+    assert journal.getDone(commands) == set([c1])
+    executor = Executor(dst, logger)
+    executor.execute(commands, journal)
+    assert [c.getCommand() for c in executor.executed] == [
+        "cp one.txt two.txt", "true"]
+    journal = Journal(dst, logger)
+    assert journal.getDone(commands) == set(commands)
+
+    # changed output, it and everything depending on it is run again
+    writeFile(str(tmpdir.join("two.txt")), "changed")
+    journal = Journal(dst, logger)
+    assert journal.getDone(commands) == set([c1])
+
+
+def test_journal_consumed_output(tmpdir):
+    dst = str(tmpdir)
+    writeFile(str(tmpdir.join("src", "a.txt")), getData(10000))
+    tar = newShellCommand(dst, "tar cf src.tar src",
+                          str(tmpdir.join("src.tar")))
+    gz = newShellCommand(dst, "gzip src.tar", str(tmpdir.join("src.tar.gz")))
+    gz.addDependency(tar)
+    test = newShellCommand(dst, "gzip -t src.tar.gz")
+    test.addDependency(gz)
+    commands = [tar, gz, test]
+    journal = Journal(dst, logger)
+    Executor(dst, logger).execute(commands, journal)
+    # the tar archive is gone, it was not hashed
+    assert journal.entries["tar cf src.tar src"]["digests"] == {}
+    assert journal.entries["gzip src.tar"]["digests"]["md5"] == (
+        backupper.fileDigest(gz.getOutputFile(), "md5"))
+    assert journal.getDigests().keys() == [gz.getOutputFile()]
+    journal = Journal(dst, logger)
+    assert journal.getDone(commands) == set(commands)
+
+    # gzip -t which has no output does not make the archive done
+    data = readFile(gz.getOutputFile())
+    writeFile(gz.getOutputFile(), data[:-10])
+    journal = Journal(dst, logger)
+    assert journal.getDone(commands) == set()
+    executor = Executor(dst, logger)
+    executor.execute(commands, journal)
+    assert executor.executed == commands
+    assert Journal(dst, logger).getDone(commands) == set(commands)
+
+
+def test_planner(tmpdir):
+    dst = str(tmpdir)
+    writeFile(str(tmpdir.join("small", "a")), getData(1000))
+    writeFile(str(tmpdir.join("big", "a")), getData(100000))
+    writeFile(str(tmpdir.join("medium", "a")), getData(20000))
+    # excluded and filtered, not estimated
+    writeFile(str(tmpdir.join("medium", "skip", "b")), getData(50000))
+    writeFile(str(tmpdir.join("medium", "c.bin")), getData(50000))
+    tar = newShellCommand(dst, "tar cf small.tar small")
+    tar.setSrcDir("small")
+    gz = newShellCommand(dst, "gzip small.tar")
+    gz.addDependency(tar)
+    big = newShellCommand(dst, "builtin-targz big")
+    big.setSrcDir("big")
+    medium = newShellCommand(dst, "builtin-targz medium")
+    medium.setSrcDir("medium")
+    medium.setExcludes(["skip"])
+    medium.setFilters(DirFilters(skipExtensions=["bin"]))
+    commands = [tar, gz, medium, big]
+
+    planner = Planner(logger, rate=1000, fileCost=0.5)
+    # largest first, chains kept together in order
+    assert planner.plan(commands, workers=2) == [big, medium, tar, gz]
+    assert medium.getEstimate() == (20000, 1)
+    assert tar.getEstimate() == (1000, 1)
+    assert gz.getEstimate() is None
+    # big on one worker, medium and small on the other
+    assert planner.duration == 100.5
+    assert "on 2 worker(s)" in planner.report[-1]
+    assert len(planner.report) == 4
+    planner.plan(commands, workers=1)
+    assert planner.duration == 100.5 + 20.5 + 1.5
+
+
+def test_seekable_archive_extract(tmpdir):
+    src = tmpdir.join("src")
+    names = ["a.txt", "dir/b c.txt", "dir/sub/d.bin", "dir/sub/e.txt",
+             "other/f.txt"]
+    for name in names:
+        writeFile(str(src.join(name)), getData(20000, name))
+    c = newArchiveCommand(tmpdir, "seekable.tar.gz", SeekableArchiveCommand)
+    c.frameSize = 8192
+    c.run(Output(), logger)
+    archive = c.getOutputFile()
+    assert os.path.exists("%s.idx" % archive)
+
+    out = str(tmpdir.join("out"))
+    # directory and its content
+    assert extractMembers(archive, "src/dir/sub", out) == 3
+    assert sorted(os.listdir(os.path.join(out, "src", "dir", "sub"))) == [
+        "d.bin", "e.txt"]
+    for name in ("dir/sub/d.bin", "dir/sub/e.txt"):
+        assert readFile(os.path.join(out, "src", name)) == getData(20000,
+                                                                   name)
+    # single file
+    assert extractMembers(archive, "/src/dir/b c.txt", out) == 1
+    assert readFile(os.path.join(out, "src", "dir", "b c.txt")) == getData(
+        20000, "dir/b c.txt")
+    py.test.raises(Exception, extractMembers, archive, "src/missing", out)
+
+
+def test_archive_index_awkward_names(tmpdir):
+    names = ["src/back\\0slash", "src/new\nline", "src/sp ace",
+             "src/1 2 3", "src/\xc5\xbelu\xc5\xa5ou\xc4\x8dk\xc3\xbd"]
+    index = ArchiveIndex(1024)
+    for i, name in enumerate(names):
+        index.add(name, i * 100, i)
+    fileName = str(tmpdir.join("archive.tar.gz.idx"))
+    index.save(fileName)
+    loaded = ArchiveIndex.load(fileName)
+    assert loaded.frameSize == 1024
+    assert loaded.entries == index.entries
+
+    # member of such name gets extracted from the archive
+    writeFile(str(tmpdir.join("src", "back\\0slash")), getData(20000))
+    c = newArchiveCommand(tmpdir, "seekable.tar.gz", SeekableArchiveCommand)
+    c.run(Output(), logger)
+    out = str(tmpdir.join("out"))
+    assert extractMembers(c.getOutputFile(), "src/back\\0slash", out) == 1
+    assert readFile(os.path.join(out, "src", "back\\0slash")) == getData(
+        20000)
+
+
+def test_catalog(tmpdir):
+    dst = str(tmpdir)
+    for name in ("a.txt", "dir/b.txt", "dir/c.jpg", "dirx/d.txt"):
+        writeFile(str(tmpdir.join("src", name)), getData(100, name))
+    # shell tar, members are listed from the archive
+    tar = newShellCommand(dst, "tar cf src.tar src", str(tmpdir.join(
+        "src.tar")))
+    memberList = str(tmpdir.join("src.members"))
+    tar.setMemberList(memberList)
+    Executor(dst, logger).execute([tar])
+    catalogFile = str(tmpdir.join("catalog.sqlite"))
+    catalog = Catalog(catalogFile)
+    assert catalog.addBackup("BACKUP-1", "2014-01-01T00:00:00",
+                             [("sys/src.tar", memberList)]) == 7
+    catalog.close()
+
+    catalog = Catalog(catalogFile)
+    # path prefix
+    found = catalog.find("src/dir/")
+    assert [row[3] for row in found] == ["src/dir/b.txt", "src/dir/c.jpg"]
+    backup, date, archive, path, size, mtime = found[0]
+    assert (backup, archive, size) == ("BACKUP-1", "sys/src.tar", 100)
+    assert mtime == int(os.path.getmtime(str(tmpdir.join("src", "dir",
+                                                          "b.txt"))))
+    # glob, * matches / as well
+    assert [row[3] for row in catalog.find("src/*.txt")] == [
+        "src/a.txt", "src/dir/b.txt", "src/dirx/d.txt"]
+
+    # resumed backup replaces its rows, other backups are kept
+    writeFile(memberList, "5 0 src/new.txt\0")
+    assert catalog.addBackup("BACKUP-1", "2014-01-01T00:00:00",
+                             [("sys/src.tar", memberList)]) == 1
+    writeFile(memberList, "6 0 src/new.txt\0")
+    catalog.addBackup("BACKUP-2", "2014-01-02T00:00:00",
+                      [("sys/src.tar", memberList)])
+    assert [(row[0], row[4]) for row in catalog.find("src")] == [
+        ("BACKUP-1", 5), ("BACKUP-2", 6)]
+    catalog.close()
+
+    # --find
+    script = os.path.splitext(backupper.__file__)[0] + ".py"
+    p = subprocess.Popen([sys.executable, script, "--find", "src/new*",
+                          "-d", dst], stdout=subprocess.PIPE)
+    lines = p.communicate()[0].splitlines()
+    assert p.returncode == 0
+    assert [line.split()[0] for line in lines[1:]] == ["BACKUP-1",
+                                                       "BACKUP-2"]
+
+
+def getChunkIds(recipe):
+    lines = readFile(recipe).splitlines()[1:-1]
+    return set([line.split()[0] for line in lines])
+
+
+def writeRecipe(store, recipe, data):
+    f = open(recipe, "w")
+    try:
+        w = ChunkStoreWriter(store, f, os.path.dirname(recipe),
+                             minSize=2048, avgBits=13, maxSize=32768)
+        for i in range(0, len(data), 5000):
+            w.write(data[i:i + 5000])
+        w.close()
+    finally:
+        f.close()
+    return w
+
+
+def test_chunk_store_dedup_and_gc(tmpdir):
+    store = ChunkStore(str(tmpdir.join("chunks")))
+    data = os.urandom(1024 * 1024)
+    recipe1 = str(tmpdir.join("one.tar.recipe"))
+    w = writeRecipe(store, recipe1, data)
+    assert w.stored == w.chunked == len(data)
+
+    # insertion at the beginning shifts the data, chunks after the
+    # first boundary are the same
+    recipe2 = str(tmpdir.join("two.tar.recipe"))
+    w = writeRecipe(store, recipe2, "".join(["inserted", data]))
+    assert w.chunked == len(data) + 8
+    assert w.stored < 64 * 1024
+    for recipe, expected in ((recipe1, data),
+                             (recipe2, "".join(["inserted", data]))):
+        output = str(tmpdir.join("restored.tar"))
+        assert restoreRecipe(recipe, output) == len(expected)
+        assert readFile(output) == expected
+
+    # chunks referenced only by the second recipe are removed
+    only2 = getChunkIds(recipe2) - getChunkIds(recipe1)
+    assert only2
+    store.lock(exclusive=True)
+    store.collectGarbage(getChunkIds(recipe1), logger)
+    store.unlock()
+    for chunkId in only2:
+        assert not os.path.exists(store.getPath(chunkId))
+    output = str(tmpdir.join("restored.tar"))
+    assert restoreRecipe(recipe1, output) == len(data)
+    py.test.raises(IOError, restoreRecipe, recipe2, output)
+
+
+def test_chunk_boundaries(tmpdir, monkeypatch):
+    # the same boundaries with and without numpy
+    data = "".join([os.urandom(300000), "\0" * 100000, os.urandom(300000)])
+    recipes = []
+    for name in ("one", "two"):
+        recipe = str(tmpdir.join("%s.tar.recipe" % name))
+        writeRecipe(ChunkStore(str(tmpdir.join("chunks"))), recipe, data)
+        recipes.append(readFile(recipe))
+        monkeypatch.setattr(backupper, "numpy", None)
+    assert recipes[0] == recipes[1]
+    assert len(recipes[0].splitlines()) > 10
+
+
+def isLocked(store):
+    f = open(os.path.join(store.root, ChunkStore.lockName), "a")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except IOError:
+        return True
+    finally:
+        f.close()
+
+
+def test_chunk_store_locking(tmpdir):
+    store = ChunkStore(str(tmpdir.join("chunks")))
+    f = open(str(tmpdir.join("one.tar.recipe")), "w")
+    w = ChunkStoreWriter(store, f, str(tmpdir))
+    w.write("data")
+    # writers share the store, garbage collection has to wait
+    other = ChunkStore(store.root)
+    other.lock()
+    other.unlock()
+    assert isLocked(store)
+    w.close()
+    f.close()
+    assert not isLocked(store)
+    backupper.collectChunkGarbage(str(tmpdir), logger)
+    assert os.listdir(os.path.join(store.root, "3a"))
+    # failed writer does not hold the store
+    w = ChunkStoreWriter(store, StringIO(), str(tmpdir))
+    w.write("data")
+    w.abort()
+    assert not isLocked(store)
+
+
+def checkOrdering(executorClass, tmpdir):
+    """
+    Dependent command starts once its dependency finished, independent
+    commands overlap.
+
+    """
+    dst = str(tmpdir)
+    a = newShellCommand(dst, "sleep 0.5")
+    b = newShellCommand(dst, "sleep 0.1")
+    b.addDependency(a)
+    c = newShellCommand(dst, "sleep 0.5")
+    executor = executorClass(dst, logger, workers=2)
+    executor.execute([a, b, c])
+    for command in (a, b, c):
+        assert command.getStats()["exitStatus"] == 0
+    aEnd = a.getStats()["start"] + a.getStats()["wallTime"]
+    assert b.getStats()["start"] >= aEnd
+    assert c.getStats()["start"] < aEnd
+    assert executor.executed.index(a) < executor.executed.index(b)
+
+
+def test_executor_ordering(tmpdir):
+    checkOrdering(Executor, tmpdir)
+
+
+def test_event_executor_ordering(tmpdir):
+    checkOrdering(EventExecutor, tmpdir)
+
+
+def checkSharedLog(executorClass, tmpdir):
+    """
+    Command writing into the log owned by a long running command is not
+    held up until the owner finished, outputs do not interleave.
+
+    """
+    dst = str(tmpdir)
+    writeFile(str(tmpdir.join("slow.sh")), "echo slow 1\nsleep 1\n"
+                                           "echo slow 2\n")
+    writeFile(str(tmpdir.join("fast.sh")), "sleep 0.2\necho fast\n")
+    logFile = str(tmpdir.join("stdout.log"))
+    commands = []
+    for name in ("slow", "fast", "fast"):
+        c = newShellCommand(dst, "sh %s.sh" % name)
+        c.setStdOutLogFile(logFile)
+        c.setLogPrefix("[%s]\n" % name)
+        commands.append(c)
+    slow, fast, dependent = commands
+    dependent.addDependency(fast)
+    executor = executorClass(dst, logger, workers=2)
+    executor.execute(commands)
+    slowEnd = slow.getStats()["start"] + slow.getStats()["wallTime"]
+    assert fast.getStats()["wallTime"] < 0.8
+    assert dependent.getStats()["start"] < slowEnd
+    assert readFile(logFile) == ("[slow]\nslow 1\nslow 2\n"
+                                 "[fast]\nfast\n[fast]\nfast\n")
+
+
+def test_executor_shared_log(tmpdir):
+    checkSharedLog(Executor, tmpdir)
+
+
+def test_event_executor_shared_log(tmpdir):
+    checkSharedLog(EventExecutor, tmpdir)
+
+
+def newBackupper(dstDir, options):
+    try:
+        return Backupper("", dstDir, options)
+    finally:
+        # Backupper sets its logger class for everybody
+        logging.setLoggerClass(logging.Logger)
+
+
+def finishBackup(dstDir, mirrors, retCode, monkeypatch):
+    """
+    Returns exit code of Backupper.finish() of a backup in dstDir.
+
+    """
+    # handlers of the test run stay open
+    monkeypatch.setattr(logging, "shutdown", lambda: None)
+    b = newBackupper(dstDir, {"mirrors": mirrors})
+    writeFile(os.path.join(dstDir, "archive.tar.gz"), getData(1000))
+    b.logger.info("last line")
+    try:
+        b.finish(retCode)
+    except SystemExit, ex:
+        return ex.code
+
+
+def test_finish_mirrors(tmpdir, monkeypatch):
+    dst = str(tmpdir.join("dst", "BACKUP-1"))
+    mirror = str(tmpdir.join("mirror", "BACKUP-1"))
+    for d in (dst, mirror):
+        os.makedirs(d)
+    # failed backup is not mirrored
+    assert finishBackup(dst, [mirror], 1, monkeypatch) == 1
+    assert os.listdir(mirror) == []
+
+    assert finishBackup(dst, [mirror], 0, monkeypatch) == 0
+    assert sorted(os.listdir(mirror)) == ["archive.tar.gz", "backup.log",
+                                          "run-report.json"]
+    for name in os.listdir(mirror):
+        assert readFile(os.path.join(mirror, name)) == readFile(
+            os.path.join(dst, name))
+    assert "Backup lasted" in readFile(os.path.join(mirror, "backup.log"))
+    report = json.loads(readFile(os.path.join(mirror, "run-report.json")))
+    assert report["retCode"] == 0
+
+    # mirroring failure is in the run report
+    writeFile(str(tmpdir.join("file")), "")
+    broken = str(tmpdir.join("file", "BACKUP-1"))
+    assert finishBackup(dst, [broken], 0, monkeypatch) == 1
+    report = json.loads(readFile(os.path.join(dst, "run-report.json")))
+    assert report["retCode"] == 1
+
+
+def test_digest_writer():
+    data = getData(100000)
+    out = StringIO()
+    w = DigestWriter(out, ["md5", "sha256"])
+    for i in range(0, len(data), 7000):
+        w.write(data[i:i + 7000])
+    assert w.size == len(data) and out.getvalue() == data
+    assert w.hexdigests() == {"md5": hashlib.md5(data).hexdigest(),
+                              "sha256": hashlib.sha256(data).hexdigest()}
+    w.close()
+    assert out.closed
+
+
+def test_generate_sums(tmpdir):
+    writeFile(str(tmpdir.join("src", "a.txt")), getData(10000))
+    dst = str(tmpdir.join("BACKUP-1"))
+    os.makedirs(os.path.join(dst, "sys"))
+    b = newBackupper(dst, {"digests": ["md5", "sha256"]})
+    builtin = newArchiveCommand(tmpdir, "BACKUP-1/sys/a.tar.gz")
+    builtin.setDigestNames(["md5", "sha256"])
+    tar = newShellCommand(str(tmpdir), "tar cf %s/sys/b.tar src" % dst,
+                          os.path.join(dst, "sys", "b.tar"))
+    gz = newShellCommand(dst, "gzip sys/b.tar",
+                         os.path.join(dst, "sys", "b.tar.gz"))
+    gz.addDependency(tar)
+    b.executor.execute([builtin, tar, gz], journal=b.journal)
+    b.generateMD5Sums()
+    # digests of the journal, no md5sum run for the archives
+    assert [c.getCommand() for c in b.executor.executed
+            if "sum " in c.getCommand()] == ["sha256sum sys/b.tar.gz"]
+    for digestName, sumFile in (("md5", "md5checksum.log"),
+                                ("sha256", "sha256checksum.log")):
+        p = subprocess.Popen(["%ssum" % digestName, "sys/a.tar.gz",
+                              "sys/b.tar.gz"], cwd=dst,
+                             stdout=subprocess.PIPE)
+        expected = p.communicate()[0]
+        assert sorted(readFile(os.path.join(dst, sumFile)).splitlines()) \
+            == sorted(expected.splitlines())
+
+
+def test_run_report(tmpdir):
+    writeFile(str(tmpdir.join("src", "a.txt")), getData(10000))
+    dst = str(tmpdir.join("BACKUP-1"))
+    os.makedirs(dst)
+    b = newBackupper(dst, {})
+    builtin = newArchiveCommand(tmpdir, "BACKUP-1/a.tar.gz")
+    builtin.setFilters(DirFilters(skipExtensions=["txt"]))
+    shell = newShellCommand(str(tmpdir), "tar cvf %s/b.tar src" % dst,
+                            os.path.join(dst, "b.tar"))
+    b.executor.execute([builtin, shell])
+    b.writeRunReport(b.startTime, 0)
+    report = json.loads(readFile(os.path.join(dst, "run-report.json")))
+    assert report["retCode"] == 0
+    assert report["skipped"] == {"skipExtensions": [1, 10000]}
+    stats = dict([(s["command"], s) for s in report["commands"]])
+    common = set(["command", "start", "wallTime", "exitStatus", "userTime",
+                  "sysTime", "maxRSS", "throttledTime", "stdOutLines",
+                  "skipped"])
+    s = stats[builtin.getCommand()]
+    assert common | set(["readBytes", "writeBytes", "usageScope"]) <= set(s)
+    assert s["exitStatus"] == 0 and s["usageScope"] == "process"
+    assert s["writeBytes"] == os.path.getsize(builtin.getOutputFile())
+    assert s["stdOutLines"] == 1
+    s = stats[shell.getCommand()]
+    assert common <= set(s)
+    assert s["exitStatus"] == 0 and "usageScope" not in s
+    # tar -v lists src and src/a.txt
+    assert s["stdOutLines"] == 2
+    assert s["wallTime"] > 0
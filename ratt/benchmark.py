@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of reading capture time (EXIF) of photo files by ratt.
+
+Reads capture date time of all files of the directory by exifread alone
+(as ratt used to) and by the header-only reader of ratt (falling back to
+exifread) and reports files per second of both.
+A mixed synthetic photo set (JPEG files with thumbnails, large TIFF
+based raw files, little and big endian) may be generated into the
+directory first.
+
+
+Usage:
+    benchmark.py [-g <number of files to generate>] <directory>
+
+
+Author: Zdenek Maxa
+
+"""
+
+import sys
+import os
+import time
+import random
+from optparse import OptionParser
+
+# ratt.py and its tests (synthetic photo files) live next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from ratt import read_exif_date_time
+from ratt import read_exif_date_time_exifread
+from test.photos import make_tiff
+from test.photos import make_jpeg
+
+
+def generate(directory, number):
+    rnd = random.Random(number)
+    for i in range(number):
+        endian = rnd.choice("<>")
+        dt = "2014:06:%02d %02d:%02d:%02d" % (rnd.randint(1, 28),
+                                              rnd.randint(0, 23),
+                                              rnd.randint(0, 59),
+                                              rnd.randint(0, 59))
+        tiff = make_tiff(endian, {0x010f: "Camera", 0x0132: dt},
+                         {0x9003: dt, 0x9004: dt}, fillers=200)
+        if i % 4:
+            data = make_jpeg(tiff, thumbnail_size=60000,
+                             payload_size=rnd.randint(2, 6) * 1024 * 1024)
+            name = "img%05d.jpg" % i
+        else:
+            # TIFF based raw file, image data follow the EXIF
+            data = tiff + b"\0" * 20 * 1024 * 1024
+            name = "img%05d.cr2" % i
+        f = open(os.path.join(directory, name), "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+
+def read_fast(fd):
+    return read_exif_date_time(fd) or read_exif_date_time_exifread(fd)
+
+
+def measure(names, reader):
+    """
+    Returns files per second and date times read by reader from files.
+
+    """
+    results = []
+    start = time.time()
+    for name in names:
+        fd = open(name, "rb")
+        try:
+            results.append(reader(fd))
+        finally:
+            fd.close()
+    return len(names) / (time.time() - start), results
+
+
+def main():
+    parser = OptionParser(usage="%prog [-g <number>] <directory>")
+    parser.add_option("-g",
+                      "--generate",
+                      dest="generate",
+                      type="int",
+                      default=0,
+                      help="Generate a synthetic photo set first.")
+    options, args = parser.parse_args(sys.argv[1:])
+    if len(args) != 1:
+        parser.error("directory expected")
+    directory = args[0]
+    if options.generate:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        generate(directory, options.generate)
+    names = [os.path.join(directory, n) for n in sorted(os.listdir(directory))]
+    names = [n for n in names if os.path.isfile(n)]
+    before, expected = measure(names, read_exif_date_time_exifread)
+    after, results = measure(names, read_fast)
+    if results != expected:
+        print("Date times differ from those read by exifread.")
+        sys.exit(1)
+    print("%s files" % len(names))
+    print("exifread:           %10.1f files/s" % before)
+    print("header-only reader: %10.1f files/s (%.1fx)" %
+          (after, after / before))
+
+
+if (__name__ == "__main__"):
+    main()
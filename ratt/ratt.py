@@ -9,12 +9,21 @@ TARGET_FILE_NAME_PATTERN (variables names and their number must be preserved).
 
 Should files with duplicate times (precision to seconds) be found, the
 target file names are counter suffixed.
+With the recursive option files of all subdirectories are renamed as
+well (each within its directory).
+
+The whole renaming plan is computed and checked for collisions with
+existing files first, nothing is renamed if any is found. The whole
+plan is recorded into a journal (JOURNAL_FILE), synced to the disk,
+before the first rename, an interrupted run is rolled back (renames
+not done yet are skipped) by the rollback option.
 
 File extension is preserved.
 The time in the final file names can be changed by hour offset argument.
 
 Could read the time information either from file's modification time or
-from files EXIF information.
+from files EXIF information (JPEG, TIFF based raw formats, HEIF/HEIC) or
+creation time of MP4/QuickTime (MOV) movies.
 
 Use case:
 Naming photo files from a digital cammera according to date/time name pattern.
@@ -38,19 +47,63 @@ Author: Zdenek Maxa
 TARGET_FILE_NAME_PATTERN = ("%(year)s-%(month)s-%(day)s-%(dow)s-"
                             "%(hour)s-%(minute)s-%(second)s")
 DAYS_OF_WEEK = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+# number of files whose times are read at the same time, reading is
+# bound by latency of the storage (memory cards, USB readers)
+DEFAULT_JOBS = 8
+# format of date time as stored in EXIF
+EXIF_DATE_TIME_FORMAT = "%Y:%m:%d %H:%M:%S"
+# EXIF (TIFF) tags holding the capture time, in order of preference:
+# DateTimeOriginal, DateTimeDigitized (Exif IFD), DateTime (IFD0)
+EXIF_DATE_TIME_TAGS = (0x9003, 0x9004, 0x0132)
+# tag of the pointer to the Exif IFD in IFD0
+EXIF_IFD_POINTER_TAG = 0x8769
+# TIFF header magic numbers, TIFF based raw formats use their own
+# (42 TIFF, CR2, NEF, DNG, ARW; 0x4f52, 0x5352 ORF; 0x55 RW2)
+TIFF_MAGICS = (42, 0x4f52, 0x5352, 0x55)
+# ISO base media file format (MP4, QuickTime, HEIF): types of the first
+# box and brands (of the ftyp box) of HEIF images, others are movies
+ISOBMFF_BOX_TYPES = (b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip",
+                     b"pnot")
+HEIF_BRANDS = (b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx",
+               b"mif1", b"msf1", b"avif")
+# seconds between 1904-01-01 (MP4/QuickTime epoch) and 1970-01-01 (UTC)
+MP4_EPOCH_OFFSET = 2082844800
+# cache of timestamps read from EXIF (see TimestampCache), entries not
+# used for CACHE_MAX_AGE days are evicted, the least recently used ones
+# beyond CACHE_MAX_ENTRIES as well
+CACHE_MAX_AGE = 90
+CACHE_MAX_ENTRIES = 1000000
+# journal of renames of the running (or interrupted) run, in the current
+# directory, removed once all files are renamed
+JOURNAL_FILE = ".ratt-journal"
 
 
 import sys
 import os
+import stat
 import time
 import datetime
+import struct
+import multiprocessing.pool
+import sqlite3
+import json
 from functools import partial
 from optparse import OptionParser
 
 import exifread
 
 
+CACHE_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                          os.path.join(os.path.expanduser("~"), ".cache"),
+                          "ratt", "timestamps.sqlite")
+
+
 def process_input_args(inputArgs):
+    """
+    Returns the options (offset_hour and jobs converted to int, jobs is
+    negative for processes instead of threads).
+
+    """
     parser = OptionParser()
     parser.add_option("-c",
                       "--confirm",
@@ -69,15 +122,58 @@ def process_input_args(inputArgs):
                       dest="exif",
                       default=False,
                       help="Read data from EXIF info from files.")
+    parser.add_option("-j",
+                      "--jobs",
+                      dest="jobs",
+                      default=DEFAULT_JOBS,
+                      help="Number of threads reading the files times "
+                           "(default %s)." % DEFAULT_JOBS)
+    parser.add_option("-p",
+                      "--processes",
+                      action="store_true",
+                      dest="processes",
+                      default=False,
+                      help="Read the files times by processes instead of "
+                           "threads.")
+    parser.add_option("-n",
+                      "--no-cache",
+                      action="store_false",
+                      dest="use_cache",
+                      default=True,
+                      help="Read EXIF of all files, do not use the cache "
+                           "of times read by previous runs (%s)." %
+                           CACHE_FILE)
+    parser.add_option("-r",
+                      "--recursive",
+                      action="store_true",
+                      dest="recursive",
+                      default=False,
+                      help="Rename files in subdirectories as well.")
+    parser.add_option("--rollback",
+                      action="store_true",
+                      dest="rollback",
+                      default=False,
+                      help="Roll back renames of an interrupted run "
+                           "(recorded in %s)." % JOURNAL_FILE)
     options, args = parser.parse_args(inputArgs)
     # sanitize - offset has to be integer
     try:
-        offset_hour = int(options.offset_hour)
+        options.offset_hour = int(options.offset_hour)
     except ValueError:
         print("Wrong offset: '%s', setting back default." %
               options.offset_hour)
-        offset_hour = 0
-    return options.confirm, offset_hour, options.exif
+        options.offset_hour = 0
+    try:
+        options.jobs = int(options.jobs)
+        assert options.jobs > 0
+    except (ValueError, AssertionError):
+        print("Wrong number of jobs: '%s', setting back default." %
+              options.jobs)
+        options.jobs = DEFAULT_JOBS
+    if options.processes:
+        # negative number of jobs - processes
+        options.jobs = -options.jobs
+    return options
 
 
 def get_date_time_string(timestamp, hour_offset):
@@ -102,34 +198,314 @@ def get_date_time_string(timestamp, hour_offset):
     return fn
 
 
+def read_ifd(fd, base, offset, endian):
+    """
+    Returns entries (tag, type, count, value/offset field) of the TIFF IFD
+    at offset (relative to the TIFF header at base) of the file fd.
+
+    """
+    fd.seek(base + offset)
+    count = struct.unpack(endian + "H", fd.read(2))[0]
+    data = fd.read(12 * count)
+    entries = []
+    for i in range(count):
+        tag, typ, num = struct.unpack(endian + "HHI", data[12 * i:12 * i + 8])
+        entries.append((tag, typ, num, data[12 * i + 8:12 * i + 12]))
+    return entries
+
+
+def read_tiff_date_time(fd, base):
+    """
+    Returns capture date time string (e.g. '2014:06:28 11:53:21') of the
+    TIFF structure (EXIF) starting at offset base of the file fd, None if
+    none of EXIF_DATE_TIME_TAGS is found. Only IFD0, the Exif IFD and the
+    date time values are read, thumbnails and maker notes are skipped.
+
+    """
+    fd.seek(base)
+    header = fd.read(8)
+    if header[:2] == b"II":
+        endian = "<"
+    elif header[:2] == b"MM":
+        endian = ">"
+    else:
+        return None
+    magic, ifd_offset = struct.unpack(endian + "HI", header[2:8])
+    if magic not in TIFF_MAGICS:
+        return None
+    values = {}
+    ifds = [ifd_offset]
+    seen = set()
+    while ifds:
+        offset = ifds.pop()
+        if offset in seen:
+            continue  # corrupted, IFD pointers loop
+        seen.add(offset)
+        for tag, typ, num, field in read_ifd(fd, base, offset, endian):
+            if tag == EXIF_IFD_POINTER_TAG:
+                ifds.append(struct.unpack(endian + "I", field)[0])
+            elif tag in EXIF_DATE_TIME_TAGS and typ == 2:  # ASCII
+                if num <= 4:
+                    value = field[:num]
+                else:
+                    fd.seek(base + struct.unpack(endian + "I", field)[0])
+                    value = fd.read(num)
+                values[tag] = value.split(b"\0")[0].decode("ascii")
+    for tag in EXIF_DATE_TIME_TAGS:
+        dt = values.get(tag, "").strip()
+        try:
+            datetime.datetime.strptime(dt, EXIF_DATE_TIME_FORMAT)
+        except ValueError:
+            continue  # missing or blank (e.g. '0000:00:00 00:00:00')
+        return dt
+    return None
+
+
+def read_jpeg_date_time(fd):
+    """
+    Returns capture date time string of the JPEG file fd from the EXIF
+    (APP1) segment, segments preceding it are skipped by seeking, None if
+    not found before the image data.
+
+    """
+    fd.seek(2)
+    while True:
+        marker = fd.read(4)
+        if len(marker) < 4 or marker[:1] != b"\xff":
+            return None
+        code = ord(marker[1:2])
+        if code in (0xda, 0xd9):  # start of scan (image data), end
+            return None
+        start = fd.tell()
+        length = struct.unpack(">H", marker[2:])[0]
+        if code == 0xe1 and fd.read(6) == b"Exif\0\0":
+            return read_tiff_date_time(fd, start + 6)
+        fd.seek(start + length - 2)
+
+
+def read_exif_date_time(fd):
+    """
+    Returns capture date time string of the JPEG or TIFF (also TIFF
+    based raw formats) file fd, None if the file is of another format or
+    the date time is not found.
+    Reads just the few structures leading to the date time, unlike
+    exifread which parses the whole EXIF information.
+
+    """
+    fd.seek(0)
+    head = fd.read(2)
+    if head == b"\xff\xd8":
+        return read_jpeg_date_time(fd)
+    if head in (b"II", b"MM"):
+        return read_tiff_date_time(fd, 0)
+    return None
+
+
+def read_exif_date_time_exifread(fd):
+    """
+    Returns capture date time string of the file fd as found by exifread,
+    raises exception if not found.
+
+    """
+    fd.seek(0)
+    data = exifread.process_file(fd, strict=True)
+    # returned in a form '2014:06:28 11:53:21'
+    exif_keys = ("EXIF DateTimeOriginal",
+                 "EXIF DateTimeDigitized",
+                 "Image DateTime")
+    for key in exif_keys:
+        if key in data.keys():
+            return str(data[key])
+    m = "Can't find any of the Exif keys: %s" % (exif_keys,)
+    raise Exception(m)
+
+
+def iter_boxes(fd, start, end=None):
+    """
+    Generates (type, payload start, payload end) of ISO base media file
+    format boxes between offsets start and end (end of file if None) of
+    the file fd. Only box headers are read, payloads are skipped.
+
+    """
+    offset = start
+    while end is None or offset + 8 <= end:
+        fd.seek(offset)
+        header = fd.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", fd.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            # box extends to the end
+            if end is None:
+                fd.seek(0, os.SEEK_END)
+                end = fd.tell()
+            size = end - offset
+        if size < header_size:
+            return  # corrupted
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def find_box(fd, box_type, start, end=None):
+    """
+    Returns (payload start, payload end) of the first box_type box between
+    offsets start and end of the file fd, None if not found.
+
+    """
+    for typ, payload_start, payload_end in iter_boxes(fd, start, end):
+        if typ == box_type:
+            return payload_start, payload_end
+    return None
+
+
+def read_mp4_creation_time(fd):
+    """
+    Returns timestamp of the creation time of the MP4/QuickTime movie fd
+    (movie header - mvhd box in the moov box), None if not found or not
+    set. Media data are skipped by seeking, whatever their size.
+
+    """
+    moov = find_box(fd, b"moov", 0)
+    if moov is None:
+        return None
+    mvhd = find_box(fd, b"mvhd", *moov)
+    if mvhd is None:
+        return None
+    fd.seek(mvhd[0])
+    version = ord(fd.read(4)[:1])
+    if version == 1:
+        creation_time = struct.unpack(">Q", fd.read(8))[0]
+    else:
+        creation_time = struct.unpack(">I", fd.read(4))[0]
+    if not creation_time:
+        return None
+    return creation_time - MP4_EPOCH_OFFSET
+
+
+def read_uint(data, pos, size):
+    """
+    Returns big endian unsigned integer of size bytes (0, 2, 4, 8) at pos
+    of data and the position after it.
+
+    """
+    if not size:
+        return 0, pos
+    fmt = {2: ">H", 4: ">I", 8: ">Q"}[size]
+    return struct.unpack(fmt, data[pos:pos + size])[0], pos + size
+
+
+def read_heif_exif_location(fd, meta_start, meta_end):
+    """
+    Returns (offset, length) in the file fd of the Exif item of the HEIF
+    meta box payload, None if there is no such item (stored in the file).
+
+    """
+    exif_id = None
+    iinf = find_box(fd, b"iinf", meta_start, meta_end)
+    if iinf is None:
+        return None
+    fd.seek(iinf[0])
+    version = ord(fd.read(4)[:1])
+    start = iinf[0] + (6 if version == 0 else 8)
+    for typ, infe_start, infe_end in iter_boxes(fd, start, iinf[1]):
+        if typ != b"infe":
+            continue
+        fd.seek(infe_start)
+        data = fd.read(min(infe_end - infe_start, 16))
+        version = ord(data[:1])
+        if version < 2:
+            continue
+        id_size = 2 if version == 2 else 4
+        item_id, pos = read_uint(data, 4, id_size)
+        if data[pos + 2:pos + 6] == b"Exif":
+            exif_id = item_id
+            break
+    iloc = find_box(fd, b"iloc", meta_start, meta_end)
+    if exif_id is None or iloc is None:
+        return None
+    fd.seek(iloc[0])
+    data = fd.read(iloc[1] - iloc[0])
+    version = ord(data[:1])
+    offset_size, length_size = ord(data[4:5]) >> 4, ord(data[4:5]) & 0xf
+    base_offset_size, index_size = ord(data[5:6]) >> 4, ord(data[5:6]) & 0xf
+    if version not in (1, 2):
+        index_size = 0
+    id_size = 4 if version == 2 else 2
+    count, pos = read_uint(data, 6, id_size)
+    for i in range(count):
+        item_id, pos = read_uint(data, pos, id_size)
+        method = 0
+        if version in (1, 2):
+            method, pos = read_uint(data, pos, 2)
+            method &= 0xf
+        pos += 2  # data reference index
+        base_offset, pos = read_uint(data, pos, base_offset_size)
+        extent_count, pos = read_uint(data, pos, 2)
+        extents = []
+        for j in range(extent_count):
+            index, pos = read_uint(data, pos, index_size)
+            offset, pos = read_uint(data, pos, offset_size)
+            length, pos = read_uint(data, pos, length_size)
+            extents.append((base_offset + offset, length))
+        if item_id == exif_id:
+            if method != 0 or not extents:
+                return None  # in the idat box or another item, rare
+            return extents[0]
+    return None
+
+
+def read_heif_date_time(fd):
+    """
+    Returns capture date time string from the Exif item of the HEIF (HEIC)
+    image fd, None if not found. Only the meta box and the Exif item are
+    read, never the image data.
+
+    """
+    meta = find_box(fd, b"meta", 0)
+    if meta is None:
+        return None
+    # meta is a full box (version, flags) followed by boxes
+    location = read_heif_exif_location(fd, meta[0] + 4, meta[1])
+    if location is None:
+        return None
+    offset, length = location
+    fd.seek(offset)
+    # offset of the TIFF header from the end of this field
+    tiff_offset = struct.unpack(">I", fd.read(4))[0]
+    return read_tiff_date_time(fd, offset + 4 + tiff_offset)
+
+
 def get_timestamp_from_exif(file_name):
-    print("Processing file '%s' ..." % file_name)
-    # format of data as read from exif
-    dt_format = "%Y:%m:%d %H:%M:%S"
+    """
+    Returns timestamp of the capture time found in EXIF of the file (or
+    of the creation time of a movie), raises exception if not found.
+
+    """
+    dt_format = EXIF_DATE_TIME_FORMAT
     fd = open(file_name, "rb")
     try:
-        data = exifread.process_file(fd,
-                                     strict=True)
-                                     #stop_tag="DateTimeOriginal")
-        # returned in a form '2014:06:28 11:53:21'
-        dt = None
-        exif_keys = ("EXIF DateTimeOriginal",
-                     "EXIF DateTimeDigitized",
-                     "Image DateTime")
-        for key in exif_keys:
-            #print("key: %s   presence: %s" % (key, key in data.keys()))
-            if key in data.keys():
-                dt = str(data[key])
-                break
-        else:
-            m = "Can't find any of the Exif keys: %s" % (exif_keys,)
-            raise Exception(m)
+        head = fd.read(12)
+        if head[4:8] in ISOBMFF_BOX_TYPES and head[8:12] not in HEIF_BRANDS:
+            ts = read_mp4_creation_time(fd)
+            if ts is None:
+                raise Exception("Can't find creation time of the movie.")
+            return ts
+        try:
+            if head[4:8] == b"ftyp":
+                dt = read_heif_date_time(fd)
+            else:
+                dt = read_exif_date_time(fd)
+        except (struct.error, ValueError, KeyError):
+            dt = None  # truncated or corrupted structure
+        if dt is None:
+            # other format or unusual layout, let exifread try harder
+            dt = read_exif_date_time_exifread(fd)
         # timestamp representation of the datetime
         ts = time.mktime(datetime.datetime.strptime(dt, dt_format).timetuple())
-    except Exception as ex:
-        print("Can't process file '%s', reason:\n%s" % (file_name, ex))
-        #print("EXIF keys:\n%s" % data.keys())
-        sys.exit(1)
     finally:
         fd.close()
     # check by converting back via timestamp
@@ -138,32 +514,407 @@ def get_timestamp_from_exif(file_name):
     return ts
 
 
-def get_new_file_names(curr_file_names, hour_offset, exif):
-    for name in curr_file_names:
+def get_timestamp(args):
+    """
+    Returns (name, timestamp, failure reason) of the file name, args are
+    (name, exif). Timestamp is None for a directory or if failed.
+    Run by the pool workers, exceptions are turned into the reason.
+
+    """
+    name, exif = args
+    try:
         if os.path.isdir(name):
-            continue
+            return name, None, None
         if exif:
             # get the file date and time from EXIF
-            timestamp = get_timestamp_from_exif(name)
+            return name, get_timestamp_from_exif(name), None
+        # get the file's last modification date
+        return name, os.path.getmtime(name), None
+    except Exception as ex:
+        return name, None, str(ex) or ex.__class__.__name__
+
+
+def get_timestamps(curr_file_names, exif, jobs=1, cache=None):
+    """
+    Generates get_timestamp() results of the files in the order of
+    curr_file_names. Files are read by jobs threads at the same time
+    (by -jobs processes if negative). EXIF of files found in cache
+    (TimestampCache) is not read, timestamps read are stored into it.
+
+    """
+    if exif and cache is not None:
+        for result in get_cached_timestamps(curr_file_names, jobs, cache):
+            yield result
+        return
+    items = ((name, exif) for name in curr_file_names)
+    for result in read_timestamps(items, jobs):
+        yield result
+
+
+def read_timestamps(items, jobs):
+    """
+    Generates get_timestamp() results of items in their order.
+
+    """
+    if jobs == 1:
+        for item in items:
+            yield get_timestamp(item)
+        return
+    if jobs > 0:
+        pool = multiprocessing.pool.ThreadPool(jobs)
+    else:
+        pool = multiprocessing.Pool(-jobs)
+    try:
+        # imap keeps the order, chunks cut the per file overhead
+        for result in pool.imap(get_timestamp, items, 16):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def get_cached_timestamps(curr_file_names, jobs, cache):
+    """
+    get_timestamps() in EXIF mode with cache. All files are stat()ed
+    first, only those not found in cache are read then.
+
+    """
+    files = []
+    misses = []
+    for name in curr_file_names:
+        try:
+            st = os.stat(name)
+        except OSError:
+            st = None  # get_timestamp() reports it
+        if st is not None and stat.S_ISDIR(st.st_mode):
+            files.append((name, st, (name, None, None)))
+            continue
+        timestamp = cache.get(st) if st is not None else None
+        if timestamp is None:
+            misses.append((name, True))
+            files.append((name, st, None))
         else:
-            # get the file's last modification date
-            timestamp = os.path.getmtime(name)
+            files.append((name, st, (name, timestamp, None)))
+    read = read_timestamps(misses, jobs)
+    for name, st, result in files:
+        if result is None:
+            result = next(read)
+            if st is not None and result[1] is not None:
+                cache.put(st, result[1])
+        yield result
+
+
+class TimestampCache(object):
+    """
+    On-disk cache of timestamps read from EXIF of files, a file is
+    identified by (device, inode) and its size and modification time
+    must match those of the cached entry. Entries are stored in SQLite
+    database file_name and evicted by close() - those not used for
+    max_age days and the least recently used ones beyond max_entries.
+
+    """
+
+    def __init__(self, file_name=CACHE_FILE, max_age=CACHE_MAX_AGE,
+                 max_entries=CACHE_MAX_ENTRIES):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        directory = os.path.dirname(file_name)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(file_name)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS timestamps ("
+                          "dev INTEGER, ino INTEGER, size INTEGER, "
+                          "mtime REAL, timestamp REAL, used REAL, "
+                          "PRIMARY KEY (dev, ino))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS timestamps_used "
+                          "ON timestamps (used)")
+        self.now = time.time()
+        # (dev, ino) of entries hit, their use time is updated at close
+        self.hits = []
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def get(self, st):
+        """
+        Returns cached timestamp of the file of the stat result st, None
+        if not cached or the file changed since.
+
+        """
+        row = self.conn.execute("SELECT size, mtime, timestamp FROM "
+                                "timestamps WHERE dev = ? AND ino = ?",
+                                (st.st_dev, st.st_ino)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime:
+            self.hits.append((st.st_dev, st.st_ino))
+            self.hit_count += 1
+            return row[2]
+        self.miss_count += 1
+        return None
+
+    def put(self, st, timestamp):
+        self.conn.execute("INSERT OR REPLACE INTO timestamps VALUES "
+                          "(?, ?, ?, ?, ?, ?)",
+                          (st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+                           timestamp, self.now))
+
+    def close(self):
+        self.conn.executemany("UPDATE timestamps SET used = ? WHERE "
+                              "dev = ? AND ino = ?",
+                              ((self.now, dev, ino)
+                               for dev, ino in self.hits))
+        self.conn.execute("DELETE FROM timestamps WHERE used < ?",
+                          (self.now - self.max_age * 24 * 3600,))
+        self.conn.execute("DELETE FROM timestamps WHERE rowid IN (SELECT "
+                          "rowid FROM timestamps ORDER BY used DESC "
+                          "LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self.conn.commit()
+        self.conn.close()
+
+
+def get_new_file_names(curr_file_names, hour_offset, exif, jobs=1,
+                       failures=None, cache=None):
+    """
+    Generates (date time file name, name) of the files in the order of
+    curr_file_names. Files whose time can't be read are reported and
+    skipped, (name, reason) of them is appended to failures if given.
+
+    """
+    for name, timestamp, reason in get_timestamps(curr_file_names, exif,
+                                                  jobs, cache):
+        if reason:
+            print("Can't process file '%s', reason:\n%s" % (name, reason))
+            if failures is not None:
+                failures.append((name, reason))
+            continue
+        if timestamp is None:
+            continue  # directory
+        if exif:
+            print("Processed file '%s'." % name)
         date_time_file_name = get_date_time_string(timestamp, hour_offset)
         yield date_time_file_name, name
 
 
-def do_rename(old_name, new_name, confirmation):
-    print("renaming %s -> %s" % (old_name, new_name))
-    if os.path.exists(new_name):
-        print("file '%s' exists, exit." % new_name)
-        sys.exit(1)
-    if confirmation:
-        os.rename(old_name, new_name)
+def list_files(top, existing, recursive=False):
+    """
+    Generates paths (relative to the top directory, joined to top) of
+    files in the top directory (and its subdirectories if recursive).
+    Paths of all entries found (directories as well) are added into the
+    existing set. Entries are listed by os.scandir(), no stat() per file.
+
+    """
+    directories = [top]
+    while directories:
+        directory = directories.pop()
+        for entry in scandir(directory or "."):
+            path = os.path.join(directory, entry.name)
+            existing.add(path)
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    directories.append(path)
+            elif path != JOURNAL_FILE:
+                yield path
+
+
+def scandir(directory):
+    """
+    os.scandir() with a fallback for Python 2 (os.listdir() and stat()).
+
+    """
+    if hasattr(os, "scandir"):
+        return os.scandir(directory)
+    return [DirEntry(directory, name) for name in os.listdir(directory)]
+
+
+class DirEntry(object):
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.path.isdir(self.path)
+        return os.path.isdir(self.path) and not os.path.islink(self.path)
+
+
+def get_rename_plan(data):
+    """
+    Returns list of (old path, new path) of the files of data (as returned
+    by get_file_rename_data()) to be renamed. Files are renamed within
+    their directory, counters of files with duplicate times are per
+    directory. Files already named as required are left out.
+
+    """
+    plan = []
+    for dt_file_name, curr_file_names in data.items():
+        directories = {}
+        for curr_file_name in curr_file_names:
+            directory = os.path.dirname(curr_file_name)
+            directories.setdefault(directory, []).append(curr_file_name)
+        for directory in sorted(directories):
+            names = directories[directory]
+            counter = 0
+            for curr_file_name in names:
+                counter += 1
+                ext = os.path.splitext(curr_file_name)[1]
+                if (len(names) > 1):
+                    new_name = "%s-%d%s" % (dt_file_name, counter, ext)
+                else:
+                    new_name = "%s%s" % (dt_file_name, ext)
+                new_name = os.path.join(directory, new_name)
+                if new_name != curr_file_name:
+                    plan.append((curr_file_name, new_name))
+    return plan
+
+
+def get_collisions(plan, existing):
+    """
+    Returns new paths of the plan which exist (in the existing set) and
+    are not renamed by the plan themselves or which are targets of more
+    renames.
+
+    """
+    sources = set(old for old, new in plan)
+    targets = set()
+    collisions = []
+    for old, new in plan:
+        if (new in existing and new not in sources) or new in targets:
+            collisions.append(new)
+        targets.add(new)
+    return collisions
+
+
+def get_temp_name(path, reserved):
+    """
+    Returns temporary name for path which is neither in reserved nor
+    exists, the name is added into reserved.
 
+    """
+    temp = "%s.ratt-tmp" % path
+    counter = 1
+    while temp in reserved or os.path.lexists(temp):
+        temp = "%s.ratt-tmp%s" % (path, counter)
+        counter += 1
+    reserved.add(temp)
+    return temp
+
+
+def order_renames(plan, existing=None):
+    """
+    Returns renames of the (collision free) plan ordered by directory so
+    that no file is renamed onto a file yet to be renamed. Cycles of
+    renames are broken by a temporary name, not colliding with existing
+    (set of paths), any name of the plan or an existing file.
+
+    """
+    pending = {}
+    reserved = set(existing or ())
+    for old, new in plan:
+        pending[old] = new
+        reserved.update((old, new))
+    ordered = []
+    for start, new in sorted(plan, key=lambda rename: (
+            os.path.dirname(rename[0]), rename[0])):
+        if start not in pending:
+            continue  # renamed as part of a chain
+        # chain of renames, each onto the source of the next one
+        chain = [start]
+        while pending[chain[-1]] in pending:
+            if pending[chain[-1]] == start:
+                break  # cycle
+            chain.append(pending[chain[-1]])
+        renames = [(old, pending.pop(old)) for old in chain]
+        if renames[-1][1] == start:
+            temp = get_temp_name(start, reserved)
+            renames[0] = (temp, renames[0][1])
+            ordered.append((start, temp))
+        ordered.extend(reversed(renames))
+    return ordered
+
+
+def apply_renames(renames, journal_file=JOURNAL_FILE):
+    """
+    Rename files (old and new path in the same directory) in order. All
+    renames are recorded into journal_file (synced to the disk) before
+    the first one is done, the journal is removed once all files are
+    renamed.
+    Renames are done relative to a file descriptor of the directory (no
+    path lookup per file) where supported.
+
+    """
+    use_dir_fd = os.rename in getattr(os, "supports_dir_fd", ())
+    journal = open(journal_file, "a")
+    dir_fd = None
+    fd_directory = None
+    try:
+        for old, new in renames:
+            journal.write("%s\n" % json.dumps([old, new]))
+        journal.flush()
+        os.fsync(journal.fileno())
+        sync_directory(os.path.dirname(os.path.abspath(journal_file)))
+        for old, new in renames:
+            if not use_dir_fd:
+                os.rename(old, new)
+                continue
+            directory = os.path.dirname(old)
+            if directory != fd_directory or dir_fd is None:
+                if dir_fd is not None:
+                    os.close(dir_fd)
+                    dir_fd = None
+                dir_fd = os.open(directory or ".", os.O_RDONLY)
+                fd_directory = directory
+            os.rename(os.path.basename(old), os.path.basename(new),
+                      src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+        journal.close()
+    os.remove(journal_file)
+
+
+def sync_directory(directory):
+    """
+    fsync() directory so that the entries created in it are on the disk
+    (not supported on Windows, ignored there).
+
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def rollback_renames(journal_file=JOURNAL_FILE):
+    """
+    Undo renames recorded in journal_file (by an interrupted run), in the
+    reverse order. Returns number of files renamed back.
 
-def get_file_rename_data(data_source_func, hour_offset, exif):
+    """
+    journal = open(journal_file, "r")
+    try:
+        renames = [json.loads(line) for line in journal if line.strip()]
+    finally:
+        journal.close()
+    count = 0
+    for old, new in reversed(renames):
+        # renames recorded after the interrupted one have not been done
+        if os.path.lexists(new) and not os.path.lexists(old):
+            print("renaming back %s -> %s" % (new, old))
+            os.rename(new, old)
+            count += 1
+    os.remove(journal_file)
+    return count
+
+
+def get_file_rename_data(data_source_func, hour_offset, exif, jobs=1,
+                         failures=None, cache=None):
     # file name items
-    fn_items = get_new_file_names(data_source_func(), hour_offset, exif)
+    fn_items = get_new_file_names(data_source_func(), hour_offset, exif,
+                                  jobs, failures, cache)
     # key = destination filename (still without counter in case of duplicates)
     # value = [list of old names], number of items determines suffix counter
     data = {}
@@ -176,26 +927,83 @@ def get_file_rename_data(data_source_func, hour_offset, exif):
     return data
 
 
-def rename_according_to_time_and_date(data, confirmation):
-    for dt_file_name, curr_file_names in data.items():
-        counter = 0
-        for curr_file_name in curr_file_names:
-            counter += 1
-            ext = os.path.splitext(curr_file_name)[1]
-            if (len(curr_file_names) > 1):
-                new_name = "%s-%d%s" % (dt_file_name, counter, ext)
-            else:
-                new_name = "%s%s" % (dt_file_name, ext)
-            do_rename(curr_file_name, new_name, confirmation)
+def rename_according_to_time_and_date(data, confirmation, existing=None,
+                                      journal_file=JOURNAL_FILE):
+    """
+    Rename files of data (see get_rename_plan()) if confirmation.
+    existing is set of paths of all entries of the directories of the
+    files (listed if not given). Nothing is renamed (and exits) if any
+    of the new names collides with an existing file.
+
+    """
+    plan = get_rename_plan(data)
+    if existing is None:
+        existing = set()
+        for directory in set(os.path.dirname(old) for old, new in plan):
+            existing.update(os.path.join(directory, name)
+                            for name in os.listdir(directory or "."))
+    for old, new in plan:
+        print("renaming %s -> %s" % (old, new))
+    collisions = get_collisions(plan, existing)
+    if collisions:
+        for new in collisions:
+            print("file '%s' exists." % new)
+        print("%s collision(s), nothing renamed, exit." % len(collisions))
+        sys.exit(1)
+    if confirmation:
+        apply_renames(order_renames(plan, existing), journal_file)
+
+
+def open_cache():
+    """
+    Returns TimestampCache, None if it can't be opened (just warns).
+
+    """
+    try:
+        return TimestampCache()
+    except (OSError, sqlite3.Error) as ex:
+        print("Can't open cache '%s', reason: %s" % (CACHE_FILE, ex))
+        return None
 
 
 def main():
-    confirmation, hour_offset, exif = process_input_args(sys.argv[1:])
-    data_source_func = partial(os.listdir, os.getcwd())
-    data = get_file_rename_data(data_source_func, hour_offset, exif)
-    rename_according_to_time_and_date(data, confirmation)
-    if not confirmation:
+    options = process_input_args(sys.argv[1:])
+    if options.rollback:
+        if os.path.exists(JOURNAL_FILE):
+            count = rollback_renames()
+            print("%s file(s) renamed back." % count)
+        else:
+            print("No journal '%s' found, nothing to roll back." %
+                  JOURNAL_FILE)
+        return
+    if os.path.exists(JOURNAL_FILE):
+        print("Journal '%s' of an interrupted run found, roll it back by "
+              "--rollback first, exit." % JOURNAL_FILE)
+        sys.exit(1)
+    existing = set()
+    data_source_func = partial(list_files, "", existing,
+                               options.recursive)
+    failures = []
+    cache = open_cache() if options.exif and options.use_cache else None
+    try:
+        data = get_file_rename_data(data_source_func, options.offset_hour,
+                                    options.exif, options.jobs, failures,
+                                    cache)
+    finally:
+        if cache:
+            print("%s file time(s) found in cache, %s read." %
+                  (cache.hit_count, cache.miss_count))
+            cache.close()
+    rename_according_to_time_and_date(data, options.confirm, existing)
+    if failures:
+        print("\n\n%s file(s) could not be processed, not renamed:" %
+              len(failures))
+        for name, reason in failures:
+            print("%s: %s" % (name, reason))
+    if not options.confirm:
         print("\n\nrun with '-c' to really perform files renaming.\n")
+    if failures:
+        sys.exit(1)
 
 
 if (__name__ == "__main__"):
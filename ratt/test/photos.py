@@ -0,0 +1,69 @@
+"""
+synthetic photo files for tests of ratt.py and its benchmark
+
+"""
+
+import struct
+
+
+def make_tiff(endian, ifd0, exif=None, fillers=0, magic=42):
+    """
+    Returns TIFF structure (as stored in EXIF) with ASCII entries ifd0
+    {tag: value} in IFD0 and entries exif in the Exif IFD (no Exif IFD if
+    None) and fillers SHORT entries in IFD0 (other EXIF information).
+
+    """
+    ifd0 = sorted(ifd0.items()) + [(0xc000 + i, i) for i in range(fillers)]
+    ifds = [ifd0]
+    if exif is not None:
+        ifds.append(sorted(exif.items()))
+    # IFDs follow the header, values follow the IFDs
+    sizes = [2 + 12 * (len(entries) + 1) + 4 for entries in ifds]
+    data_offset = 8 + sum(sizes)
+    ifd_data, data = [], []
+    for i, entries in enumerate(ifds):
+        ifd = [struct.pack(endian + "H", len(entries) + 1)]
+        if i == 0 and exif is not None:
+            # pointer to the Exif IFD (LONG)
+            ifd.append(struct.pack(endian + "HHII", 0x8769, 4, 1,
+                                   8 + sizes[0]))
+        else:
+            # padding entry (SHORT), IFDs are of the size computed
+            ifd.append(struct.pack(endian + "HHIHH", 0xbfff, 3, 1, 0, 0))
+        for tag, value in entries:
+            if not isinstance(value, str):
+                ifd.append(struct.pack(endian + "HHIHH", tag, 3, 1, value, 0))
+                continue
+            value = value.encode("ascii") + b"\0"
+            if len(value) <= 4:
+                field = value.ljust(4, b"\0")
+            else:
+                field = struct.pack(endian + "I", data_offset)
+                data.append(value)
+                data_offset += len(value)
+            ifd.append(struct.pack(endian + "HHI", tag, 2, len(value)) +
+                       field)
+        ifd.append(struct.pack(endian + "I", 0))
+        ifd_data.append(b"".join(ifd))
+    header = (b"II" if endian == "<" else b"MM") + struct.pack(endian + "HI",
+                                                                magic, 8)
+    return b"".join([header] + ifd_data + data)
+
+
+def make_jpeg(tiff, thumbnail_size=0, payload_size=0):
+    """
+    Returns JPEG file data, EXIF (APP1) segment of tiff followed by
+    thumbnail_size bytes (thumbnail) preceded by a JFIF (APP0) segment,
+    payload_size bytes of image data.
+
+    """
+    app0 = b"JFIF\0\1\1\0\0\1\0\1\0\0"
+    app1 = b"Exif\0\0" + tiff + b"\0" * thumbnail_size
+    segments = [b"\xff\xd8"]
+    for code, data in ((0xe0, app0), (0xe1, app1), (0xdb, b"\0" * 65)):
+        segments.append(struct.pack(">BBH", 0xff, code, len(data) + 2))
+        segments.append(data)
+    segments.append(b"\xff\xda\0\2")
+    segments.append(b"\0" * payload_size)
+    segments.append(b"\xff\xd9")
+    return b"".join(segments)
@@ -1,14 +1,13 @@
 """
 tests for ratt.py
 
-TODO:
-    exif stuff not tested
-
 """
 
 import os
 import sys
 import time
+import json
+import struct
 from datetime import datetime
 from datetime import timedelta
 from tempfile import NamedTemporaryFile
@@ -21,32 +20,79 @@ from ratt import get_date_time_string
 from ratt import get_file_rename_data
 from ratt import rename_according_to_time_and_date
 from ratt import DAYS_OF_WEEK
+from ratt import DEFAULT_JOBS
+from ratt import get_new_file_names
+from ratt import TimestampCache
+from ratt import list_files
+from ratt import get_rename_plan
+from ratt import get_collisions
+from ratt import order_renames
+from ratt import apply_renames
+from ratt import rollback_renames
+from ratt import read_mp4_creation_time
+from ratt import read_heif_date_time
+from ratt import MP4_EPOCH_OFFSET
+from ratt import read_exif_date_time
+from ratt import get_timestamp_from_exif
+
+from .photos import make_tiff
+from .photos import make_jpeg
 
 
 def test_process_input_args():
     inp = ""
-    confirmation, hour_offset, exif = process_input_args(inp.split())
-    assert confirmation is False
-    assert hour_offset == 0
-    assert exif is False
+    options = process_input_args(inp.split())
+    assert options.confirm is False
+    assert options.offset_hour == 0
+    assert options.exif is False
+    assert options.jobs == DEFAULT_JOBS
+    assert options.use_cache is True
+    assert options.recursive is False
+    assert options.rollback is False
 
     inp = "-c -o 9"
-    confirmation, hour_offset, exif = process_input_args(inp.split())
-    assert confirmation is True
-    assert hour_offset == 9
+    options = process_input_args(inp.split())
+    assert options.confirm is True
+    assert options.offset_hour == 9
 
     # wrong offset, should fall back to default
     inp = "-c -o a"
-    confirmation, hour_offset, exif = process_input_args(inp.split())
-    assert confirmation is True
-    assert hour_offset == 0
+    options = process_input_args(inp.split())
+    assert options.confirm is True
+    assert options.offset_hour == 0
 
     # wrong offset, should fall back to default
     inp = "-c -o 2.3 -e"
-    confirmation, hour_offset, exif = process_input_args(inp.split())
-    assert confirmation is True
-    assert hour_offset == 0
-    assert exif is True
+    options = process_input_args(inp.split())
+    assert options.confirm is True
+    assert options.offset_hour == 0
+    assert options.exif is True
+
+    inp = "-j 3"
+    options = process_input_args(inp.split())
+    assert options.jobs == 3
+
+    # processes instead of threads
+    inp = "-j 3 -p"
+    options = process_input_args(inp.split())
+    assert options.jobs == -3
+
+    inp = "-e --no-cache"
+    options = process_input_args(inp.split())
+    assert options.use_cache is False
+
+    inp = "-r -c"
+    options = process_input_args(inp.split())
+    assert options.recursive is True
+
+    inp = "--rollback"
+    options = process_input_args(inp.split())
+    assert options.rollback is True
+
+    # wrong number of jobs, should fall back to default
+    inp = "-j 0"
+    options = process_input_args(inp.split())
+    assert options.jobs == DEFAULT_JOBS
 
 
 def test_get_date_time_string():
@@ -135,3 +181,386 @@ def test_rename_according_to_time_and_date():
     data = get_file_rename_data(data_source_func, 0, False)
     # tempfile would fail on attemp to rename, don't perform actual rename
     rename_according_to_time_and_date(data, False)
+
+
+def read_date_time(data):
+    f = NamedTemporaryFile()
+    f.write(data)
+    f.flush()
+    fd = open(f.name, "rb")
+    try:
+        return read_exif_date_time(fd)
+    finally:
+        fd.close()
+        f.close()
+
+
+def test_read_exif_date_time():
+    original = "2014:06:28 11:53:21"
+    digitized = "2014:06:28 11:53:22"
+    changed = "2015:01:02 03:04:05"
+    for endian in "<>":
+        # DateTimeOriginal preferred
+        tiff = make_tiff(endian, {0x0132: changed},
+                         {0x9003: original, 0x9004: digitized}, fillers=5)
+        assert read_date_time(make_jpeg(tiff, 1000, 1000)) == original
+        # TIFF based raw file
+        assert read_date_time(tiff + b"\0" * 1000) == original
+        tiff = make_tiff(endian, {0x0132: changed}, {0x9003: original},
+                         magic=0x4f52)
+        assert read_date_time(tiff) == original
+
+        # blank DateTimeOriginal, DateTimeDigitized then
+        tiff = make_tiff(endian, {0x0132: changed},
+                         {0x9003: "    :  :     :  :  ", 0x9004: digitized})
+        assert read_date_time(make_jpeg(tiff)) == digitized
+
+        # no Exif IFD, DateTime of IFD0
+        tiff = make_tiff(endian, {0x0132: changed})
+        assert read_date_time(make_jpeg(tiff)) == changed
+
+        # no date time at all
+        tiff = make_tiff(endian, {0x010f: "Camera"}, {})
+        assert read_date_time(make_jpeg(tiff)) is None
+
+    # no EXIF segment, other format
+    assert read_date_time(make_jpeg(b"", 0, 1000)[:2] + b"\xff\xda") is None
+    assert read_date_time(b"GIF89a") is None
+
+
+def test_get_timestamp_from_exif():
+    dt = "2014:06:28 11:53:21"
+    tiff = make_tiff("<", {}, {0x9003: dt})
+    f = NamedTemporaryFile()
+    f.write(make_jpeg(tiff))
+    f.flush()
+    ts = get_timestamp_from_exif(f.name)
+    assert ts == time.mktime(datetime(2014, 6, 28, 11, 53, 21).timetuple())
+    f.close()
+
+    # truncated file, not even exifread finds the date time
+    f = NamedTemporaryFile()
+    f.write(make_jpeg(tiff)[:30])
+    f.flush()
+    py.test.raises(Exception, get_timestamp_from_exif, f.name)
+    f.close()
+
+
+def test_get_new_file_names_parallel():
+    """
+    Results come in the order of the input names whatever the number of
+    jobs, files which can't be read are reported and skipped.
+
+    """
+    files = []
+    for i in range(40):
+        dt = "2014:06:28 11:%02d:%02d" % (i % 3, 59 - i)
+        f = NamedTemporaryFile()
+        f.write(make_jpeg(make_tiff("<", {}, {0x9003: dt})))
+        f.flush()
+        files.append(f)
+    broken = NamedTemporaryFile()
+    broken.write(b"not a photo")
+    broken.flush()
+    names = [f.name for f in files]
+    names.insert(7, broken.name)
+    names.insert(20, "/nonexistent/photo.jpg")
+
+    expected = None
+    for jobs in (1, 4, -2):
+        failures = []
+        result = list(get_new_file_names(names, 0, True, jobs, failures))
+        assert [name for dt, name in result] == [f.name for f in files]
+        assert [name for name, reason in failures] == [
+            broken.name, "/nonexistent/photo.jpg"]
+        if expected is None:
+            expected = result
+        assert result == expected
+    for f in files + [broken]:
+        f.close()
+
+
+def test_timestamp_cache(tmpdir):
+    cache_file = str(tmpdir.join("cache", "timestamps.sqlite"))
+    f = NamedTemporaryFile()
+    f.write(b"data")
+    f.flush()
+    st = os.stat(f.name)
+    cache = TimestampCache(cache_file)
+    assert cache.get(st) is None
+    cache.put(st, 1000.5)
+    assert cache.get(st) == 1000.5
+    cache.close()
+
+    cache = TimestampCache(cache_file)
+    assert cache.get(st) == 1000.5
+    # file changed
+    f.write(b"more data")
+    f.flush()
+    assert cache.get(os.stat(f.name)) is None
+    cache.close()
+    f.close()
+
+    # eviction of the least recently used beyond max_entries
+    files = get_files(3)
+    cache = TimestampCache(cache_file, max_entries=2)
+    for i, f in enumerate(files):
+        cache.now = time.time() + i
+        cache.put(os.stat(f.name), i)
+    cache.close()
+    cache = TimestampCache(cache_file)
+    assert [cache.get(os.stat(f.name)) for f in files] == [None, 1, 2]
+    # not used for max_age days
+    cache.now = time.time() - 2 * 24 * 3600
+    cache.close()
+    cache = TimestampCache(cache_file, max_age=1)
+    cache.close()
+    cache = TimestampCache(cache_file)
+    assert [cache.get(os.stat(f.name)) for f in files] == [None, None, None]
+    cache.close()
+
+
+def test_get_new_file_names_cache(tmpdir):
+    cache_file = str(tmpdir.join("timestamps.sqlite"))
+    names = []
+    for i in range(10):
+        dt = "2014:06:28 11:53:%02d" % i
+        f = tmpdir.join("%s.jpg" % i)
+        f.write(make_jpeg(make_tiff("<", {}, {0x9003: dt})), "wb")
+        names.append(str(f))
+    cache = TimestampCache(cache_file)
+    expected = list(get_new_file_names(names, 0, True, 4, cache=cache))
+    assert (cache.hit_count, cache.miss_count) == (0, 10)
+    cache.close()
+
+    # modified file is read again
+    f = tmpdir.join("3.jpg")
+    f.write(f.read("rb") + b"\0", "wb")
+    cache = TimestampCache(cache_file)
+    result = list(get_new_file_names(names, 0, True, 4, cache=cache))
+    assert (cache.hit_count, cache.miss_count) == (9, 1)
+    assert result == expected
+    cache.close()
+
+
+def test_list_files(tmpdir):
+    tmpdir.join("a.jpg").write("")
+    tmpdir.join("sub", "b.jpg").write("", ensure=True)
+    tmpdir.join("sub", "deeper", "c.jpg").write("", ensure=True)
+    top = str(tmpdir)
+    existing = set()
+    assert list(list_files(top, existing)) == [os.path.join(top, "a.jpg")]
+    assert existing == set([os.path.join(top, "a.jpg"),
+                            os.path.join(top, "sub")])
+    existing = set()
+    files = sorted(list_files(top, existing, recursive=True))
+    assert files == [os.path.join(top, name)
+                     for name in ("a.jpg", "sub/b.jpg", "sub/deeper/c.jpg")]
+    assert len(existing) == 5
+
+
+def test_get_rename_plan():
+    data = {"2014": ["a/1.jpg", "b/2.jpg", "a/3.JPG"],
+            "2015": ["a/4.jpg", "a/5.jpg"],
+            "2016": ["c/2016.jpg"]}
+    plan = sorted(get_rename_plan(data))
+    # counters per directory, correctly named file left out
+    assert plan == [("a/1.jpg", "a/2014-1.jpg"), ("a/3.JPG", "a/2014-2.JPG"),
+                    ("a/4.jpg", "a/2015-1.jpg"), ("a/5.jpg", "a/2015-2.jpg"),
+                    ("b/2.jpg", "b/2014.jpg")]
+
+
+def test_get_collisions():
+    plan = [("a", "b"), ("b", "c"), ("d", "e"), ("f", "e")]
+    assert get_collisions(plan, set(["a", "b", "c", "d", "f"])) == ["c", "e"]
+    assert get_collisions(plan[:3], set(["a", "b", "d"])) == []
+
+
+def test_order_renames():
+    # chain, the file renamed onto has to be renamed first
+    assert order_renames([("a", "b"), ("b", "c")]) == [("b", "c"),
+                                                        ("a", "b")]
+    # cycle, broken by a temporary name
+    assert order_renames([("a", "b"), ("b", "a")]) == [
+        ("a", "a.ratt-tmp"), ("b", "a"), ("a.ratt-tmp", "b")]
+    renames = order_renames([("d/x", "d/y"), ("e/a", "e/b"), ("d/w", "d/x")])
+    assert renames == [("d/x", "d/y"), ("d/w", "d/x"), ("e/a", "e/b")]
+    # temporary name neither existing nor in the plan
+    renames = order_renames([("a", "b"), ("b", "a"),
+                             ("c", "a.ratt-tmp1")], set(["a.ratt-tmp"]))
+    assert renames[:3] == [("a", "a.ratt-tmp2"), ("b", "a"),
+                           ("a.ratt-tmp2", "b")]
+
+
+def test_apply_and_rollback_renames(tmpdir):
+    for name in ("a", "b", "c"):
+        tmpdir.join("sub", name).write(name, ensure=True)
+    d = str(tmpdir.join("sub"))
+    journal = str(tmpdir.join("journal"))
+    plan = [(os.path.join(d, "a"), os.path.join(d, "b")),
+            (os.path.join(d, "b"), os.path.join(d, "a")),
+            (os.path.join(d, "c"), os.path.join(d, "x"))]
+    apply_renames(order_renames(plan), journal)
+    assert not os.path.exists(journal)
+    assert [tmpdir.join("sub", name).read() for name in ("a", "b", "x")] == [
+        "b", "a", "c"]
+
+    # interrupted run, the last rename recorded is not done
+    renames = order_renames([(new, old) for old, new in plan])
+    apply_renames(renames[:2], journal)
+    f = open(journal, "w")
+    for old, new in renames[:3]:
+        f.write("%s\n" % json.dumps([old, new]))
+    f.close()
+    assert rollback_renames(journal) == 2
+    assert not os.path.exists(journal)
+    assert [tmpdir.join("sub", name).read() for name in ("a", "b", "x")] == [
+        "b", "a", "c"]
+
+
+def test_apply_renames_journal_synced(tmpdir, monkeypatch):
+    for name in ("a", "b", "c"):
+        tmpdir.join("sub", name).write(name, ensure=True)
+    d = str(tmpdir.join("sub"))
+    journal = str(tmpdir.join("journal"))
+    plan = [(os.path.join(d, "a"), os.path.join(d, "b")),
+            (os.path.join(d, "b"), os.path.join(d, "a")),
+            (os.path.join(d, "c"), os.path.join(d, "x"))]
+    renames = order_renames(plan)
+    calls = []
+    fsync, rename = os.fsync, os.rename
+
+    def record_fsync(fd):
+        calls.append("fsync")
+        fsync(fd)
+
+    def interrupted_rename(old, new, **kwargs):
+        # all renames are on the disk before the first one
+        assert [json.loads(line) for line in open(journal)] == [
+            list(r) for r in renames]
+        assert "fsync" in calls
+        calls.append("rename")
+        if calls.count("rename") == 3:
+            raise OSError("interrupted")
+        rename(old, new, **kwargs)
+
+    monkeypatch.setattr(os, "fsync", record_fsync)
+    monkeypatch.setattr(os, "rename", interrupted_rename)
+    py.test.raises(OSError, apply_renames, renames, journal)
+    monkeypatch.undo()
+    # renames not done are skipped
+    assert rollback_renames(journal) == 2
+    assert [tmpdir.join("sub", name).read() for name in ("a", "b", "c")] == [
+        "a", "b", "c"]
+
+
+def make_box(box_type, payload, version=None):
+    """
+    Returns ISO base media file format box, full box if version given.
+
+    """
+    if version is not None:
+        payload = struct.pack(">B3s", version, b"\0\0\0") + payload
+    return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+
+def make_mp4(creation_time, version=0, media_size=1000):
+    """
+    Returns MP4 movie data, media data (with 64-bit size) precede the
+    movie header as they often do in files of cameras.
+
+    """
+    ftyp = make_box(b"ftyp", b"isom\0\0\0\0isommp41")
+    mdat = struct.pack(">I4sQ", 1, b"mdat", media_size + 16)
+    mdat += b"\0" * media_size
+    if version == 1:
+        times = struct.pack(">QQ", creation_time, creation_time)
+    else:
+        times = struct.pack(">II", creation_time, creation_time)
+    mvhd = make_box(b"mvhd", times + b"\0" * 80, version)
+    moov = make_box(b"moov", make_box(b"trak", b"\0" * 50) + mvhd)
+    return ftyp + mdat + moov
+
+
+def make_heif(tiff):
+    """
+    Returns HEIF image data with an image item and an Exif item of tiff,
+    both in the mdat box following the meta box.
+
+    """
+    ftyp = make_box(b"ftyp", b"heic\0\0\0\0mif1heic")
+    infe = [make_box(b"infe", struct.pack(">HH4s", item_id, 0, item_type) +
+                     b"\0", 2)
+            for item_id, item_type in ((1, b"hvc1"), (2, b"Exif"))]
+    iinf = make_box(b"iinf", struct.pack(">H", 2) + b"".join(infe), 0)
+    exif = struct.pack(">I", 6) + b"Exif\0\0" + tiff
+    image = b"\0" * 1000
+
+    def make_meta(mdat_offset):
+        items = ((1, mdat_offset, len(image)),
+                 (2, mdat_offset + len(image), len(exif)))
+        iloc = struct.pack(">BBH", 0x44, 0, len(items))
+        for item_id, offset, length in items:
+            iloc += struct.pack(">HHHII", item_id, 0, 1, offset, length)
+        hdlr = make_box(b"hdlr", b"\0" * 4 + b"pict" + b"\0" * 13, 0)
+        return make_box(b"meta", hdlr + iinf + make_box(b"iloc", iloc, 0),
+                        0)
+
+    # offset of the mdat payload depends on size of meta only
+    meta = make_meta(0)
+    meta = make_meta(len(ftyp) + len(meta) + 8)
+    return ftyp + meta + make_box(b"mdat", image + exif)
+
+
+def read_container(data, reader):
+    f = NamedTemporaryFile()
+    f.write(data)
+    f.flush()
+    fd = open(f.name, "rb")
+    try:
+        return reader(fd)
+    finally:
+        fd.close()
+        f.close()
+
+
+def test_read_mp4_creation_time():
+    ts = time.mktime(datetime(2016, 7, 1, 10, 20, 30).timetuple())
+    for version in (0, 1):
+        data = make_mp4(int(ts) + MP4_EPOCH_OFFSET, version)
+        assert read_container(data, read_mp4_creation_time) == ts
+    # creation time not set
+    assert read_container(make_mp4(0), read_mp4_creation_time) is None
+    # no movie header
+    data = make_mp4(int(ts) + MP4_EPOCH_OFFSET)
+    assert read_container(data[:-100], read_mp4_creation_time) is None
+
+
+def test_read_heif_date_time():
+    dt = "2014:06:28 11:53:21"
+    for endian in "<>":
+        tiff = make_tiff(endian, {0x0132: "2015:01:02 03:04:05"},
+                         {0x9003: dt})
+        assert read_container(make_heif(tiff), read_heif_date_time) == dt
+    data = make_heif(make_tiff("<", {}, {}))
+    assert read_container(data, read_heif_date_time) is None
+
+
+def test_get_timestamp_from_exif_containers(tmpdir):
+    # MP4 movie, creation time (UTC) stored as is
+    ts = 1467368430
+    f = tmpdir.join("movie.mp4")
+    f.write(make_mp4(ts + MP4_EPOCH_OFFSET, media_size=10 ** 6), "wb")
+    assert get_timestamp_from_exif(str(f)) == ts
+
+    # HEIC image, EXIF date time in local time as in JPEG files
+    f = tmpdir.join("image.heic")
+    f.write(make_heif(make_tiff("<", {}, {0x9003: "2014:06:28 11:53:21"})),
+            "wb")
+    assert get_timestamp_from_exif(str(f)) == time.mktime(
+        datetime(2014, 6, 28, 11, 53, 21).timetuple())
+
+    # movie without creation time
+    f = tmpdir.join("movie.mov")
+    f.write(make_mp4(0), "wb")
+    py.test.raises(Exception, get_timestamp_from_exif, str(f))